@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+import bisect
+import collections
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import recordOutput
+import recordScraperLib as rs
+from recordStore import normalize_apn
+
+# An inverted index from APN (block and lot) to the records that cover it,
+# for the transfer history of a single lot without loading the corpus or
+# running a database. An index directory holds two files:
+#
+#   records.jsonl  every record once, one JSON document per line
+#   apn.idx        a header, then fixed-width (APN, offset, length) entries
+#                  sorted by APN and, within an APN, by filing date
+#
+# Lookups mmap apn.idx and binary search it, then read the matching lines
+# of records.jsonl.
+
+INDEX_MAGIC = "APNIDX01"
+APN_KEY_BYTES = 24  # APNs are padded with NULs to this width
+# Block-lot numbers as checked by HTMLRecordsAPNParser.validate_records.
+APN_RE = re.compile(r"[\d\w]+-\d+$")
+HEADER = struct.Struct(">8sIQQ")  # magic, key width, entries, records size
+ENTRY = struct.Struct(">%dsQI" % APN_KEY_BYTES)  # APN, offset, length
+RECORDS_FILENAME = "records.jsonl"
+INDEX_FILENAME = "apn.idx"
+
+""" Index key of an APN, or None if it is not a valid block-lot number. """
+def apn_key(apn):
+    apn = normalize_apn(apn)
+    if not APN_RE.match(apn):
+        return None
+    apn = apn.encode('utf-8')
+    if len(apn) > APN_KEY_BYTES:
+        return None
+    return apn.ljust(APN_KEY_BYTES, "\0")
+
+""" Writes an index of the records in the output files of output_path to
+index_path. A document found in several output files (e.g. a day written in
+two formats, or under two record types) is kept once, as last read, in the
+place it was first read. Both files are written under temp names and
+renamed when done; the index header records the size of the records file it
+belongs to. Returns (records, index entries). """
+def build_index(output_path, index_path):
+    if not os.path.isdir(index_path):
+        os.makedirs(index_path)
+    records_path = os.path.join(index_path, RECORDS_FILENAME)
+    index_file_path = os.path.join(index_path, INDEX_FILENAME)
+    records = collections.OrderedDict()  # document id -> record
+    for filename in sorted(os.listdir(output_path)):
+        try:
+            recordOutput.format_for_path(filename)
+        except ValueError:
+            continue
+        for record in recordOutput.iter_records(
+                os.path.join(output_path, filename)):
+            records[record['id']] = record
+    entries = []
+    f_records = open(records_path + ".tmp", 'wb')
+    try:
+        offset = 0
+        for record in records.itervalues():
+            line = rs.encode_record(record) + "\n"
+            f_records.write(line)
+            sort_key = rs.record_sort_key(record)
+            for apn in set(record.get('apn') or []):
+                key = apn_key(apn)
+                if key is None:
+                    if apn:
+                        logging.warning("Not indexing APN %r of %s", apn,
+                                        record['id'])
+                    continue
+                entries.append((key, sort_key, offset, len(line)))
+            offset += len(line)
+        f_records.flush()
+        os.fsync(f_records.fileno())
+    finally:
+        f_records.close()
+    entries.sort()
+
+    f_index = open(index_file_path + ".tmp", 'wb')
+    try:
+        f_index.write(HEADER.pack(INDEX_MAGIC, APN_KEY_BYTES, len(entries),
+                                  offset))
+        for key, sort_key, entry_offset, length in entries:
+            f_index.write(ENTRY.pack(key, entry_offset, length))
+        f_index.flush()
+        os.fsync(f_index.fileno())
+    finally:
+        f_index.close()
+    os.rename(records_path + ".tmp", records_path)
+    os.rename(index_file_path + ".tmp", index_file_path)
+    return (len(records), len(entries))
+
+""" The APN keys of an mmapped index, as a sequence for bisect. """
+class IndexKeys(object):
+    def __init__(self, index_map, count):
+        self.index_map = index_map
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        start = HEADER.size + idx * ENTRY.size
+        return self.index_map[start:start + APN_KEY_BYTES]
+
+""" Read-only view of an index built by build_index. Opening it only maps
+the files, so it is ready at once however large the corpus. """
+class APNIndex(object):
+    def __init__(self, index_path):
+        self.index_file = open(os.path.join(index_path, INDEX_FILENAME), 'rb')
+        self.records_file = open(
+            os.path.join(index_path, RECORDS_FILENAME), 'rb')
+        self.index_map = mmap.mmap(self.index_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        if os.fstat(self.records_file.fileno()).st_size:
+            self.records_map = mmap.mmap(self.records_file.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+        else:
+            self.records_map = ""  # mmap refuses empty files
+        magic, key_bytes, count, records_size = HEADER.unpack(
+            self.index_map[0:HEADER.size])
+        if magic != INDEX_MAGIC or key_bytes != APN_KEY_BYTES:
+            raise ValueError("%s is not an APN index" % index_path)
+        if records_size != len(self.records_map) or \
+                len(self.index_map) != HEADER.size + count * ENTRY.size:
+            raise ValueError("APN index in %s does not match its records, "
+                             "rebuild it" % index_path)
+        self.keys = IndexKeys(self.index_map, count)
+
+    def close(self):
+        self.index_map.close()
+        if self.records_map:
+            self.records_map.close()
+        self.index_file.close()
+        self.records_file.close()
+
+    """ (offset, length) of every record covering the APN, in date order. """
+    def locate(self, apn):
+        key = apn_key(apn)
+        if key is None:
+            return []
+        locations = []
+        idx = bisect.bisect_left(self.keys, key)
+        while idx < len(self.keys) and self.keys[idx] == key:
+            start = HEADER.size + idx * ENTRY.size
+            entry_key, offset, length = ENTRY.unpack(
+                self.index_map[start:start + ENTRY.size])
+            locations.append((offset, length))
+            idx += 1
+        return locations
+
+    """ Raw JSON lines of the records covering the APN, in date order. """
+    def history_lines(self, apn):
+        return [self.records_map[offset:offset + length].rstrip("\n")
+                for offset, length in self.locate(apn)]
+
+    """ The transfer history of a block/lot: the records covering the APN,
+    as dicts, in date order. """
+    def history(self, apn):
+        return [json.loads(line) for line in self.history_lines(apn)]
+
+def usage():
+    print
+    print 'Usage: ./apnIndex.py build INDEX_DIR data_path'
+    print '       ./apnIndex.py lookup INDEX_DIR BLOCK-LOT [BLOCK-LOT ...]'
+    print
+    print """Builds an APN index of the recordScraper output files in data_path, or prints the records of each given block/lot in date order, one JSON record per line."""
+    sys.exit(2)
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    if len(argv) < 4:
+        usage()
+    command, index_path = argv[1:3]
+    if command == 'build' and len(argv) == 4:
+        records, entries = build_index(argv[3], index_path)
+        logging.info("Indexed %d records under %d APN entries.", records,
+                     entries)
+    elif command == 'lookup':
+        index = APNIndex(index_path)
+        try:
+            for apn in argv[3:]:
+                for line in index.history_lines(apn):
+                    print line
+        finally:
+            index.close()
+    else:
+        usage()
+
+if __name__ == '__main__':
+    main(sys.argv)
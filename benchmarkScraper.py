@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+import getopt
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import Queue
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import recordScraperLib as rs
+
+# Offline benchmarks of the parsing and normalization code, built on the pages
+# in testdata/. Every benchmark runs in a child process of its own, so its
+# peak memory can be reported, and the results are printed as JSON for
+# comparing runs between commits (see --compare).
+
+TESTDATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "testdata")
+DATE_QUERY_PAGES = ("datequery_doc_type_list1.html",
+                    "datequery_doc_type_list2.html",
+                    "datequery_doc_type_list3.html")
+APN_PAGES = ("apnquery_doc_detail1.html",
+             "apnquery_doc_detail2.html",
+             "apnquery_doc_detail3.html")
+# apnquery_doc_detail1.html has no reel/image yet, so its rows go through the
+# sniffing fallback of HTMLRecordsAPNParser.flush_data_to_records.
+SNIFFING_APN_PAGE = "apnquery_doc_detail1.html"
+DEFAULT_SCALES = (1, 10)
+DEFAULT_REPEAT = 5
+DEFAULT_TOLERANCE = 0.2  # slowdown that --compare reports as a regression
+BENCHMARK_DATE = "02/01/2011"
+CHILD_POLL_SECONDS = 1.0  # how often run_benchmark checks its child is alive
+
+RECORDS_TABLE_RE = re.compile(r'(<table class="records"[^>]*>)(.*?)(</table>)',
+                              re.S | re.I)
+DOCUMENT_ID_RE = re.compile(r'>([A-Z])(\d+)-(\d{2})<')
+DOC_REF_RE = re.compile(r'l_doc_ref_no=(\d+)')
+SCALED_ID_STEP = 10000000  # added to document numbers for each copy
+
+def read_testdata(filename):
+    f = open(os.path.join(TESTDATA_PATH, filename), 'r')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+""" Renumbers the document ids and APN links of a table row for copy number
+copy of a scaled page. """
+def renumber_row(row, copy):
+    if copy == 0:
+        return row
+    row = DOCUMENT_ID_RE.sub(lambda match: ">%s%d-%s<" % (
+            match.group(1), int(match.group(2)) + copy * SCALED_ID_STEP,
+            match.group(3)), row)
+    return DOC_REF_RE.sub(lambda match: "l_doc_ref_no=%d" % (
+            int(match.group(1)) + copy * SCALED_ID_STEP), row)
+
+""" Synthesizes a page with factor times the records of page, by repeating
+the data rows of each records table, passing each copy of a row through
+renumber(row, copy). Header rows stay as they are. """
+def scale_page(page, factor, renumber=renumber_row):
+    if factor == 1 and renumber is renumber_row:
+        return page
+    def scale_table(match):
+        rows = match.group(2).split("</tr>")
+        data_rows = [idx for idx, row in enumerate(rows[:-1])
+                     if DOCUMENT_ID_RE.search(row)]
+        if not data_rows:
+            return match.group(0)
+        first, last = data_rows[0], data_rows[-1] + 1
+        scaled = [renumber(row, copy) for copy in range(factor)
+                  for row in rows[first:last]]
+        return match.group(1) + "</tr>".join(
+            rows[:first] + scaled + rows[last:]) + match.group(3)
+    return RECORDS_TABLE_RE.sub(scale_table, page)
+
+""" Replaces the document id of an APN detail page. """
+def set_apn_page_document(page, document_id):
+    return DOCUMENT_ID_RE.sub(">%s<" % document_id, page)
+
+""" Runs fn repeat times. Returns the (best, median) seconds and the result
+of the last call. """
+def time_calls(fn, repeat):
+    timings = []
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        result = fn()
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[0], timings[len(timings) / 2], result
+
+def count_rows(records):
+    return sum(len(rows) for rows in records.itervalues())
+
+def parse_page(parser_class, engine, page):
+    parser = parser_class(engine)
+    parser.feed(page)
+    return parser.get_records()
+
+""" Parses a date query page. """
+def benchmark_date_query_parser(filename, engine, scale, repeat):
+    page = scale_page(read_testdata(filename), scale)
+    best, median, records = time_calls(
+        lambda: parse_page(rs.HTMLRecordsDateQueryParser, engine, page),
+        repeat)
+    return {'best_s': best, 'median_s': median, 'bytes': len(page),
+            'documents': len(records), 'rows': count_rows(records),
+            'pages_per_s': 1 / best, 'rows_per_s': count_rows(records) / best}
+
+""" Parses an APN detail page. For the sniffing page every row goes through
+the sniffing fallback. """
+def benchmark_apn_parser(filename, engine, scale, repeat):
+    page = scale_page(read_testdata(filename), scale)
+    best, median, records = time_calls(
+        lambda: parse_page(rs.HTMLRecordsAPNParser, engine, page), repeat)
+    return {'best_s': best, 'median_s': median, 'bytes': len(page),
+            'documents': len(records), 'rows': count_rows(records),
+            'pages_per_s': 1 / best, 'rows_per_s': count_rows(records) / best}
+
+""" The normalization steps of fetch_records_for_daterange on a parsed date
+query page: building each document's record from its rows and merging in a
+parsed APN detail page. """
+def benchmark_normalization(filename, scale, repeat):
+    groups = parse_page(rs.HTMLRecordsDateQueryParser, 'fast',
+                        scale_page(read_testdata(filename), scale)).items()
+    apn_records = [parse_page(rs.HTMLRecordsAPNParser, 'fast',
+                              read_testdata(apn_filename))
+                   for apn_filename in APN_PAGES]
+    def normalize():
+        normalized_records = []
+        for idx, (joinkey, record_rows) in enumerate(groups):
+            normalized_record = rs.normalize_date_query_rows(joinkey,
+                                                             record_rows)
+            if normalized_record is None:
+                continue
+            apn_record = apn_records[idx % len(apn_records)].values()[0]
+            rs.merge_apn_records(normalized_record, {joinkey: apn_record})
+            normalized_records.append(normalized_record)
+        normalized_records.sort(key=rs.record_sort_key)
+        return normalized_records
+    best, median, records = time_calls(normalize, repeat)
+    return {'best_s': best, 'median_s': median, 'documents': len(records),
+            'rows': sum(len(rows) for joinkey, rows in groups),
+            'records_per_s': len(records) / best}
+
+""" Writes a replay archive that answers the date query for BENCHMARK_DATE
+with page and every APN lookup of it with a fixture APN page. Returns the
+number of APN pages archived. """
+def build_replay_archive(archive, page, record_type_num):
+    archive.put("/cgi-bin/new_get_recorded.cgi",
+                rs.CRIISCallerDateQuery.build_params(
+                    BENCHMARK_DATE, BENCHMARK_DATE, record_type_num), page)
+    apn_pages = [read_testdata(filename) for filename in APN_PAGES]
+    records = parse_page(rs.HTMLRecordsDateQueryParser, 'fast', page)
+    for idx, (joinkey, record_rows) in enumerate(sorted(records.items())):
+        url, params = rs.CRIISCallerAPNQuery.split_apn_url(
+            record_rows[0]['APNLink'])
+        archive.put(url, params, set_apn_page_document(
+                apn_pages[idx % len(apn_pages)], joinkey))
+    return len(records)
+
+""" fetch_records_for_daterange end to end, with every page served from a
+replay archive: streaming parse of the date query, normalization and the
+pooled APN lookups. """
+def benchmark_fetch(filename, engine, scale, repeat):
+    archive_path = tempfile.mkdtemp()
+    try:
+        rs.CRIISCaller.archive = rs.ResponseArchive(archive_path, offline=True)
+        build_replay_archive(rs.CRIISCaller.archive,
+                             scale_page(read_testdata(filename), scale),
+                             rs.RECORD_TYPES['DEED'])
+        rs.PARSER_ENGINE = engine
+        best, median, records = time_calls(
+            lambda: rs.fetch_records_for_daterange(
+                BENCHMARK_DATE, BENCHMARK_DATE, rs.RECORD_TYPES['DEED']),
+            repeat)
+    finally:
+        shutil.rmtree(archive_path)
+    return {'best_s': best, 'median_s': median, 'documents': len(records),
+            'records_per_s': len(records) / best}
+
+""" Lists the (name, function, arguments) of the benchmarks to run. """
+def list_benchmarks(engines, scales, repeat):
+    benchmarks = []
+    for scale in scales:
+        for engine in engines:
+            for filename in DATE_QUERY_PAGES:
+                benchmarks.append((
+                        "parse.datequery.%s.%s.x%d" % (
+                            filename[:-5], engine, scale),
+                        benchmark_date_query_parser,
+                        (filename, engine, scale, repeat)))
+            for filename in APN_PAGES:
+                if filename == SNIFFING_APN_PAGE:
+                    continue
+                benchmarks.append((
+                        "parse.apn.%s.%s.x%d" % (filename[:-5], engine, scale),
+                        benchmark_apn_parser,
+                        (filename, engine, scale, repeat)))
+            benchmarks.append((
+                    "sniff.apn.%s.x%d" % (engine, scale),
+                    benchmark_apn_parser,
+                    (SNIFFING_APN_PAGE, engine, scale, repeat)))
+        for filename in DATE_QUERY_PAGES:
+            benchmarks.append((
+                    "normalize.%s.x%d" % (filename[:-5], scale),
+                    benchmark_normalization, (filename, scale, repeat)))
+        for engine in engines:
+            benchmarks.append((
+                    "fetch.%s.%s.x%d" % (DATE_QUERY_PAGES[1][:-5], engine,
+                                         scale),
+                    benchmark_fetch,
+                    (DATE_QUERY_PAGES[1], engine, scale, repeat)))
+    return benchmarks
+
+""" Peak resident set size of this process so far, in KB. """
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024  # Reported in bytes there.
+    return peak
+
+def run_benchmark_child(queue, fn, args):
+    logging.disable(logging.WARNING)
+    start_rss = peak_rss_kb()
+    try:
+        result = fn(*args)
+    except Exception, e:
+        queue.put({'error': "%s: %s" % (type(e).__name__, str(e))})
+        return
+    result['peak_rss_kb'] = peak_rss_kb()
+    result['rss_growth_kb'] = result['peak_rss_kb'] - start_rss
+    queue.put(result)
+
+""" Runs fn(*args) in a child process and returns its result dict, with the
+peak memory of the child added. A child that dies without a result (killed,
+out of memory, or failing before it could report) gives an error result. """
+def run_benchmark(fn, args):
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=run_benchmark_child,
+                                    args=(queue, fn, args))
+    child.start()
+    result = None
+    while result is None:
+        # Checked before the get, so a result put just before the child
+        # exited is still read.
+        alive = child.is_alive()
+        try:
+            result = queue.get(timeout=CHILD_POLL_SECONDS)
+        except Queue.Empty:
+            if not alive:
+                result = {'error': "Benchmark process exited with code %s" %
+                          child.exitcode}
+                logging.error("%s", result['error'])
+    child.join()
+    return result
+
+""" The current git commit of the tree, if there is one. """
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=TESTDATA_PATH,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(engines, scales, repeat, name_filter=None):
+    results = dict()
+    for name, fn, args in list_benchmarks(engines, scales, repeat):
+        if name_filter and name_filter not in name:
+            continue
+        logging.info("Running %s", name)
+        results[name] = run_benchmark(fn, args)
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'repeat': repeat,
+        'results': results,
+    }
+
+""" Compares the best timings of two runs. Returns a list of (name, baseline
+seconds, current seconds, ratio) for the benchmarks of both, and the names of
+those that got slower by more than tolerance. """
+def compare_runs(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    comparison = []
+    regressions = []
+    for name in sorted(current['results']):
+        result = current['results'][name]
+        base_result = baseline['results'].get(name)
+        if base_result is None or 'best_s' not in base_result or \
+                'best_s' not in result:
+            continue
+        ratio = result['best_s'] / base_result['best_s']
+        comparison.append((name, base_result['best_s'], result['best_s'],
+                           ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return comparison, regressions
+
+def usage():
+    print
+    print 'Usage: ./benchmarkScraper.py [options]'
+    print
+    print """Benchmarks parsing, normalization and offline end-to-end fetching on the pages in testdata/, and prints the results as JSON."""
+    print
+    print 'Options:'
+    print '  --engine=ENGINE       Only benchmark this parser engine'
+    print '                        (default: all of %s)' % (
+        ", ".join(rs.PARSER_ENGINES))
+    print '  --scale=N[,N...]      Also synthesize pages with N times the rows'
+    print '                        of the fixtures (default 1,10)'
+    print '  --repeat=N            Runs per benchmark; the best counts'
+    print '                        (default %d)' % DEFAULT_REPEAT
+    print '  --filter=TEXT         Only run benchmarks whose name contains TEXT'
+    print '  --output=FILE         Write the JSON results to FILE'
+    print '  --compare=FILE        Compare against the results in FILE and exit'
+    print '                        with status 1 on regressions'
+    print '  --tolerance=F         Slowdown that counts as a regression'
+    print '                        (default %.1f)' % DEFAULT_TOLERANCE
+    sys.exit(2)
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    engines = rs.PARSER_ENGINES
+    scales = DEFAULT_SCALES
+    repeat = DEFAULT_REPEAT
+    name_filter = None
+    output = None
+    compare = None
+    tolerance = DEFAULT_TOLERANCE
+    try:
+        flags, args = getopt.gnu_getopt(argv[1:], '', [
+                'engine=', 'scale=', 'repeat=', 'filter=', 'output=',
+                'compare=', 'tolerance='])
+        for flag, value in flags:
+            if flag == '--engine':
+                if value not in rs.PARSER_ENGINES:
+                    raise Exception("Unknown parser engine %s" % value)
+                engines = (value,)
+            elif flag == '--scale':
+                scales = tuple(int(scale) for scale in value.split(","))
+            elif flag == '--repeat':
+                repeat = int(value)
+            elif flag == '--filter':
+                name_filter = value
+            elif flag == '--output':
+                output = value
+            elif flag == '--compare':
+                compare = value
+            elif flag == '--tolerance':
+                tolerance = float(value)
+        if args:
+            raise Exception("Unexpected arguments: %s" % " ".join(args))
+    except Exception, e:
+        print str(e)
+        usage()
+
+    run = run_benchmarks(engines, scales, repeat, name_filter)
+    encoded = json.dumps(run, indent=2, sort_keys=True)
+    if output:
+        f = open(output, 'w')
+        try:
+            f.write(encoded + "\n")
+        finally:
+            f.close()
+    else:
+        print encoded
+    if compare:
+        f = open(compare, 'r')
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        comparison, regressions = compare_runs(baseline, run, tolerance)
+        for name, base_s, cur_s, ratio in comparison:
+            logging.info("%-50s %8.4fs -> %8.4fs (x%.2f)", name, base_s, cur_s,
+                         ratio)
+        if regressions:
+            logging.error("Slower than %s: %s", compare, ", ".join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+import getopt
+import logging
+import os
+import socket
+import sys
+import threading
+import recordScraperLib as rs
+import recordScraper
+import recordOutput
+import recordMetrics
+from recordMetrics import METRICS
+from apnIndex import APN_RE
+from recordStore import normalize_apn
+
+# Fetches the documents of many parcels by block/lot query, instead of by
+# date range. The block/lot numbers to fetch are kept in a WorkQueue file, so
+# a bulk run of a whole list of parcels can be stopped and resumed, and
+# several bulkScraper processes (on one host, or sharing the file system) can
+# work through the same queue. Each parcel gets its own output file,
+# APN_<block>-<lot>.<format>, in data_path.
+
+BULK_WORKERS = 2  # parcels fetched at once by a bulkScraper run
+OUTPUT_PREFIX = "APN"
+
+LONG_OPTIONS = [
+    'workers=',
+    'apn-concurrency=',
+    'max-rate=',
+    'format=',
+    'known=',
+    'known-blank-ttl-days=',
+    'force',
+    'website=',
+    'metrics=',
+    'metrics-interval=',
+    'lease-seconds=',
+    'max-attempts=',
+    'failed',
+]
+
+def usage():
+    print
+    print 'Usage: ./bulkScraper.py [options] add QUEUE APN_LIST'
+    print '       ./bulkScraper.py [options] run QUEUE data_path'
+    print '       ./bulkScraper.py status QUEUE'
+    print '       ./bulkScraper.py [--failed] release QUEUE'
+    print
+    print """Queues the block/lot numbers listed in APN_LIST (one BLOCK-LOT per line, '-' for stdin) in the work queue file QUEUE, or fetches the records of the queued parcels into one output file per parcel in data_path. Any number of runs may work on one queue at a time; parcels of a run that died are handed out again once their lease expires."""
+    print
+    print 'Options:'
+    print '  --workers=N           Parcels fetched at once (default %d)' % (
+        BULK_WORKERS)
+    print '  --apn-concurrency=N   APN detail lookups in flight per parcel'
+    print '                        (default %d)' % rs.APN_FETCH_CONCURRENCY
+    print '  --max-rate=R          Ceiling for the adaptive request rate, in'
+    print '                        requests per second (default %.0f)' % (
+        rs.CRIISCaller.rate_controller.max_rate)
+    print '  --format=FORMAT       Output format, one of %s' % (
+        ', '.join(recordOutput.OUTPUT_FORMATS))
+    print '  --known=FILE          Remember looked-up documents in FILE and skip'
+    print '                        their APN lookups for other parcels'
+    print '  --known-blank-ttl-days=N'
+    print '                        Look up known documents without reel/image'
+    print '                        again after N days (default %d)' % (
+        rs.KNOWN_BLANK_TTL_DAYS)
+    print '  --force               Look up every document again'
+    print '  --website=HOST[:PORT] Query this server instead of %s' % (
+        rs.CRIISCaller.website)
+    print '  --metrics=PATH        Dump counters and latency histograms to'
+    print '                        PATH.json and PATH.prom while running'
+    print '  --metrics-interval=S  Seconds between metrics dumps'
+    print '  --lease-seconds=S     Hand a parcel to another run if it is not'
+    print '                        done after S seconds (default %d)' % (
+        rs.WORK_LEASE_SECONDS)
+    print '  --max-attempts=N      Give up on a parcel after N tries'
+    print '                        (default %d)' % rs.WORK_MAX_ATTEMPTS
+    print '  --failed              With release, queue the parcels that were'
+    print '                        given up on again'
+    sys.exit(2)
+
+def parse_commandline_arguments(argv):
+    options = recordScraper.default_options()
+    options.update({
+        'workers': BULK_WORKERS,
+        'lease_seconds': rs.WORK_LEASE_SECONDS,
+        'max_attempts': rs.WORK_MAX_ATTEMPTS,
+        'failed': False,
+    })
+    try:
+        flags, args = getopt.gnu_getopt(argv[1:], '', LONG_OPTIONS)
+        for flag, value in flags:
+            if flag == '--workers':
+                options['workers'] = int(value)
+                if options['workers'] < 1:
+                    raise Exception("Need at least one worker")
+            elif flag == '--apn-concurrency':
+                options['apn_concurrency'] = int(value)
+                if options['apn_concurrency'] < 1:
+                    raise Exception("APN concurrency must be at least 1")
+            elif flag == '--max-rate':
+                options['max_rate'] = float(value)
+                if options['max_rate'] <= 0:
+                    raise Exception("Max rate must be positive")
+            elif flag == '--format':
+                if value not in recordOutput.OUTPUT_FORMATS:
+                    raise Exception("Unknown output format %s" % value)
+                options['format'] = value
+            elif flag == '--known':
+                options['known'] = value
+            elif flag == '--known-blank-ttl-days':
+                options['known_blank_ttl_days'] = float(value)
+            elif flag == '--force':
+                options['force'] = True
+            elif flag == '--website':
+                options['website'] = value
+            elif flag == '--metrics':
+                options['metrics'] = value
+            elif flag == '--metrics-interval':
+                options['metrics_interval'] = float(value)
+            elif flag == '--lease-seconds':
+                options['lease_seconds'] = float(value)
+                if options['lease_seconds'] <= 0:
+                    raise Exception("Leases must be positive")
+            elif flag == '--max-attempts':
+                options['max_attempts'] = int(value)
+                if options['max_attempts'] < 1:
+                    raise Exception("Need at least one attempt per parcel")
+            elif flag == '--failed':
+                options['failed'] = True
+        commands = {'add': 3, 'run': 3, 'status': 2, 'release': 2}
+        if not args or len(args) != commands.get(args[0]):
+            usage()
+    except Exception, e:
+        print str(e)
+        usage()
+    options['total_rate'] = options['max_rate']
+    return (args[0], args[1:], options)
+
+""" Parses a BLOCK-LOT number into (block, lot). Raises ValueError if it is
+not one. """
+def parse_blocklot(apn):
+    apn = normalize_apn(apn)
+    if not APN_RE.match(apn):
+        raise ValueError("Not a block-lot number: %r" % apn)
+    return tuple(apn.split("-", 1))
+
+""" Reads the block/lot numbers of an APN list, one per line. Blank lines
+and lines starting with # are skipped. Returns the normalized numbers. """
+def read_apn_list(f):
+    apns = []
+    for line_no, line in enumerate(f):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            apns.append("%s-%s" % parse_blocklot(line))
+        except ValueError, e:
+            raise ValueError("Line %d: %s" % (line_no + 1, str(e)))
+    return apns
+
+def blocklot_output_filename(output_path, apn, output_format):
+    return os.path.join(output_path, "%s_%s%s" % (
+            OUTPUT_PREFIX, apn, recordOutput.output_extension(output_format)))
+
+""" Fetches the records of one block/lot and writes its output file. Raises
+rs.DSException if the block/lot could not be fetched. """
+def fetch_and_write_blocklot(apn, output_path, options):
+    block, lot = parse_blocklot(apn)
+    known = None
+    if options['known']:
+        known = rs.KnownDocuments(options['known'],
+                                  options['known_blank_ttl_days'],
+                                  options['force'])
+    try:
+        records = rs.fetch_records_for_blocklot(
+            block, lot, apn_concurrency=options['apn_concurrency'],
+            known=known)
+    finally:
+        if known is not None:
+            known.close()
+    with recordOutput.RecordWriter(blocklot_output_filename(
+            output_path, apn, options['format']), options['format']) as writer:
+        writer.write_all(records)
+    METRICS.inc('blocklots_written_total')
+    METRICS.observe('blocklot_records', len(records),
+                    buckets=recordMetrics.COUNT_BUCKETS)
+    return records
+
+""" One worker thread of run_queue: leases a block/lot at a time until the
+queue has nothing left to hand out. """
+def work_queue(queue, owner, output_path, options, stats):
+    while True:
+        items = queue.lease(owner)
+        if not items:
+            return
+        apn = items[0]
+        logging.info("Fetching records for block/lot %s", apn)
+        try:
+            with METRICS.timer('blocklot_seconds'):
+                fetch_and_write_blocklot(apn, output_path, options)
+        except rs.DSException, e:
+            state = queue.fail(apn, owner, str(e))
+            METRICS.inc('blocklots_failed_total')
+            logging.error("Failed to fetch block/lot %s (%s)", apn,
+                          state or "lease lost")
+            stats.append((apn, state))
+            continue
+        if not queue.complete(apn, owner):
+            logging.warning("Lease on block/lot %s expired before it was "
+                            "done", apn)
+        stats.append((apn, 'done'))
+
+""" Works through the queue with options['workers'] threads, each leasing
+one block/lot at a time, until no block/lot is left to hand out. Returns
+the (block/lot, state) pairs of the parcels this run worked on. """
+def run_queue(queue, output_path, options):
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    stats = []
+    owner = "%s:%d" % (socket.gethostname(), os.getpid())
+    threads = [threading.Thread(
+            target=work_queue, args=(queue, "%s:%d" % (owner, idx),
+                                     output_path, options, stats))
+               for idx in range(options['workers'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats
+
+def log_queue_counts(queue):
+    counts = queue.counts()
+    logging.info("Queue: %d pending, %d leased, %d done, %d failed.",
+                 counts['pending'], counts['leased'], counts['done'],
+                 counts['failed'])
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    command, args, options = parse_commandline_arguments(argv)
+    queue = rs.WorkQueue(args[0], options['lease_seconds'],
+                         options['max_attempts'])
+    try:
+        if command == 'add':
+            f = sys.stdin
+            if args[1] != '-':
+                f = open(args[1])
+            try:
+                apns = read_apn_list(f)
+            except ValueError, e:
+                logging.error("Not queueing %s: %s", args[1], str(e))
+                sys.exit(1)
+            finally:
+                f.close()
+            logging.info("Queued %d of %d block/lots.", queue.add(apns),
+                         len(apns))
+        elif command == 'run':
+            if options['website'] == rs.CRIIS_WEBSITE and \
+                    not rs.BLOCKLOT_FORM_VERIFIED:
+                logging.error("The block/lot query has not been checked "
+                              "against %s yet (see BLOCKLOT_FORM_VERIFIED); "
+                              "only runs with --website are allowed.",
+                              rs.CRIIS_WEBSITE)
+                sys.exit(1)
+            recordScraper.configure_callers(options)
+            dumper = None
+            if options['metrics']:
+                dumper = recordMetrics.MetricsDumper(
+                    METRICS, options['metrics'],
+                    options['metrics_interval']).start()
+            try:
+                stats = run_queue(queue, args[1], options)
+            finally:
+                if dumper is not None:
+                    dumper.stop()
+            logging.info("Fetched %d block/lots.", len(
+                    [apn for apn, state in stats if state == 'done']))
+            recordScraper.log_connection_stats()
+        elif command == 'release':
+            logging.info("Released %d block/lots.",
+                         queue.release(options['failed']))
+        for apn, attempts, error in queue.failures():
+            logging.error("Gave up on block/lot %s after %d attempts: %s",
+                          apn, attempts, error)
+        log_queue_counts(queue)
+    finally:
+        queue.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
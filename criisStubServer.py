@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+import BaseHTTPServer
+import collections
+import datetime
+import getopt
+import gzip
+import json
+import logging
+import random
+import re
+import signal
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+import zlib
+from cStringIO import StringIO
+import benchmarkScraper
+import recordCalendar
+
+# A local stand-in for www.criis.com, for load and fault-injection testing of
+# the fetch path without touching the live site. Like CyberQuery it answers a
+# POST to /cgi-bin/new_get_recorded.cgi with a 302 to a results file, which
+# is then fetched with a GET. Date queries get the testdata/ date query pages,
+# with the rows dated and renumbered for each day asked for; block/lot
+# queries get the page of a day picked by the block/lot; APN detail
+# queries get the testdata/ APN pages for the document. Faults are injected
+# per request at configurable rates. Point the scraper at it with
+# --website=127.0.0.1:PORT.
+
+QUERY_PATH = "/cgi-bin/new_get_recorded.cgi"
+RESULTS_PATH = "/results/"
+STATS_PATH = "/stats"
+MAX_RESULTS = 1000  # results files kept for their GET
+DAY_ID_STEP = 1000  # document number offset between the copies of a page
+DATE_RE = re.compile(r"\d{2}/\d{2}/\d{4}")
+DOC_REF_ID_RE = re.compile(r'l_doc_ref_no=(\d+).*>([A-Z]\d+-\d{2})<', re.S)
+REPORT_PAGES_META_RE = re.compile(
+    r'(<meta\s+name="CQCS-Report-Pages"\s+content=")(\d+)(")', re.I)
+FAULTS = ('drop', 'timeout', 'error')
+# Block/lot queries answer with the date query page of a day in the
+# BLOCKLOT_DAYS days from BLOCKLOT_FIRST_DAY.
+BLOCKLOT_FIRST_DAY = datetime.date(2011, 1, 1)
+BLOCKLOT_DAYS = 365
+
+""" Parses an MMDDYYYY or MM/DD/YYYY date. """
+def parse_query_date(value):
+    value = value.replace("/", "")
+    return datetime.date(int(value[4:8]), int(value[0:2]), int(value[2:4]))
+
+""" Fault injection and latency settings of a CRIISStubServer. Rates are
+probabilities per request. A dropped request gets its connection closed
+without a response, a timed out one is held for timeout_seconds first, and
+an error is a 500 response. Truncated results files are cut off halfway
+through their body. With gzip set, results pages are sent gzip-compressed
+to clients that accept it. With closed_days set, weekends and county holidays
+have no records, as on the real site. fault_plan lists the faults (or None for no fault) of
+the first requests, for tests that need them in a fixed order. """
+class StubBehavior(object):
+    def __init__(self, min_latency=0.0, max_latency=0.0, drop_rate=0.0,
+                 timeout_rate=0.0, error_rate=0.0, truncate_rate=0.0,
+                 timeout_seconds=15.0, scale=1, keep_alive=False, seed=None,
+                 fault_plan=(), gzip=False, closed_days=False):
+        self.min_latency = min_latency
+        self.max_latency = max(min_latency, max_latency)
+        self.drop_rate = drop_rate
+        self.timeout_rate = timeout_rate
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.timeout_seconds = timeout_seconds
+        self.scale = scale
+        self.keep_alive = keep_alive
+        self.gzip = gzip
+        self.closed_days = closed_days
+        self.random = random.Random(seed)
+        self.fault_plan = collections.deque(fault_plan)
+        self.lock = threading.Lock()
+
+    def latency(self):
+        with self.lock:
+            return self.random.uniform(self.min_latency, self.max_latency)
+
+    """ Returns the fault to inject into a request, or None. """
+    def choose_fault(self):
+        with self.lock:
+            if self.fault_plan:
+                return self.fault_plan.popleft()
+            draw = self.random.random()
+        for fault, rate in zip(FAULTS, (self.drop_rate, self.timeout_rate,
+                                        self.error_rate)):
+            if draw < rate:
+                return fault
+            draw -= rate
+        return None
+
+    def truncate(self):
+        with self.lock:
+            return self.random.random() < self.truncate_rate
+
+class CRIISStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug("%s %s", self.address_string(), format % args)
+
+    def do_POST(self):
+        self.server.begin_request()
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+            params = urlparse.parse_qs(self.rfile.read(length),
+                                       keep_blank_values=True)
+            if self.inject_fault():
+                return
+            if urlparse.urlparse(self.path).path != QUERY_PATH:
+                self.send_page(404, "Not Found")
+                return
+            try:
+                if 'l_doc_ref_no' in params:
+                    self.server.count('apn_queries')
+                    page = self.server.apn_page(
+                        int(params['l_doc_ref_no'][0]))
+                elif 'APN_BLOCK' in params:
+                    self.server.count('blocklot_queries')
+                    page = self.server.blocklot_query_page(
+                        params['APN_BLOCK'][0], params['APN_LOT'][0])
+                else:
+                    self.server.count('date_queries')
+                    page = self.server.date_query_page(
+                        parse_query_date(params['doc_dateA'][0]),
+                        parse_query_date(params['doc_dateB'][0]))
+            except (KeyError, ValueError), e:
+                self.send_page(400, "Bad query: %s" % str(e))
+                return
+            self.send_response(302)
+            self.send_header('Location', self.server.add_result(page))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        finally:
+            self.server.end_request()
+
+    def do_GET(self):
+        self.server.begin_request()
+        try:
+            if self.path == STATS_PATH:
+                self.send_page(200, json.dumps(self.server.get_stats()),
+                               'application/json')
+                return
+            if self.inject_fault():
+                return
+            page = self.server.get_result(self.path)
+            if page is None:
+                self.send_page(404, "Not Found")
+                return
+            self.server.count('results')
+            encoding = None
+            if self.server.behavior.gzip and 'gzip' in (
+                    self.headers.getheader('accept-encoding') or ""):
+                encoding = 'gzip'
+                page = gzip_page(page)
+            if self.server.behavior.truncate():
+                self.server.count('truncated')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                self.send_header('Content-Length', str(len(page)))
+                self.end_headers()
+                self.wfile.write(page[:len(page) / 2])
+                self.close_connection = 1
+                return
+            self.send_page(200, page, encoding=encoding)
+        finally:
+            self.server.end_request()
+
+    """ Sleeps for the configured latency, then injects a fault if one is
+    drawn. Returns True if the request was answered (or dropped) by it. """
+    def inject_fault(self):
+        behavior = self.server.behavior
+        time.sleep(behavior.latency())
+        fault = behavior.choose_fault()
+        if fault is None:
+            return False
+        self.server.count(fault)
+        logging.info("Injecting %s into %s %s", fault, self.command,
+                     self.path)
+        if fault == 'timeout':
+            time.sleep(behavior.timeout_seconds)
+        if fault == 'error':
+            self.send_page(500, "Internal Server Error")
+        else:
+            self.close_connection = 1
+        return True
+
+    def send_page(self, status, body, content_type='text/html',
+                  encoding=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count('body_bytes', len(body))
+
+def gzip_page(page):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6)
+    try:
+        f.write(page)
+    finally:
+        f.close()
+    return buf.getvalue()
+
+""" Keeps connections open between requests. Responses are buffered and
+sent without Nagle's delay, which otherwise holds back the body written
+after the headers on a connection that stays open. """
+class KeepAliveCRIISStubHandler(CRIISStubHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+class CRIISStubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), behavior=None):
+        self.behavior = behavior or StubBehavior()
+        handler = CRIISStubHandler
+        if self.behavior.keep_alive:
+            handler = KeepAliveCRIISStubHandler
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()
+        self.result_count = 0
+        self.documents = dict()  # l_doc_ref_no -> document id
+        self.stats = collections.defaultdict(int)
+        self.in_flight = 0
+        self.started_at = time.time()
+        self.date_query_pages = [
+            benchmarkScraper.read_testdata(filename)
+            for filename in benchmarkScraper.DATE_QUERY_PAGES]
+        self.apn_pages = [benchmarkScraper.read_testdata(filename)
+                          for filename in benchmarkScraper.APN_PAGES]
+        self.calendar = recordCalendar.DatePlanner()
+        self.thread = None
+
+    """ HOST:PORT to point CRIISCaller.website at. """
+    @property
+    def website(self):
+        return "%s:%d" % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def process_request(self, request, client_address):
+        self.count('connections')
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def begin_request(self):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.in_flight += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'],
+                                              self.in_flight)
+
+    def end_request(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['uptime_s'] = time.time() - self.started_at
+        stats['requests_per_s'] = stats.get('requests', 0) / stats['uptime_s']
+        return stats
+
+    """ Stores a results page and returns its path. """
+    def add_result(self, page):
+        with self.lock:
+            self.result_count += 1
+            path = "%s%d.html" % (RESULTS_PATH, self.result_count)
+            self.results[path] = page
+            while len(self.results) > MAX_RESULTS:
+                self.results.popitem(last=False)
+        return path
+
+    def get_result(self, path):
+        with self.lock:
+            return self.results.get(path)
+
+    """ The date query page for start_date to end_date: one testdata/ page,
+    picked by start_date, with its rows repeated behavior.scale times for
+    every day and dated and renumbered for that day. Closed days (see
+    StubBehavior) get no rows. """
+    def date_query_page(self, start_date, end_date):
+        days = [start_date + datetime.timedelta(days=offset)
+                for offset in range((end_date - start_date).days + 1)]
+        if not days:
+            raise ValueError("Empty date range")
+        if self.behavior.closed_days:
+            days = [day for day in days
+                    if self.calendar.reason(day) is None]
+        scale = self.behavior.scale
+        template = self.date_query_pages[
+            start_date.toordinal() % len(self.date_query_pages)]
+        def renumber(row, copy):
+            day = days[copy / scale]
+            date = day.strftime("%m/%d/%Y")
+            row = benchmarkScraper.renumber_row(
+                row, (day.toordinal() % DAY_ID_STEP) * scale + copy % scale +
+                1)
+            return DATE_RE.sub(date, row)
+        page = benchmarkScraper.scale_page(template, len(days) * scale,
+                                           renumber)
+        page = REPORT_PAGES_META_RE.sub(lambda match: "%s%d%s" % (
+                match.group(1), int(match.group(2)) * len(days) * scale,
+                match.group(3)), page, count=1)
+        documents = dict()
+        for row in page.split("</tr>"):
+            match = DOC_REF_ID_RE.search(row)
+            if match:
+                documents[int(match.group(1))] = match.group(2)
+        with self.lock:
+            self.documents.update(documents)
+        return page
+
+    """ The results page of a block/lot query: the date query page of a
+    day picked by the block/lot, so each parcel gets its own documents. """
+    def blocklot_query_page(self, block, lot):
+        if not block or not lot:
+            raise ValueError("Empty block/lot")
+        day = BLOCKLOT_FIRST_DAY + datetime.timedelta(
+            days=zlib.crc32("%s-%s" % (block, lot)) % BLOCKLOT_DAYS)
+        return self.date_query_page(day, day)
+
+    """ The APN detail page of the document with this l_doc_ref_no. """
+    def apn_page(self, doc_ref):
+        page = self.apn_pages[doc_ref % len(self.apn_pages)]
+        with self.lock:
+            document_id = self.documents.get(doc_ref)
+        if document_id is None:
+            return page
+        return benchmarkScraper.set_apn_page_document(page, document_id)
+
+def usage():
+    print
+    print 'Usage: ./criisStubServer.py [options]'
+    print
+    print """Serves the testdata/ pages the way www.criis.com serves its query results, with optional latency and injected faults. Point recordScraper at it with --website=127.0.0.1:PORT. GET /stats returns the request counters as JSON."""
+    print
+    print 'Options:'
+    print '  --port=N              Port to listen on (default 8080)'
+    print '  --latency=MIN[:MAX]   Seconds before each answer'
+    print '  --drop-rate=F         Share of requests whose connection is closed'
+    print '                        without an answer'
+    print '  --timeout-rate=F      Share of requests held for --timeout-seconds'
+    print '                        (default 15) and then dropped'
+    print '  --error-rate=F        Share of requests answered with a 500'
+    print '  --truncate-rate=F     Share of results pages cut off halfway'
+    print '  --scale=N             Serve N times the rows per day'
+    print '  --keep-alive          Speak HTTP/1.1 and keep connections open'
+    print '  --gzip                Compress results pages for clients that'
+    print '                        accept it'
+    print '  --closed-days         Serve no records on weekends and county'
+    print '                        holidays'
+    print '  --seed=N              Seed for the injected faults'
+    sys.exit(2)
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    port = 8080
+    settings = dict()
+    try:
+        flags, args = getopt.gnu_getopt(argv[1:], '', [
+                'port=', 'latency=', 'drop-rate=', 'timeout-rate=',
+                'error-rate=', 'truncate-rate=', 'timeout-seconds=', 'scale=',
+                'keep-alive', 'gzip', 'closed-days', 'seed='])
+        for flag, value in flags:
+            if flag == '--port':
+                port = int(value)
+            elif flag == '--latency':
+                latency = value.split(":")
+                settings['min_latency'] = float(latency[0])
+                settings['max_latency'] = float(latency[-1])
+            elif flag in ('--drop-rate', '--timeout-rate', '--error-rate',
+                          '--truncate-rate', '--timeout-seconds'):
+                settings[flag[2:].replace('-', '_')] = float(value)
+            elif flag == '--scale':
+                settings['scale'] = int(value)
+            elif flag == '--keep-alive':
+                settings['keep_alive'] = True
+            elif flag == '--gzip':
+                settings['gzip'] = True
+            elif flag == '--closed-days':
+                settings['closed_days'] = True
+            elif flag == '--seed':
+                settings['seed'] = int(value)
+        if args:
+            raise Exception("Unexpected arguments: %s" % " ".join(args))
+    except Exception, e:
+        print str(e)
+        usage()
+    server = CRIISStubServer(('127.0.0.1', port), StubBehavior(**settings))
+    logging.info("Serving on %s", server.website)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info("Stats: %s", json.dumps(server.get_stats(),
+                                             sort_keys=True))
+        server.server_close()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,128 @@
+import datetime
+import os
+import re
+import recordOutput
+
+# Which days the San Francisco Assessor-Recorder records documents on. It is
+# closed on weekends and on the city's holidays, and a date query for those
+# days returns an empty report, which still costs its POST, redirect and
+# results page. A DatePlanner picks out such days from the weekends, the
+# holidays below and the days earlier runs found empty, so they can be
+# skipped or fetched with a cheap empty-page check.
+
+# Calendar days that were empty in at least this many years, and never had
+# records, are treated like holidays.
+LEARN_MIN_YEARS = 2
+# Output files up to this size are opened to see if they are empty. Larger
+# ones hold records.
+EMPTY_FILE_MAX_BYTES = 64
+CALENDAR_MODES = ('off', 'check', 'skip')
+OUTPUT_DAY_RE = re.compile(r"^(.+)_(\d{4})(\d{2})(\d{2})\.")
+
+""" The nth (from 1, or -1 for the last) given weekday of a month. """
+def nth_weekday(year, month, weekday, nth):
+    if nth > 0:
+        day = datetime.date(year, month, 1)
+        day += datetime.timedelta(days=(weekday - day.weekday()) % 7)
+        return day + datetime.timedelta(weeks=nth - 1)
+    if month == 12:
+        day = datetime.date(year, 12, 31)
+    else:
+        day = datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
+    return day - datetime.timedelta(days=(day.weekday() - weekday) % 7)
+
+""" A holiday on a weekend is observed on the Friday before or the Monday
+after. """
+def observed(day):
+    if day.weekday() == 5:
+        return day - datetime.timedelta(days=1)
+    if day.weekday() == 6:
+        return day + datetime.timedelta(days=1)
+    return day
+
+""" The days of a year the recorder's office is closed for a holiday, as a
+dict from date to the holiday's name. """
+def county_holidays(year):
+    thanksgiving = nth_weekday(year, 11, 3, 4)
+    holidays = {
+        observed(datetime.date(year, 1, 1)): "New Year's Day",
+        nth_weekday(year, 1, 0, 3): "Martin Luther King Jr. Day",
+        nth_weekday(year, 2, 0, 3): "Presidents' Day",
+        nth_weekday(year, 5, 0, -1): "Memorial Day",
+        observed(datetime.date(year, 7, 4)): "Independence Day",
+        nth_weekday(year, 9, 0, 1): "Labor Day",
+        nth_weekday(year, 10, 0, 2): "Columbus Day",
+        observed(datetime.date(year, 11, 11)): "Veterans Day",
+        thanksgiving: "Thanksgiving",
+        thanksgiving + datetime.timedelta(days=1): "Day after Thanksgiving",
+        observed(datetime.date(year, 12, 25)): "Christmas Day",
+    }
+    if year >= 2022:
+        holidays[observed(datetime.date(year, 6, 19))] = "Juneteenth"
+    # New Year's Day on a Saturday is observed in the year before.
+    next_new_year = observed(datetime.date(year + 1, 1, 1))
+    if next_new_year.year == year:
+        holidays[next_new_year] = "New Year's Day"
+    return holidays
+
+""" Whether an output file holds no records. A _BAD_READ tombstone or a
+_SKIPPED marker next to it means the day was not fetched, not that it was
+empty, and gives None. """
+def is_empty_output(path):
+    if os.path.exists(path + "_BAD_READ") or os.path.exists(path + "_SKIPPED"):
+        return None
+    if os.path.getsize(path) > EMPTY_FILE_MAX_BYTES:
+        return False
+    for record in recordOutput.iter_records(path):
+        return False
+    return True
+
+""" Learns which calendar days (month, day) are empty in the output files of
+a record type in output_path: those found empty in at least min_years years
+and never with records. Days already explained by the calendar (weekends and
+holidays) do not count. """
+def learn_empty_days(output_path, record_type_name, min_years=LEARN_MIN_YEARS):
+    calendar = DatePlanner()
+    empty_years = dict()
+    with_records = set()
+    if not os.path.isdir(output_path):
+        return set()
+    for filename in os.listdir(output_path):
+        match = OUTPUT_DAY_RE.match(filename)
+        if not match or match.group(1) != record_type_name:
+            continue
+        try:
+            recordOutput.format_for_path(filename)
+            day = datetime.date(*[int(group) for group in match.groups()[1:]])
+        except ValueError:
+            continue
+        empty = is_empty_output(os.path.join(output_path, filename))
+        if empty and calendar.reason(day):
+            continue
+        if empty:
+            empty_years.setdefault((day.month, day.day), set()).add(day.year)
+        elif empty is not None:
+            with_records.add((day.month, day.day))
+    return set(key for key, years in empty_years.iteritems()
+               if len(years) >= min_years and key not in with_records)
+
+""" Tells the days the recorder records documents on from those it most
+likely does not: weekends, county holidays, and the calendar days learned to
+be empty (see learn_empty_days). """
+class DatePlanner(object):
+    def __init__(self, learned_empty_days=()):
+        self.learned_empty_days = set(learned_empty_days)
+        self.holidays = dict()  # year -> county_holidays(year)
+
+    """ Why no documents are expected on day (a datetime.date), or None if
+    they are. """
+    def reason(self, day):
+        if day.weekday() >= 5:
+            return "weekend"
+        if day.year not in self.holidays:
+            self.holidays[day.year] = county_holidays(day.year)
+        if day in self.holidays[day.year]:
+            return self.holidays[day.year][day]
+        if (day.month, day.day) in self.learned_empty_days:
+            return "empty in earlier years"
+        return None
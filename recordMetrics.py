@@ -0,0 +1,224 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+# Counters and latency histograms of a scraper run, kept in one registry per
+# process (METRICS) and dumped to a JSON file and a Prometheus text format
+# file. Metrics are identified by a name and a set of labels, like
+# Prometheus series, e.g. criis_http_seconds{caller="CRIISCallerAPNQuery",
+# method="POST",phase="response"}.
+
+# Upper bounds of the histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0, 60.0)
+# Upper bounds of the buckets of per-day and per-query counts.
+COUNT_BUCKETS = (0, 1, 10, 25, 50, 100, 200, 500, 1000, 2500, 5000)
+METRICS_DUMP_INTERVAL = 60  # seconds between dumps of a MetricsDumper
+PROMETHEUS_PREFIX = "deedscraper_"
+
+def series_key(name, labels):
+    return (name, tuple(sorted(labels.iteritems())))
+
+""" Counts of observed values per bucket, with their sum and maximum. """
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts),
+                'count': self.count, 'sum': self.sum, 'max': self.max}
+
+    def merge_dict(self, other):
+        if list(other['buckets']) != list(self.buckets):
+            raise ValueError("Cannot merge histograms with other buckets")
+        self.counts = [mine + theirs for mine, theirs in zip(
+                self.counts, other['counts'])]
+        self.count += other['count']
+        self.sum += other['sum']
+        self.max = max(self.max, other['max'])
+
+""" Times the block it wraps into a histogram of a Metrics registry. """
+class MetricsTimer(object):
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.metrics.observe(self.name, time.time() - self.start,
+                             **self.labels)
+        return False
+
+""" Thread-safe registry of counters and histograms. """
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.started_at = time.time()
+
+    def inc(self, name, amount=1, **labels):
+        key = series_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = series_key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    """ Returns a context manager that observes the seconds spent in it. """
+    def timer(self, name, **labels):
+        return MetricsTimer(self, name, labels)
+
+    def counter_value(self, name, **labels):
+        with self.lock:
+            return self.counters.get(series_key(name, labels), 0)
+
+    def histogram(self, name, **labels):
+        with self.lock:
+            return self.histograms.get(series_key(name, labels))
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.histograms = dict()
+
+    """ Returns the metrics as a JSON-encodable dict. With reset set, the
+    registry starts over, so the next snapshot only holds what came after.
+    """
+    def snapshot(self, reset=False):
+        with self.lock:
+            snapshot = {
+                'time': time.time(),
+                'uptime_s': time.time() - self.started_at,
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(
+                        self.counters.iteritems())],
+                'histograms': [
+                    dict(histogram.to_dict(), name=name, labels=dict(labels))
+                    for (name, labels), histogram in sorted(
+                        self.histograms.iteritems())],
+            }
+            if reset:
+                self.counters = dict()
+                self.histograms = dict()
+        return snapshot
+
+    """ Adds the counts of a snapshot, e.g. one taken in a worker process.
+    """
+    def merge(self, snapshot):
+        with self.lock:
+            for counter in snapshot['counters']:
+                key = series_key(counter['name'], counter['labels'])
+                self.counters[key] = self.counters.get(key, 0) + \
+                    counter['value']
+            for histogram in snapshot['histograms']:
+                key = series_key(histogram['name'], histogram['labels'])
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(
+                        tuple(histogram['buckets']))
+                self.histograms[key].merge_dict(histogram)
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    """ Renders the metrics in the Prometheus text exposition format. """
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for counter in snapshot['counters']:
+            name = PROMETHEUS_PREFIX + counter['name']
+            if name not in typed:
+                lines.append("# TYPE %s counter" % name)
+                typed.add(name)
+            lines.append("%s%s %s" % (name, format_labels(counter['labels']),
+                                      format_value(counter['value'])))
+        for histogram in snapshot['histograms']:
+            name = PROMETHEUS_PREFIX + histogram['name']
+            if name not in typed:
+                lines.append("# TYPE %s histogram" % name)
+                typed.add(name)
+            cumulative = 0
+            bounds = [format_value(bound) for bound in histogram['buckets']]
+            for bound, count in zip(bounds + ["+Inf"], histogram['counts']):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (name, format_labels(
+                            histogram['labels'], le=bound), cumulative))
+            lines.append("%s_sum%s %s" % (name, format_labels(
+                        histogram['labels']), format_value(histogram['sum'])))
+            lines.append("%s_count%s %d" % (name, format_labels(
+                        histogram['labels']), histogram['count']))
+        return "\n".join(lines) + "\n"
+
+    """ Writes path.json and path.prom, each under a temp name first. """
+    def dump(self, path):
+        for extension, content in ((".json", self.to_json() + "\n"),
+                                   (".prom", self.to_prometheus())):
+            tmp_path = path + extension + ".tmp"
+            f = open(tmp_path, 'w')
+            try:
+                f.write(content)
+            finally:
+                f.close()
+            os.rename(tmp_path, path + extension)
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace(
+                '"', '\\"').replace("\n", "\\n"))
+        for name, value in sorted(labels.iteritems()))
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+""" Dumps a Metrics registry to path.json and path.prom every interval
+seconds in a background thread, and once more on stop(). """
+class MetricsDumper(object):
+    def __init__(self, metrics, path, interval=METRICS_DUMP_INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.dump(self.path)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.metrics.dump(self.path)
+
+METRICS = Metrics()
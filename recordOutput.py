@@ -0,0 +1,138 @@
+import bz2
+import gzip
+import json
+import os
+import recordScraperLib as rsl
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None  # xz output needs Python 3 or backports.lzma
+
+# Writers and readers of the per-day output files. 'json' is the original
+# format, one JSON list per file. The 'jsonl' formats hold one record per line
+# and can be read back a record at a time.
+
+OUTPUT_FORMATS = ('json', 'jsonl', 'jsonl.gz', 'jsonl.bz2')
+if lzma is not None:
+    OUTPUT_FORMATS += ('jsonl.xz',)
+DEFAULT_OUTPUT_FORMAT = 'json'
+
+""" File name extension (with the dot) of an output format. """
+def output_extension(output_format):
+    return "." + output_format
+
+""" Output format of a file, judging by its name. """
+def format_for_path(path):
+    for output_format in sorted(OUTPUT_FORMATS, key=len, reverse=True):
+        if path.endswith(output_extension(output_format)):
+            return output_format
+    raise ValueError("Unknown output format of %s" % path)
+
+""" Writes the records of one output file. Records go to a temp file next to
+path as they are written, and only commit() renames it into place, so a
+crash mid-write never leaves a truncated file under the final name. As a
+context manager it commits on success and aborts on an exception. """
+class RecordWriter(object):
+    def __init__(self, path, output_format=DEFAULT_OUTPUT_FORMAT):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format %s" % output_format)
+        self.path = path
+        self.output_format = output_format
+        self.tmp_path = path + ".tmp"
+        self.count = 0
+        self.raw = open(self.tmp_path, 'wb')
+        self.out = self.raw
+        self.compressor = None
+        if output_format.endswith('.gz'):
+            self.out = gzip.GzipFile(os.path.basename(path)[:-3], 'wb', 9,
+                                     self.raw)
+        elif output_format.endswith('.bz2'):
+            self.compressor = bz2.BZ2Compressor()
+        elif output_format.endswith('.xz'):
+            self.compressor = lzma.LZMACompressor()
+        if output_format == 'json':
+            self.write_bytes("[")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+    def write_bytes(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.out.write(data)
+
+    def write(self, record):
+        line = rsl.encode_record(record)
+        if self.output_format == 'json':
+            # Same separators as json.dumps of the whole list.
+            if self.count:
+                line = ", " + line
+        else:
+            line += "\n"
+        self.write_bytes(line)
+        self.count += 1
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def commit(self):
+        if self.output_format == 'json':
+            self.write_bytes("]")
+        if self.compressor is not None:
+            self.raw.write(self.compressor.flush())
+        if self.out is not self.raw:
+            self.out.close()  # Leaves self.raw open.
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        self.raw.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+""" Opens an output file for reading, decompressing it if needed. """
+def open_output_file(path):
+    output_format = format_for_path(path)
+    if output_format.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif output_format.endswith('.bz2'):
+        return bz2.BZ2File(path, 'r')
+    elif output_format.endswith('.xz'):
+        return lzma.LZMAFile(path, 'r')
+    return open(path, 'r')
+
+""" Yields the records of an output file, as dicts or, with compact set, as
+rsl.Records interned by interner. Without an interner, each call interns
+with one of its own; pass the same rsl.StringInterner to the calls for the
+files of one corpus to share their strings, and drop it with the corpus.
+JSON Lines files are read a record at a time; 'json' files have to be
+loaded whole. """
+def iter_records(path, compact=False, interner=None):
+    if compact and interner is None:
+        interner = rsl.StringInterner()
+    f = open_output_file(path)
+    try:
+        if format_for_path(path) == 'json':
+            records = json.load(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for record in records:
+            if compact:
+                record = rsl.Record.from_dict(record, interner)
+            yield record
+    finally:
+        f.close()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import sys
+import recordOutput
+from apnIndex import APN_RE
+from recordStore import normalize_apn, date_to_day
+
+# Rollup tables of transaction volume, kept in a SQLite file next to the
+# corpus and updated as new day files land, so dashboards read counts
+# instead of rescanning every output file:
+#
+#   transfers  documents per (block, month, doctype)
+#   resales    sales of a lot per (block, month, years since its last sale),
+#              with the days between the two sales summed up
+#
+# ALL ('*') stands for every block or every doctype, so a city-wide count is
+# one row as well. Updating folds in only the day files that are new or
+# changed since the last update (by size and mtime), and takes out the
+# documents of files that were removed. Like recordStore, a document is
+# replaced as a whole whenever it is seen again, so a document found in two
+# files (e.g. under two record types) counts once, for as long as either
+# file lists it.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    block TEXT NOT NULL,
+    month TEXT NOT NULL,
+    doctype TEXT NOT NULL,
+    documents INTEGER NOT NULL,
+    PRIMARY KEY (block, month, doctype)
+);
+CREATE TABLE IF NOT EXISTS resales (
+    block TEXT NOT NULL,
+    month TEXT NOT NULL,
+    years INTEGER NOT NULL,
+    sales INTEGER NOT NULL,
+    total_days INTEGER NOT NULL,
+    PRIMARY KEY (block, month, years)
+);
+CREATE TABLE IF NOT EXISTS rollup_documents (
+    id TEXT PRIMARY KEY,
+    day TEXT NOT NULL,
+    doctype TEXT NOT NULL,
+    apn TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS document_files (
+    id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (id, path)
+);
+CREATE INDEX IF NOT EXISTS document_files_path ON document_files (path);
+CREATE TABLE IF NOT EXISTS sales (
+    apn TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    PRIMARY KEY (apn, document_id)
+);
+CREATE TABLE IF NOT EXISTS rolled_up_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL
+);
+"""
+
+ALL = '*'
+# Document types that transfer a lot, whose filings count as its sales.
+SALE_DOCTYPES = frozenset(('DEED',))
+# Lower bounds, in years, of the buckets of the time between two sales.
+RESALE_YEARS = (0, 1, 2, 5, 10)
+DAYS_PER_YEAR = 365.25
+
+""" The block of a block-lot number, or None if it is not one. """
+def apn_block(apn):
+    apn = normalize_apn(apn)
+    if not APN_RE.match(apn):
+        return None
+    return apn.split("-", 1)[0]
+
+def day_to_ordinal(day):
+    return datetime.date(int(day[0:4]), int(day[4:6]),
+                         int(day[6:8])).toordinal()
+
+""" The RESALE_YEARS bucket of a time between sales, in days. """
+def resale_years(days):
+    years = days / DAYS_PER_YEAR
+    bucket = RESALE_YEARS[0]
+    for lower in RESALE_YEARS:
+        if years >= lower:
+            bucket = lower
+    return bucket
+
+""" Parses a YYYYMM:YYYYMM month range, or None for all months. """
+def parse_months(value):
+    if value is None:
+        return ("000000", "999999")
+    if len(value) != 13 or value[6] != ':':
+        raise ValueError("Months must be YYYYMM:YYYYMM, not %s" % value)
+    return (value[0:6], value[7:13])
+
+class RecordRollups(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    """ Folds the output files of output_path into the rollups: files that
+    are new or changed since the last update, each in its own transaction,
+    and takes out the documents of files no longer there. Tombstones,
+    journals and temp files are left alone. Returns (files folded, files
+    removed). """
+    def update(self, output_path, force=False):
+        paths = []
+        for filename in sorted(os.listdir(output_path)):
+            try:
+                recordOutput.format_for_path(filename)
+            except ValueError:
+                continue
+            paths.append(os.path.join(output_path, filename))
+        folded = 0
+        for path in paths:
+            with self.conn:
+                if self.fold_file(path, force):
+                    folded += 1
+        removed = 0
+        directory = os.path.dirname(os.path.join(output_path, "x"))
+        known_paths = [row[0] for row in self.conn.execute(
+                "SELECT path FROM rolled_up_files")]
+        for path in sorted(set(known_paths) - set(paths)):
+            if os.path.dirname(path) != directory:
+                continue  # a file of another output directory
+            with self.conn:
+                self.replace_documents(path, [])
+                self.conn.execute(
+                    "DELETE FROM rolled_up_files WHERE path = ?", (path,))
+            logging.info("Took out %s", path)
+            removed += 1
+        return (folded, removed)
+
+    """ Folds one output file in unless it was folded before with the same
+    size and mtime (or force is set), without committing. Returns whether it
+    was folded. """
+    def fold_file(self, path, force=False):
+        stat = os.stat(path)
+        if not force:
+            row = self.conn.execute(
+                "SELECT size, mtime FROM rolled_up_files WHERE path = ?",
+                (path,)).fetchone()
+            if row is not None and row[0] == stat.st_size and \
+                    row[1] == stat.st_mtime:
+                return False
+        count = self.replace_documents(path,
+                                       recordOutput.iter_records(path))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO rolled_up_files (path, size, mtime) "
+            "VALUES (?, ?, ?)", (path, stat.st_size, stat.st_mtime))
+        logging.info("Folded %d records from %s", count, path)
+        return True
+
+    """ Makes records the documents of path. Earlier versions of records,
+and the documents path held before that no other file holds, are taken out
+of the rollups, and records are added. Returns the number of records. """
+    def replace_documents(self, path, records):
+        new_documents = dict()
+        for record in records:
+            new_documents[record['id']] = (
+                date_to_day(record['date']), record['doctype'] or "",
+                sorted(set(normalize_apn(apn)
+                           for apn in record.get('apn') or [] if apn)))
+        dropped_ids = set(row[0] for row in self.conn.execute(
+                "SELECT id FROM document_files WHERE path = ?", (path,)))
+        self.conn.execute("DELETE FROM document_files WHERE path = ?",
+                          (path,))
+        self.conn.executemany(
+            "INSERT INTO document_files (id, path) VALUES (?, ?)",
+            [(document_id, path) for document_id in new_documents])
+        dropped_ids = set(
+            document_id for document_id in dropped_ids - set(new_documents)
+            if self.conn.execute(
+                "SELECT 1 FROM document_files WHERE id = ?",
+                (document_id,)).fetchone() is None)
+        old_documents = dict()
+        for document_id in dropped_ids | set(new_documents):
+            row = self.conn.execute(
+                "SELECT day, doctype, apn FROM rollup_documents "
+                "WHERE id = ?", (document_id,)).fetchone()
+            if row is not None:
+                old_documents[document_id] = (row[0], row[1],
+                                              json.loads(row[2]))
+        sold_apns = set()
+        for document in old_documents.values() + new_documents.values():
+            if document[1] in SALE_DOCTYPES:
+                sold_apns.update(document[2])
+
+        transfer_deltas = dict()
+        resale_deltas = dict()
+        self.count_resales(sold_apns, resale_deltas, -1)
+        for document_id, document in old_documents.iteritems():
+            self.count_transfers(document, transfer_deltas, -1)
+            self.conn.executemany(
+                "DELETE FROM sales WHERE apn = ? AND document_id = ?",
+                [(apn, document_id) for apn in document[2]])
+        self.conn.executemany(
+            "DELETE FROM rollup_documents WHERE id = ?",
+            [(document_id,) for document_id in old_documents])
+        for document_id, document in new_documents.iteritems():
+            self.count_transfers(document, transfer_deltas, 1)
+            if document[1] in SALE_DOCTYPES and document[0]:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO sales (apn, document_id, day) "
+                    "VALUES (?, ?, ?)",
+                    [(apn, document_id, document[0]) for apn in document[2]])
+        self.conn.executemany(
+            "INSERT INTO rollup_documents (id, day, doctype, apn) "
+            "VALUES (?, ?, ?, ?)",
+            [(document_id, document[0], document[1],
+              json.dumps(document[2]))
+             for document_id, document in new_documents.iteritems()])
+        self.count_resales(sold_apns, resale_deltas, 1)
+        self.apply_transfers(transfer_deltas)
+        self.apply_resales(resale_deltas)
+        return len(new_documents)
+
+    """ Adds sign to the transfers of a document: one per block it covers
+    and ALL, under its doctype and ALL. """
+    def count_transfers(self, document, deltas, sign):
+        day, doctype, apns = document
+        if not day:
+            return
+        blocks = set(block for block in (apn_block(apn) for apn in apns)
+                     if block is not None)
+        blocks.add(ALL)
+        for block in blocks:
+            for key_doctype in (doctype, ALL):
+                key = (block, day[0:6], key_doctype)
+                deltas[key] = deltas.get(key, 0) + sign
+
+    """ Adds sign to the resales of the lots in apns, as the sales table has
+    them now. A lot's sales on one day count once, and each sale after the
+    first counts in the month it was filed, under the years since the one
+    before. """
+    def count_resales(self, apns, deltas, sign):
+        for apn in apns:
+            block = apn_block(apn)
+            if block is None:
+                continue
+            days = [row[0] for row in self.conn.execute(
+                    "SELECT DISTINCT day FROM sales WHERE apn = ? "
+                    "ORDER BY day", (apn,))]
+            for previous, day in zip(days, days[1:]):
+                interval = day_to_ordinal(day) - day_to_ordinal(previous)
+                for key_block in (block, ALL):
+                    key = (key_block, day[0:6], resale_years(interval))
+                    sales, total_days = deltas.get(key, (0, 0))
+                    deltas[key] = (sales + sign, total_days + sign * interval)
+
+    def apply_transfers(self, deltas):
+        changed = [(documents, block, month, doctype)
+                   for (block, month, doctype), documents in deltas.iteritems()
+                   if documents]
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO transfers (block, month, doctype, "
+            "documents) VALUES (?, ?, ?, 0)",
+            [key[1:] for key in changed])
+        self.conn.executemany(
+            "UPDATE transfers SET documents = documents + ? "
+            "WHERE block = ? AND month = ? AND doctype = ?", changed)
+        self.conn.execute("DELETE FROM transfers WHERE documents = 0")
+
+    def apply_resales(self, deltas):
+        changed = [(sales, total_days, block, month, years)
+                   for (block, month, years), (sales, total_days)
+                   in deltas.iteritems() if sales or total_days]
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO resales (block, month, years, sales, "
+            "total_days) VALUES (?, ?, ?, 0, 0)",
+            [key[2:] for key in changed])
+        self.conn.executemany(
+            "UPDATE resales SET sales = sales + ?, "
+            "total_days = total_days + ? "
+            "WHERE block = ? AND month = ? AND years = ?", changed)
+        self.conn.execute("DELETE FROM resales WHERE sales = 0")
+
+    """ Documents per month, for a block (or ALL) and doctype (or ALL),
+    between two YYYYMM months. Returns [(month, documents)] in month order.
+    """
+    def transfers(self, block=ALL, doctype=ALL, start_month="000000",
+                  end_month="999999"):
+        return self.conn.execute(
+            "SELECT month, documents FROM transfers WHERE block = ? AND "
+            "doctype = ? AND month BETWEEN ? AND ? ORDER BY month",
+            (block, doctype, start_month, end_month)).fetchall()
+
+    """ Resales per month, for a block (or ALL), between two YYYYMM months.
+    Returns [(month, {years: (sales, total_days)})] in month order. """
+    def resales(self, block=ALL, start_month="000000", end_month="999999"):
+        months = []
+        for month, years, sales, total_days in self.conn.execute(
+                "SELECT month, years, sales, total_days FROM resales "
+                "WHERE block = ? AND month BETWEEN ? AND ? "
+                "ORDER BY month, years",
+                (block, start_month, end_month)):
+            if not months or months[-1][0] != month:
+                months.append((month, dict()))
+            months[-1][1][years] = (sales, total_days)
+        return months
+
+def usage():
+    print
+    print 'Usage: ./recordRollups.py update ROLLUPS data_path'
+    print '       ./recordRollups.py transfers ROLLUPS [BLOCK [DOCTYPE [YYYYMM:YYYYMM]]]'
+    print '       ./recordRollups.py resales ROLLUPS [BLOCK [YYYYMM:YYYYMM]]'
+    print
+    print """Folds the output files of recordScraper in data_path that are new or changed into the rollup tables in the SQLite file ROLLUPS, or prints the documents per month (of a block and doctype) or the resales per month (of a block) from them, one JSON object per line. BLOCK and DOCTYPE default to %s, every block or doctype.""" % ALL
+    sys.exit(2)
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    if len(argv) < 3:
+        usage()
+    command, rollups_path = argv[1:3]
+    args = argv[3:]
+    try:
+        if command == 'update' and len(args) == 1:
+            pass
+        elif command == 'transfers' and len(args) <= 3:
+            months = parse_months((args[2:3] or [None])[0])
+        elif command == 'resales' and len(args) <= 2:
+            months = parse_months((args[1:2] or [None])[0])
+        else:
+            usage()
+    except ValueError, e:
+        print str(e)
+        usage()
+    rollups = RecordRollups(rollups_path)
+    try:
+        if command == 'update':
+            folded, removed = rollups.update(args[0])
+            logging.info("Folded %d files, took out %d.", folded, removed)
+        elif command == 'transfers':
+            block = (args[0:1] or [ALL])[0]
+            doctype = (args[1:2] or [ALL])[0]
+            for month, documents in rollups.transfers(block, doctype,
+                                                      *months):
+                print json.dumps({'block': block, 'doctype': doctype,
+                                  'month': month, 'documents': documents},
+                                 sort_keys=True)
+        elif command == 'resales':
+            block = (args[0:1] or [ALL])[0]
+            for month, buckets in rollups.resales(block, *months):
+                sales = sum(bucket[0] for bucket in buckets.values())
+                total_days = sum(bucket[1] for bucket in buckets.values())
+                print json.dumps({
+                        'block': block, 'month': month, 'sales': sales,
+                        'mean_days': float(total_days) / sales,
+                        'by_years': dict((str(years), bucket[0]) for
+                                         years, bucket in buckets.items())},
+                                 sort_keys=True)
+    finally:
+        rollups.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,36 +1,253 @@
 #!/usr/bin/env python
+import collections
 import csv
 from datetime import datetime 
 import pprint
 import sys
 import recordScraperLib as rs
+import recordScraperAsync
+import recordOutput
+import recordCalendar
+import recordMetrics
+from recordMetrics import METRICS
 import logging
 import datetime
+import getopt
 import json
+import multiprocessing
+import os
+
+# A busy day fills about 9 report pages. Larger reports of multi-day queries
+# are split, in case CyberQuery truncates long reports.
+MAX_REPORT_PAGES = 20
+# Times a day is fetched before the run gives up on it and leaves its
+# tombstone for --repair.
+DAY_ATTEMPTS = 3
+# Documents looked up by this process, shared by the record types of a run.
+# Set up by configure_callers.
+RUN_DOCUMENTS = None
+
+LONG_OPTIONS = [
+    'apn-concurrency=',
+    'async',
+    'max-rate=',
+    'archive=',
+    'archive-max-mb=',
+    'archive-max-age-days=',
+    'replay',
+    'repair',
+    'processes=',
+    'total-rate=',
+    'parser=',
+    'format=',
+    'known=',
+    'known-blank-ttl-days=',
+    'force',
+    'window-days=',
+    'max-report-pages=',
+    'website=',
+    'metrics=',
+    'metrics-interval=',
+    'parse-processes=',
+    'day-attempts=',
+    'calendar=',
+]
 
 def usage():
     print
-    print 'Usage: ./recordScraper YYYYMMDD:YYYYMMDD RECORDTYPE data_path'
+    print 'Usage: ./recordScraper [options] YYYYMMDD:YYYYMMDD RECORDTYPE[,RECORDTYPE...] data_path'
+    print
+    print """Fetches records between the two specified dates and writes output files containing details of the records into the directory specified by data_path. Output files are JSON-encoded deed data and are chunked per day and record type. With several record types, each day's queries go out back to back and a document listed under more than one type is looked up once."""
     print
-    print """Fetches records between the two specified dates and writes output files containing details of the records into the directory specified by data_path. Output files are JSON-encoded deed data and are chunked per day."""
+    print 'Options:'
+    print '  --apn-concurrency=N   APN detail lookups in flight (default %d)' % (
+        rs.APN_FETCH_CONCURRENCY)
+    print '  --async               Multiplex lookups over keep-alive connections'
+    print '                        on one event loop instead of threads'
+    print '  --max-rate=R          Ceiling for the adaptive request rate, in'
+    print '                        requests per second (default %.0f)' % (
+        rs.CRIISCaller.rate_controller.max_rate)
+    print '  --archive=DIR         Keep the raw result pages in DIR and reuse them'
+    print '  --archive-max-mb=N    Size cap of the archive (default 2048)'
+    print '  --archive-max-age-days=N'
+    print '                        Refetch archived pages older than N days'
+    print '  --replay              Rebuild the output from the archive only,'
+    print '                        without contacting criis.com'
+    print '  --repair              Only fetch days in the range that have no'
+    print '                        output file or a _BAD_READ tombstone'
+    print '  --processes=N         Spread the days over N worker processes'
+    print '  --total-rate=R        Requests per second shared by all worker'
+    print '                        processes (default: the --max-rate value)'
+    print '  --parser=ENGINE       Result page parser, one of %s (default %s)' % (
+        ', '.join(rs.PARSER_ENGINES), rs.PARSER_ENGINE)
+    print '  --format=FORMAT       Output format, one of %s' % (
+        ', '.join(recordOutput.OUTPUT_FORMATS))
+    print '                        (default %s)' % (
+        recordOutput.DEFAULT_OUTPUT_FORMAT)
+    print '  --known=FILE          Remember looked-up documents in FILE and skip'
+    print '                        their APN lookups on later runs'
+    print '  --known-blank-ttl-days=N'
+    print '                        Look up known documents without reel/image'
+    print '                        again after N days (default %d)' % (
+        rs.KNOWN_BLANK_TTL_DAYS)
+    print '  --force               Look up every document again'
+    print '  --window-days=N       Query up to N consecutive days at once'
+    print '                        (default 1)'
+    print '  --max-report-pages=N  Split a multi-day query whose report has'
+    print '                        more than N pages (default %d)' % (
+        MAX_REPORT_PAGES)
+    print '  --website=HOST[:PORT] Query this server instead of %s,' % (
+        rs.CRIISCaller.website)
+    print '                        e.g. a criisStubServer.py'
+    print '  --metrics=PATH        Dump counters and latency histograms to'
+    print '                        PATH.json and PATH.prom (Prometheus text'
+    print '                        format) while running'
+    print '  --metrics-interval=S  Seconds between metrics dumps'
+    print '                        (default %d)' % (
+        recordMetrics.METRICS_DUMP_INTERVAL)
+    print '  --parse-processes=N   Parse result pages in N worker processes,'
+    print '                        overlapping with the fetching (default 0:'
+    print '                        parse in the fetching threads)'
+    print '  --day-attempts=N      Fetch a failing day up to N times, retrying'
+    print '                        it after the rest of the range (default %d)' % (
+        DAY_ATTEMPTS)
+    print '  --calendar=MODE       What to do with weekends, county holidays and'
+    print '                        days empty in earlier years: fetch them as'
+    print '                        usual (off, the default), fetch them with a'
+    print '                        cheap check for an empty report (check), or'
+    print '                        write them as empty days without a query (skip)'
     sys.exit(2)
 
+""" The options of a run with no flags given. """
+def default_options():
+    return {
+        'apn_concurrency': rs.APN_FETCH_CONCURRENCY,
+        'async': False,
+        'max_rate': rs.CRIISCaller.rate_controller.max_rate,
+        'archive': None,
+        'archive_max_mb': 2048,
+        'archive_max_age_days': None,
+        'replay': False,
+        'repair': False,
+        'processes': 1,
+        'total_rate': None,
+        'parser': rs.PARSER_ENGINE,
+        'format': recordOutput.DEFAULT_OUTPUT_FORMAT,
+        'known': None,
+        'known_blank_ttl_days': rs.KNOWN_BLANK_TTL_DAYS,
+        'force': False,
+        'window_days': 1,
+        'max_report_pages': MAX_REPORT_PAGES,
+        'website': rs.CRIISCaller.website,
+        'metrics': None,
+        'metrics_interval': recordMetrics.METRICS_DUMP_INTERVAL,
+        'parse_processes': 0,
+        'day_attempts': DAY_ATTEMPTS,
+        'calendar': 'off',
+        'check_days': frozenset(),  # (date, record type) pairs, see plan_days
+    }
+
 def parse_commandline_arguments(argv):
+    options = default_options()
     try:
+        flags, args = getopt.gnu_getopt(argv[1:], '', LONG_OPTIONS)
+        argv = argv[0:1] + args
+        for flag, value in flags:
+            if flag == '--apn-concurrency':
+                options['apn_concurrency'] = int(value)
+                if options['apn_concurrency'] < 1:
+                    raise Exception("APN concurrency must be at least 1")
+            elif flag == '--async':
+                options['async'] = True
+            elif flag == '--max-rate':
+                options['max_rate'] = float(value)
+                if options['max_rate'] <= 0:
+                    raise Exception("Max rate must be positive")
+            elif flag == '--archive':
+                options['archive'] = value
+            elif flag == '--archive-max-mb':
+                options['archive_max_mb'] = int(value)
+            elif flag == '--archive-max-age-days':
+                options['archive_max_age_days'] = float(value)
+            elif flag == '--replay':
+                options['replay'] = True
+            elif flag == '--repair':
+                options['repair'] = True
+            elif flag == '--processes':
+                options['processes'] = int(value)
+                if options['processes'] < 1:
+                    raise Exception("Need at least one process")
+            elif flag == '--total-rate':
+                options['total_rate'] = float(value)
+                if options['total_rate'] <= 0:
+                    raise Exception("Total rate must be positive")
+            elif flag == '--parser':
+                if value not in rs.PARSER_ENGINES:
+                    raise Exception("Unknown parser engine %s" % value)
+                options['parser'] = value
+            elif flag == '--format':
+                if value not in recordOutput.OUTPUT_FORMATS:
+                    raise Exception("Unknown output format %s" % value)
+                options['format'] = value
+            elif flag == '--known':
+                options['known'] = value
+            elif flag == '--known-blank-ttl-days':
+                options['known_blank_ttl_days'] = float(value)
+            elif flag == '--force':
+                options['force'] = True
+            elif flag == '--window-days':
+                options['window_days'] = int(value)
+                if options['window_days'] < 1:
+                    raise Exception("Windows need at least one day")
+            elif flag == '--max-report-pages':
+                options['max_report_pages'] = int(value)
+            elif flag == '--website':
+                options['website'] = value
+            elif flag == '--metrics':
+                options['metrics'] = value
+            elif flag == '--metrics-interval':
+                options['metrics_interval'] = float(value)
+            elif flag == '--parse-processes':
+                options['parse_processes'] = int(value)
+                if options['parse_processes'] < 0:
+                    raise Exception("Parse processes cannot be negative")
+            elif flag == '--day-attempts':
+                options['day_attempts'] = int(value)
+                if options['day_attempts'] < 1:
+                    raise Exception("Need at least one attempt per day")
+            elif flag == '--calendar':
+                if value not in recordCalendar.CALENDAR_MODES:
+                    raise Exception("Unknown calendar mode %s" % value)
+                options['calendar'] = value
+        if options['replay'] and not options['archive']:
+            raise Exception("--replay needs an --archive to replay from")
+        # Async lookups parse on their event loop, and the scheduler's
+        # workers are daemonic and cannot start processes of their own.
+        if options['parse_processes'] and (options['async'] or
+                                           options['processes'] > 1):
+            raise Exception("--parse-processes cannot be combined with "
+                            "--async or --processes")
+
         if len(argv) < 4:
             usage()
 
         if len(argv[1]) != 17 or argv[1][8] != ':':
-            raise Exception("Incorrect date format:", arvg[1])
+            raise Exception("Incorrect date format:", argv[1])
 
-        if not rs.RECORD_TYPES.get(argv[2]):
-            print "Invalid record type, valid types are:"
-            pprint.pprint(rs.RECORD_TYPES.keys())
-            raise Exception()
+        record_type_names = []
+        for record_type_name in argv[2].split(","):
+            if not rs.RECORD_TYPES.get(record_type_name):
+                print "Invalid record type, valid types are:"
+                pprint.pprint(rs.RECORD_TYPES.keys())
+                raise Exception()
+            if record_type_name not in record_type_names:
+                record_type_names.append(record_type_name)
     except Exception, e:
         print str(e)
         usage()
-    return (argv[1][0:8], argv[1][9:18], argv[2], argv[3])
+    if options['total_rate'] is None:
+        options['total_rate'] = options['max_rate']
+    return (argv[1][0:8], argv[1][9:18], record_type_names, argv[3], options)
 
 """ Given two YYYYMMDD formatted date strings, return a list containing
 all days in this range (including end date) in MMDDYYYY format."""
@@ -52,50 +269,425 @@ def expand_dates_to_MMDDYYYY_list(start_date_str, end_date_str):
         cur_date += datetime.timedelta(days=1)
     return mmddyyyy_list
 
-def convert_mmddyyyy_to_output_filename(output_path, prefix, mmddyyyy_str):
+def convert_mmddyyyy_to_output_filename(output_path, prefix, mmddyyyy_str,
+                                        extension=".json"):
     year_str = mmddyyyy_str[4:8]
     day_str = mmddyyyy_str[2:4]
     month_str = mmddyyyy_str[0:2]
-    return output_path + ("/%s_%s%s%s.json" % (
-            prefix, year_str, month_str, day_str))
+    return output_path + ("/%s_%s%s%s%s" % (
+            prefix, year_str, month_str, day_str, extension))
+
+""" Converts MMDDYYYY to the MM/DD/YYYY format of record dates. """
+def convert_mmddyyyy_to_record_date(mmddyyyy_str):
+    return "%s/%s/%s" % (mmddyyyy_str[0:2], mmddyyyy_str[2:4],
+                         mmddyyyy_str[4:8])
+
+def convert_mmddyyyy_to_date(mmddyyyy_str):
+    return datetime.date(int(mmddyyyy_str[4:8]), int(mmddyyyy_str[0:2]),
+                         int(mmddyyyy_str[2:4]))
+
+""" Splits a list of MMDDYYYY days into windows of consecutive days, each at
+most window_days long. """
+def split_into_windows(date_list, window_days):
+    windows = []
+    for cur_date in date_list:
+        if windows and len(windows[-1]) < window_days and \
+                convert_mmddyyyy_to_date(cur_date) - convert_mmddyyyy_to_date(
+                    windows[-1][-1]) == datetime.timedelta(days=1):
+            windows[-1].append(cur_date)
+        else:
+            windows.append([cur_date])
+    return windows
+
+""" Returns the dates of date_list that have no output file yet, whose last
+fetch left a _BAD_READ tombstone, or that were skipped without a query
+(marked _SKIPPED). """
+def find_days_to_repair(date_list, output_path, record_type_name,
+                        extension=".json"):
+    missing = []
+    for cur_date in date_list:
+        output_filename = convert_mmddyyyy_to_output_filename(
+            output_path, record_type_name, cur_date, extension)
+        if not os.path.exists(output_filename) or \
+                os.path.exists(output_filename + "_BAD_READ") or \
+                os.path.exists(output_filename + "_SKIPPED"):
+            missing.append(cur_date)
+    return missing
+
+""" Fetches one day and writes its output file in options['format'].
+Raises rs.DSException if the day could not be fetched. """
+def fetch_and_write_day(cur_date, record_type_name, output_path, options):
+    return fetch_and_write_window([cur_date], record_type_name, output_path,
+                                  options)
+
+""" Fetches a window of consecutive days with a single date query and writes
+each day's output file in options['format'], bucketing the records by their
+filing date. Completed documents are journaled next to the output files until
+the days are written, so a crashed run resumes mid-window. With
+options['known'] set, documents looked up by earlier runs are taken from that
+KnownDocuments file, and documents looked up earlier in this process (for
+another record type) are taken from RUN_DOCUMENTS. Raises rs.DSException
+if the window could not be
+fetched, and rs.ReportTooLargeException if a multi-day window's report has
+more than options['max_report_pages'] pages. """
+def fetch_and_write_window(window, record_type_name, output_path, options):
+    record_type_num = rs.RECORD_TYPES[record_type_name]
+    extension = recordOutput.output_extension(options['format'])
+    output_filenames = dict()
+    journals = dict()
+    for cur_date in window:
+        output_filenames[cur_date] = convert_mmddyyyy_to_output_filename(
+            output_path, record_type_name, cur_date, extension)
+        journals[convert_mmddyyyy_to_record_date(cur_date)] = \
+            rs.RecordJournal(output_filenames[cur_date] + ".journal")
+    journal = rs.MultiDayJournal(
+        journals, journals[convert_mmddyyyy_to_record_date(window[0])])
+    max_report_pages = None
+    if len(window) > 1:
+        max_report_pages = options['max_report_pages']
+    known_file = None
+    if options['known']:
+        known_file = rs.KnownDocuments(options['known'],
+                                       options['known_blank_ttl_days'],
+                                       options['force'])
+    known = rs.DocumentSets([RUN_DOCUMENTS, known_file])
+    # Only a window of days expected to be empty is worth checking.
+    check_empty = all((cur_date, record_type_name) in options['check_days']
+                      for cur_date in window)
+    try:
+        if options['async']:
+            records = recordScraperAsync.fetch_records_for_daterange(
+                window[0], window[-1], record_type_num,
+                pool_size=options['apn_concurrency'], journal=journal,
+                known=known, max_report_pages=max_report_pages,
+                check_empty=check_empty)
+        else:
+            records = rs.fetch_records_for_daterange(
+                window[0], window[-1], record_type_num,
+                apn_concurrency=options['apn_concurrency'], journal=journal,
+                known=known, max_report_pages=max_report_pages,
+                check_empty=check_empty)
+    finally:
+        if known_file is not None:
+            known_file.close()
+
+    records_by_day = dict((cur_date, []) for cur_date in window)
+    for record in records:
+        day = record['date'][0:2] + record['date'][3:5] + record['date'][6:10]
+        if len(window) == 1:
+            day = window[0]
+        if day not in records_by_day:
+            logging.warning("Dropping %s, filed %s outside of %s to %s",
+                            record['id'], record['date'], window[0],
+                            window[-1])
+            continue
+        records_by_day[day].append(record)
+    for cur_date in window:
+        output_filename = output_filenames[cur_date]
+        with recordOutput.RecordWriter(output_filename,
+                                       options['format']) as writer:
+            writer.write_all(records_by_day[cur_date])
+        METRICS.inc('days_written_total')
+        METRICS.observe('day_records', len(records_by_day[cur_date]),
+                        buckets=recordMetrics.COUNT_BUCKETS)
+        journals[convert_mmddyyyy_to_record_date(cur_date)].remove()
+        for suffix in ("_BAD_READ", "_SKIPPED"):
+            if os.path.exists(output_filename + suffix):
+                os.remove(output_filename + suffix)
+    return records
+
+""" Fetches a window, halving it (recursively) while its report is too
+large. Days that could not be fetched get a tombstone, except in replay mode
+where there is nothing to tombstone. Returns the list of failed days. """
+def fetch_window(window, record_type_name, output_path, options):
+    try:
+        with METRICS.timer('window_seconds'):
+            fetch_and_write_window(window, record_type_name, output_path,
+                                   options)
+        return []
+    except rs.ReportTooLargeException, e:
+        half = (len(window) + 1) / 2
+        logging.info("Splitting %s to %s: %s", window[0], window[-1], str(e))
+        return fetch_window(window[:half], record_type_name, output_path,
+                            options) + \
+            fetch_window(window[half:], record_type_name, output_path,
+                         options)
+    except rs.DSException:
+        METRICS.inc('days_failed_total', len(window))
+        for cur_date in window:
+            if options['replay']:
+                logging.error("Archive cannot replay %s, skipping.", cur_date)
+            else:
+                write_tombstone(output_path, record_type_name, cur_date,
+                                recordOutput.output_extension(
+                                    options['format']))
+        return list(window)
+
+""" Picks out the pending (date, record type) pairs whose days the recorder
+most likely did not record on (see recordCalendar.DatePlanner). With
+options['calendar'] at 'skip' they get an empty output file marked as
+skipped and are dropped;
+at 'check' they are noted in options['check_days'], to be fetched with an
+empty-page check. Returns the pairs left to fetch. """
+def plan_days(pending, output_path, options):
+    if options['calendar'] == 'off':
+        return pending
+    planners = dict()
+    fetch, expected_empty = [], []
+    for cur_date, record_type_name in pending:
+        if record_type_name not in planners:
+            planners[record_type_name] = recordCalendar.DatePlanner(
+                recordCalendar.learn_empty_days(output_path,
+                                                record_type_name))
+        if planners[record_type_name].reason(
+                convert_mmddyyyy_to_date(cur_date)) is None:
+            fetch.append((cur_date, record_type_name))
+        else:
+            expected_empty.append((cur_date, record_type_name))
+    if options['calendar'] == 'check':
+        logging.info("Checking %d days expected to be empty",
+                     len(expected_empty))
+        options['check_days'] = frozenset(expected_empty)
+        return pending
+    logging.info("Skipping %d days expected to be empty: %s",
+                 len(expected_empty),
+                 ",".join(format_pair(pair) for pair in expected_empty))
+    for cur_date, record_type_name in expected_empty:
+        write_skipped_day(output_path, record_type_name, cur_date, options)
+    return fetch
+
+""" Writes the empty output file of a day skipped by plan_days, with a
+_SKIPPED file next to it: the day was never queried, so --repair fetches it
+again and learn_empty_days does not take it for an empty day. """
+def write_skipped_day(output_path, record_type_name, cur_date, options):
+    output_filename = convert_mmddyyyy_to_output_filename(
+        output_path, record_type_name, cur_date,
+        recordOutput.output_extension(options['format']))
+    if os.path.exists(output_filename) and \
+            not os.path.exists(output_filename + "_SKIPPED") and \
+            not os.path.exists(output_filename + "_BAD_READ"):
+        # Fetched before; its file says more than a skip would.
+        return
+    f_out = open(output_filename + "_SKIPPED", 'w')
+    f_out.write("SKIPPED")
+    f_out.close()
+    with recordOutput.RecordWriter(output_filename,
+                                   options['format']) as writer:
+        writer.write_all([])
+    METRICS.inc('days_skipped_total')
+    if os.path.exists(output_filename + "_BAD_READ"):
+        os.remove(output_filename + "_BAD_READ")
+
+""" Records a failed fetch of cur_date with a _BAD_READ file. """
+def write_tombstone(output_path, record_type_name, cur_date,
+                    extension=".json"):
+    # Criis.com repeatedly timing out or throwing errors results
+    # in a _BAD_READ file for that date, indicating that fetching failed.
+    # Empty files OTOH are due to no filings on that date (ex: Sunday,
+    # holidays).
+    tombstone = convert_mmddyyyy_to_output_filename(
+        output_path, record_type_name, cur_date, extension) + "_BAD_READ"
+    f_out = open(tombstone, 'w')
+    f_out.write("FAILED TO READ")
+    f_out.close()
+    logging.error("Failed to fetch %s" % cur_date)
+
+""" Sets up the sessions, rate controller and response archive shared by
+this process's CRIISCallers, and the documents they share. """
+def configure_callers(options, budget=None):
+    global RUN_DOCUMENTS
+    RUN_DOCUMENTS = rs.RunDocuments()
+    rs.PARSER_ENGINE = options['parser']
+    rs.CRIISCaller.website = options['website']
+    rs.CRIISCaller.sessions = rs.CRIISSessionPool()
+    rs.CRIISCaller.rate_controller = rs.RateController(
+        max_rate=options['max_rate'])
+    rs.CRIISCaller.rate_controller.budget = budget
+    rs.CRIISCaller.retry_budget = rs.RetryBudget()
+    rs.CRIISCaller.circuit_breaker = rs.CircuitBreaker()
+    if options['archive']:
+        rs.CRIISCaller.archive = rs.ResponseArchive(
+            options['archive'],
+            max_bytes=options['archive_max_mb'] * 1024 * 1024,
+            max_age_days=options['archive_max_age_days'],
+            offline=options['replay'])
+
+def init_scheduler_worker(options, budget):
+    configure_callers(options, budget)
+
+""" Scheduler task: fetches a window for each of its record types in a
+worker process, one after another, so the documents the types share are
+looked up once (see group_windows). Returns the (date, record type) pairs
+that failed and the metrics collected for the task, which the parent merges
+into its own. """
+def run_scheduled_task(task):
+    window, record_type_names, output_path, options = task
+    failed = []
+    for record_type_name in record_type_names:
+        logging.info("Fetching %s records for %s to %s", record_type_name,
+                     window[0], window[-1])
+        failed.extend((cur_date, record_type_name) for cur_date in
+                      fetch_window(window, record_type_name, output_path,
+                                   options))
+    return (failed, METRICS.snapshot(reset=True))
+
+""" Splits the pending (date, record type) pairs into (window, record type)
+tasks. They are ordered by date, so the queries of a day's record types go
+out back to back, on the same keep-alive connection in a serial run, and
+the documents they share are looked up once. """
+def plan_windows(pending, window_days):
+    record_type_names = []
+    for cur_date, record_type_name in pending:
+        if record_type_name not in record_type_names:
+            record_type_names.append(record_type_name)
+    tasks = [(window, record_type_name)
+             for record_type_name in record_type_names
+             for window in split_into_windows(
+                [cur_date for cur_date, pending_type in pending
+                 if pending_type == record_type_name], window_days)]
+    tasks.sort(key=lambda (window, record_type_name): (
+            convert_mmddyyyy_to_date(window[0]),
+            record_type_names.index(record_type_name)))
+    return tasks
+
+""" Groups the (window, record type) tasks of plan_windows into (window,
+record types) tasks, one per window, keeping their order. Each worker process
+of run_scheduled has a RUN_DOCUMENTS of its own, so the record types of a
+window are fetched by one worker. """
+def group_windows(windows):
+    grouped = collections.OrderedDict()
+    for window, record_type_name in windows:
+        grouped.setdefault(tuple(window), []).append(record_type_name)
+    return [(list(window), record_type_names)
+            for window, record_type_names in grouped.iteritems()]
+
+""" Spreads the pending (date, record type) pairs over a pool of worker
+processes, a window (with all of its record types) at a time. All workers draw from one SharedRequestBudget
+of options['total_rate'] requests per second, so adding processes adds
+overlap, not load. Output goes through fetch_window exactly as in a serial
+run, and failed days are deferred as in run_serial. Returns the pairs that
+still failed. """
+def run_scheduled(pending, output_path, options):
+    budget = rs.SharedRequestBudget(options['total_rate'])
+    pool = multiprocessing.Pool(options['processes'],
+                                initializer=init_scheduler_worker,
+                                initargs=(options, budget))
+    try:
+        for attempt in range(options['day_attempts']):
+            tasks = [(window, record_type_names, output_path, options)
+                     for window, record_type_names in group_windows(
+                        plan_windows(pending, options['window_days']))]
+            failed = set()
+            for failed_pairs, metrics in \
+                    pool.imap_unordered(run_scheduled_task, tasks):
+                METRICS.merge(metrics)
+                failed.update(failed_pairs)
+            pending = [pair for pair in pending if pair in failed]
+            if not pending or options['replay']:
+                break
+            defer_days(pending, attempt, options)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return pending
+
+""" Fetches the windows of the pending (date, record type) pairs one after
+another in this process. Failed days are tombstoned and deferred: once the
+rest of the range is done they are fetched again, up to
+options['day_attempts'] times in all, so a bad day does not hold up the days
+after it. Returns the pairs that still failed. """
+def run_serial(pending, output_path, options):
+    for attempt in range(options['day_attempts']):
+        failed = set()
+        for window, record_type_name in plan_windows(
+                pending, options['window_days']):
+            logging.info("Fetching %s records for %s to %s", record_type_name,
+                         window[0], window[-1])
+            failed.update((cur_date, record_type_name) for cur_date in
+                          fetch_window(window, record_type_name, output_path,
+                                       options))
+        pending = [pair for pair in pending if pair in failed]
+        if not pending or options['replay']:
+            break
+        defer_days(pending, attempt, options)
+    return pending
+
+def defer_days(pending, attempt, options):
+    if attempt + 1 < options['day_attempts']:
+        METRICS.inc('days_deferred_total', len(pending))
+        logging.warning("Fetching %d failed days again: %s", len(pending),
+                        ",".join(format_pair(pair) for pair in pending))
+
+def format_pair(pair):
+    return "%s %s" % pair
+
+""" Logs how many requests reused a connection and how well the responses
+compressed, across all worker processes. """
+def log_connection_stats():
+    connections = METRICS.counter_value('criis_connections_total')
+    reuses = METRICS.counter_value('criis_connection_reuses_total')
+    wire_bytes = METRICS.counter_value('criis_wire_bytes_total')
+    page_bytes = METRICS.counter_value('criis_page_bytes_total')
+    if connections + reuses:
+        logging.info("Sent %d requests over %d connections (%.0f%% reused), "
+                     "received %d bytes for %d bytes of pages.",
+                     connections + reuses, connections,
+                     100.0 * reuses / (connections + reuses), wire_bytes,
+                     page_bytes)
 
 def main(argv):
     logging.basicConfig(level=logging.INFO)
-    (date_start, date_end, record_type_name, output_path) = \
+    (date_start, date_end, record_type_names, output_path, options) = \
         parse_commandline_arguments(argv)
-    record_type_num = rs.RECORD_TYPES[record_type_name]
+    configure_callers(options)
     date_list = expand_dates_to_MMDDYYYY_list(date_start, date_end)
-    logging.info("Attempting to fetch for dates: %s", ",".join(date_list))
+    pending = []
+    for record_type_name in record_type_names:
+        type_date_list = date_list
+        if options['repair']:
+            type_date_list = find_days_to_repair(
+                date_list, output_path, record_type_name,
+                recordOutput.output_extension(options['format']))
+        pending.extend((cur_date, record_type_name)
+                       for cur_date in type_date_list)
+    pending = plan_days(pending, output_path, options)
+    logging.info("Attempting to fetch %s for dates: %s",
+                 ",".join(record_type_names), ",".join(sorted(
+                set(cur_date for cur_date, record_type_name in pending),
+                key=convert_mmddyyyy_to_date)))
     start = datetime.datetime.now()
-    idx = 0
-    while idx < len(date_list):
-        cur_date = date_list[idx]
-        logging.info("Fetching records for %s", cur_date)
-        try:
-            records = rs.fetch_records_for_daterange(
-                cur_date, cur_date, record_type_num)
-        except rs.DSException:
-            # Criis.com repeatedly timing out or throwing errors results
-            # in a _BAD_READ file for that date, indicating that fetching failed.
-            # Empty files OTOH are due to no filings on that date (ex: Sunday,
-            # holidays).
-            tombstone = convert_mmddyyyy_to_output_filename(
-                output_path, record_type_name, cur_date) + "_BAD_READ"
-            f_out = open(tombstone, 'w')
-            f_out.write("FAILED TO READ")
-            f_out.close()
-            logging.error("Failed to fetch %s" % cur_date)
-            continue
-
-        f_out = open(convert_mmddyyyy_to_output_filename(
-                output_path, record_type_name, cur_date), 'w')
-        f_out.write(json.dumps(records))
-        f_out.close()
-        idx += 1
+    if options['parse_processes']:
+        # Before any thread starts, since the workers are forked.
+        rs.start_parse_workers(options['parse_processes'])
+    dumper = None
+    if options['metrics']:
+        dumper = recordMetrics.MetricsDumper(
+            METRICS, options['metrics'], options['metrics_interval']).start()
+    try:
+        if options['processes'] > 1:
+            failed = run_scheduled(pending, output_path, options)
+        else:
+            failed = run_serial(pending, output_path, options)
+    finally:
+        if dumper is not None:
+            dumper.stop()
+        rs.stop_parse_workers()
     end = datetime.datetime.now()
     timetaken = end - start
     logging.info("Processed %d dates in %d seconds." % (
             len(date_list), timetaken.seconds))
+    log_connection_stats()
+    reused = METRICS.counter_value('run_documents_reused_total')
+    if reused:
+        logging.info("Reused the APN details of %d documents looked up for "
+                     "another record type.", reused)
+    if failed:
+        logging.error("Gave up on %d days, run with --repair to fetch them "
+                      "again: %s", len(failed),
+                      ",".join(format_pair(pair) for pair in failed))
 
 if __name__ == '__main__':
     main(sys.argv)
@@ -0,0 +1,544 @@
+import asyncore
+import heapq
+import logging
+import socket
+import time
+import zlib
+import recordScraperLib as rsl
+from recordMetrics import METRICS
+
+# An event-driven counterpart to the blocking CRIISCallers in
+# recordScraperLib. Python 2 has no asyncio, so the transport is built on
+# asyncore: one select loop drives every connection, and callers are given
+# callbacks instead of blocking on the response.
+
+ASYNC_POOL_SIZE = 4  # keep-alive connections per pool
+REQUEST_TIMEOUT = 10  # seconds, same as the blocking CRIISCaller
+
+""" Incremental parser for one HTTP/1.x response. Feed it the bytes as they
+arrive; feed() returns True once the response is complete. """
+class HTTPResponseReader(object):
+    def __init__(self, method='GET'):
+        self.method = method
+        self.buffer = ""
+        self.status = None
+        self.latency = None  # seconds, set once the response is complete
+        self.version = None
+        self.headers = dict()
+        self.body_parts = []
+        self.remaining = None  # bytes left in the body or current chunk
+        self.chunked = False
+        self.state = 'status'
+        self.complete = False
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self):
+        return "".join(self.body_parts)
+
+    """ Whether the server will close the connection after this response. """
+    def will_close(self):
+        connection = self.getheader('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection != 'keep-alive'
+        return connection == 'close' or self.state == 'until_close'
+
+    def feed(self, data):
+        self.buffer += data
+        while not self.complete:
+            if self.state in ('status', 'headers', 'chunk_size', 'trailer'):
+                line_end = self.buffer.find("\r\n")
+                if line_end < 0:
+                    return False
+                line = self.buffer[:line_end]
+                self.buffer = self.buffer[line_end + 2:]
+                self.handle_line(line)
+            elif self.state in ('body', 'chunk'):
+                if not self.buffer:
+                    return False
+                piece = self.buffer[:self.remaining]
+                self.buffer = self.buffer[len(piece):]
+                self.body_parts.append(piece)
+                self.remaining -= len(piece)
+                if self.remaining == 0:
+                    if self.state == 'body':
+                        self.complete = True
+                    else:
+                        self.state = 'chunk_end'
+            elif self.state == 'chunk_end':
+                if len(self.buffer) < 2:
+                    return False
+                self.buffer = self.buffer[2:]
+                self.state = 'chunk_size'
+            elif self.state == 'until_close':
+                self.body_parts.append(self.buffer)
+                self.buffer = ""
+                return False
+        return True
+
+    """ Called when the server closes the connection. Returns True if that
+    completed the response. """
+    def feed_eof(self):
+        if self.state == 'until_close':
+            self.complete = True
+        return self.complete
+
+    def handle_line(self, line):
+        if self.state == 'status':
+            parts = line.split(None, 2)
+            if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+                raise rsl.DSException("Bad status line: %r" % line)
+            self.version = parts[0]
+            self.status = int(parts[1])
+            self.state = 'headers'
+        elif self.state == 'headers':
+            if line:
+                name, _, value = line.partition(":")
+                self.headers[name.strip().lower()] = value.strip()
+                return
+            self.start_body()
+        elif self.state == 'chunk_size':
+            self.remaining = int(line.split(";")[0], 16)
+            self.state = 'chunk' if self.remaining else 'trailer'
+        elif self.state == 'trailer' and not line:
+            self.complete = True
+
+    def start_body(self):
+        if self.method == 'HEAD' or self.status in (204, 304) or \
+                100 <= self.status < 200:
+            self.complete = True
+        elif 'chunked' in self.getheader('transfer-encoding', '').lower():
+            self.chunked = True
+            self.state = 'chunk_size'
+        elif self.getheader('content-length') is not None:
+            self.remaining = int(self.getheader('content-length'))
+            self.state = 'body'
+            self.complete = self.remaining == 0
+        else:
+            self.state = 'until_close'
+
+""" Drives asyncore sockets plus a heap of timers, which stand in for the
+time.sleep calls of the blocking callers. """
+class AsyncLoop(object):
+    def __init__(self):
+        self.socket_map = dict()
+        self.timers = []
+        self.timer_seq = 0
+
+    def call_later(self, delay, function, *args):
+        self.timer_seq += 1
+        heapq.heappush(self.timers,
+                       (time.time() + delay, self.timer_seq, function, args))
+
+    """ Runs until done() returns True. """
+    def run(self, done):
+        while not done():
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, function, args = heapq.heappop(self.timers)
+                function(*args)
+            if done():
+                return
+            timeout = 0.5
+            if self.timers:
+                timeout = max(0, min(timeout, self.timers[0][0] - now))
+            if self.socket_map:
+                asyncore.loop(timeout, False, self.socket_map, 1)
+            elif self.timers:
+                time.sleep(timeout)
+            else:
+                raise rsl.DSException("Async loop stalled with work pending.")
+            now = time.time()
+            for conn in self.socket_map.values():
+                conn.check_timeout(now)
+
+""" One keep-alive connection to criis.com that carries one request at a
+time. The pool hands it the next request when the previous one finishes. """
+class AsyncCRIISConnection(asyncore.dispatcher):
+    def __init__(self, pool):
+        asyncore.dispatcher.__init__(self, map=pool.loop.socket_map)
+        self.pool = pool
+        self.out_buffer = ""
+        self.reader = None
+        self.callback = None
+        self.deadline = None
+        self.sent_at = None
+        self.method = None
+        self.requests_served = 0
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((pool.host, pool.port))
+        logging.info('Async connection to %s opened.', pool.website)
+
+    def start_request(self, method, request_bytes, callback):
+        self.method = method
+        self.out_buffer = request_bytes
+        self.reader = HTTPResponseReader(method)
+        self.callback = callback
+        self.sent_at = time.time()
+        self.deadline = self.sent_at + REQUEST_TIMEOUT
+
+    def is_idle(self):
+        return self.callback is None
+
+    def writable(self):
+        return not self.connected or bool(self.out_buffer)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data or self.reader is None:
+            return
+        try:
+            complete = self.reader.feed(data)
+        except (rsl.DSException, ValueError), e:
+            self.fail(rsl.DSException("Bad response from %s: %s" % (
+                        self.pool.website, str(e))))
+            return
+        if complete:
+            self.finish()
+
+    def handle_close(self):
+        if self.reader is not None and self.reader.feed_eof():
+            self.finish()
+        elif self.callback is not None:
+            self.fail(rsl.DSException(
+                    "Connection to %s closed mid-response." % self.pool.website))
+        else:
+            self.discard()
+
+    def handle_error(self):
+        _, value, _ = asyncore.compact_traceback()[1:]
+        self.fail(rsl.DSException("Connection error: %s" % value))
+
+    def check_timeout(self, now):
+        if self.deadline is not None and now > self.deadline:
+            self.fail(rsl.DSException("Request to %s timed out." % (
+                        self.pool.website)), 'timeout')
+
+    def finish(self):
+        latency = time.time() - self.sent_at
+        METRICS.observe('criis_http_seconds', latency,
+                        caller=self.__class__.__name__, method=self.method,
+                        phase='response')
+        response, callback = self.reader, self.callback
+        response.latency = latency
+        self.reader = self.callback = self.deadline = None
+        self.requests_served += 1
+        if response.will_close():
+            self.discard()
+        else:
+            self.pool.release(self)
+        callback(response, None)
+
+    def fail(self, error, kind='error'):
+        if self.callback is not None:
+            METRICS.inc('criis_failures_total',
+                        caller=self.__class__.__name__, phase='response',
+                        kind=kind)
+            rsl.CRIISCaller.rate_controller.record_failure()
+            rsl.CRIISCaller.circuit_breaker.record_failure()
+        callback = self.callback
+        self.reader = self.callback = self.deadline = None
+        self.discard()
+        if callback is not None:
+            callback(None, error)
+
+    def discard(self):
+        self.close()
+        self.pool.remove(self)
+
+""" A small pool of keep-alive connections. Requests beyond the pool size
+queue up until a connection frees. """
+class AsyncConnectionPool(object):
+    def __init__(self, loop, size=ASYNC_POOL_SIZE, website=None):
+        self.loop = loop
+        self.size = max(1, size)
+        self.website = website or rsl.CRIISCaller.website
+        host, _, port = self.website.partition(":")
+        self.host = host
+        self.port = int(port or 80)
+        self.idle = []
+        self.busy = set()
+        self.pending = []
+        self.connections_opened = 0
+
+    def request(self, method, url, body, headers, callback):
+        lines = ["%s %s HTTP/1.1" % (method, url),
+                 "Host: %s" % self.website,
+                 "Connection: keep-alive"]
+        for name, value in headers.iteritems():
+            lines.append("%s: %s" % (name, value))
+        if method == 'POST':
+            lines.append("Content-Length: %d" % len(body))
+        request_bytes = "\r\n".join(lines) + "\r\n\r\n" + (body or "")
+        rsl.CRIISCaller.retry_budget.record_request()
+        self.pending.append((method, request_bytes, callback))
+        self.dispatch()
+
+    def dispatch(self):
+        while self.pending:
+            if self.idle:
+                conn = self.idle.pop()
+                METRICS.inc('criis_connection_reuses_total')
+            elif len(self.busy) < self.size:
+                conn = AsyncCRIISConnection(self)
+                self.connections_opened += 1
+                METRICS.inc('criis_connections_total')
+            else:
+                return
+            self.busy.add(conn)
+            method, request_bytes, callback = self.pending.pop(0)
+            self.start_throttled(conn, method, request_bytes, callback)
+
+    """ Holds the request back until the shared circuit breaker and rate
+    controller let it through, like the blocking callers do. """
+    def start_throttled(self, conn, method, request_bytes, callback):
+        pause = rsl.CRIISCaller.circuit_breaker.delay()
+        if pause > 0:
+            METRICS.inc('circuit_wait_seconds_total', pause)
+            self.loop.call_later(pause, self.resume, conn, method,
+                                 request_bytes, callback)
+            return
+        wait = rsl.CRIISCaller.rate_controller.reserve()
+        conn.start_request(method, request_bytes, callback)
+        if wait > 0:
+            METRICS.inc('throttle_sleep_seconds_total', wait)
+            out_buffer, conn.out_buffer = conn.out_buffer, ""
+            conn.deadline = None
+            self.loop.call_later(wait, self.send_later, conn, out_buffer)
+
+    """ Starts a request held back by the circuit breaker, on another
+    connection if the server closed this one in the meantime. """
+    def resume(self, conn, method, request_bytes, callback):
+        if conn in self.busy:
+            self.start_throttled(conn, method, request_bytes, callback)
+        else:
+            self.pending.insert(0, (method, request_bytes, callback))
+            self.dispatch()
+
+    def send_later(self, conn, out_buffer):
+        if conn.callback is not None:
+            conn.out_buffer = out_buffer
+            conn.sent_at = time.time()
+            conn.deadline = conn.sent_at + REQUEST_TIMEOUT
+
+    def release(self, conn):
+        self.busy.discard(conn)
+        self.idle.append(conn)
+        self.dispatch()
+
+    def remove(self, conn):
+        self.busy.discard(conn)
+        if conn in self.idle:
+            self.idle.remove(conn)
+        self.loop.call_later(0, self.dispatch)
+
+    def close(self):
+        for conn in list(self.idle) + list(self.busy):
+            conn.close()
+        self.idle = []
+        self.busy = set()
+
+    def busy_or_pending(self):
+        return bool(self.busy or self.pending)
+
+""" Asynchronous counterpart of CRIISCaller. Every call takes a
+callback(page, error): page is the results page on success, error a
+DSException once all retries are used up. """
+class AsyncCRIISCaller(object):
+    max_retries = 3
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.default_headers = {
+            'Content-type': 'application/x-www-form-urlencoded',
+            'Accept':       'text/html',
+            'Accept-Encoding': 'gzip',
+            'User-Agent':   'sararcher@outlook.com'
+        }
+
+    """ POSTs to url, follows the 302 to the CyberQuery results file and
+    hands its contents to callback. Pages in the shared response archive are
+    served from there. """
+    def call_criis_with_redirection(self, url, params, callback,
+                                    headers=None, attempt=0):
+        headers = headers or self.default_headers
+        archive = rsl.CRIISCaller.archive
+        if archive is not None and attempt == 0:
+            try:
+                page = archive.get(url, params)
+            except rsl.ArchiveMissException, e:
+                self.pool.loop.call_later(0, callback, None, e)
+                return
+            if page is not None:
+                self.pool.loop.call_later(0, callback, page, None)
+                return
+
+        def retry_or_fail(error):
+            if attempt + 1 < self.max_retries and \
+                    rsl.CRIISCaller.retry_budget.try_retry():
+                logging.error("Async call to %s failed (%s), retrying.",
+                              url, str(error))
+                METRICS.inc('criis_retries_total',
+                            caller=self.__class__.__name__)
+                self.pool.loop.call_later(
+                    rsl.CRIISCaller.rate_controller.backoff_delay(attempt),
+                    self.call_criis_with_redirection,
+                    url, params, callback, headers, attempt + 1)
+            else:
+                callback(None, error)
+
+        def on_results(response, error):
+            if error is None:
+                error = self.check_status(
+                    response, 200, 'Post-redirect page fetching failed.')
+            if error is not None:
+                return retry_or_fail(error)
+            data = response.read()
+            decoder = rsl.ResponseDecoder(response)
+            try:
+                page = decoder.decode(data) + decoder.flush()
+            except zlib.error, e:
+                return retry_or_fail(rsl.DSException(
+                        "Failed to decode %s: %s" % (url, str(e))))
+            METRICS.inc('criis_wire_bytes_total', len(data))
+            METRICS.inc('criis_page_bytes_total', len(page))
+            if archive is not None:
+                archive.put(url, params, page)
+            callback(page, None)
+
+        def on_redirect(response, error):
+            if error is None:
+                error = self.check_status(response, 302,
+                                          'No redirect returned.')
+            if error is not None:
+                return retry_or_fail(error)
+            self.pool.request('GET', response.getheader('Location'), "",
+                              headers, on_results)
+
+        self.pool.request('POST', url, params, headers, on_redirect)
+
+    """ Like rsl.CRIISCaller.check_status, but returns the DSException
+    instead of raising it, and None for a response with the expected
+    status. """
+    def check_status(self, response, expected, message):
+        if response.status != expected:
+            METRICS.inc('criis_failures_total',
+                        caller=self.__class__.__name__, phase='status',
+                        kind='error')
+            rsl.CRIISCaller.rate_controller.record_failure()
+            rsl.CRIISCaller.circuit_breaker.record_failure()
+            return rsl.DSException("%s (HTTP %d)" % (message,
+                                                     response.status))
+        rsl.CRIISCaller.rate_controller.record_success(response.latency)
+        rsl.CRIISCaller.circuit_breaker.record_success()
+        return None
+
+""" Issues a date-range query to CRIIS. """
+class AsyncCRIISCallerDateQuery(AsyncCRIISCaller):
+    def fetch(self, date_start, date_end, doc_type, callback):
+        self.call_criis_with_redirection(
+            "/cgi-bin/new_get_recorded.cgi",
+            rsl.CRIISCallerDateQuery.build_params(
+                date_start, date_end, doc_type),
+            callback)
+
+class AsyncCRIISCallerAPNQuery(AsyncCRIISCaller):
+    def fetch(self, apn_url, callback):
+        url, params = rsl.CRIISCallerAPNQuery.split_apn_url(apn_url)
+        self.call_criis_with_redirection(url, params, callback)
+
+""" Event-loop version of rsl.fetch_records_for_daterange. All APN lookups
+are issued at once and multiplexed over pool_size keep-alive connections;
+parsing, normalization and journaling are shared with the blocking
+version, and so is the check_empty scan for an empty report. """
+def fetch_records_for_daterange(start_date, end_date, record_type_num,
+                                pool_size=ASYNC_POOL_SIZE, journal=None,
+                                known=None, max_report_pages=None,
+                                check_empty=False):
+    loop = AsyncLoop()
+    pool = AsyncConnectionPool(loop, pool_size)
+    state = {'done': False, 'error': None, 'records': None}
+
+    def on_date_records(html_daterecords, error):
+        if error is not None:
+            state['error'] = rsl.DSException(
+                "Failed to fetch for date range %s to %s" % (
+                    start_date, end_date))
+            state['done'] = True
+            return
+        if check_empty:
+            try:
+                html_daterecords = "".join(
+                    rsl.check_empty_page([html_daterecords]))
+            except rsl.DSException, e:
+                state['error'] = e
+                state['done'] = True
+                return
+            if not html_daterecords:
+                finish([], [], [])
+                return
+        date_query_parser = rsl.HTMLRecordsDateQueryParser()
+        date_query_parser.feed(html_daterecords)
+        try:
+            rsl.check_report_pages(date_query_parser, start_date, end_date,
+                                   max_report_pages)
+        except rsl.ReportTooLargeException, e:
+            state['error'] = e
+            state['done'] = True
+            return
+        normalized_records, apn_jobs = rsl.normalize_date_query_records(
+            date_query_parser.get_records())
+        pending = rsl.restore_journaled_records(normalized_records, journal)
+        pending = rsl.restore_known_records(normalized_records, pending, known)
+        pending_jobs = [apn_jobs[idx] for idx in pending]
+        apn_pages = [None] * len(pending_jobs)
+        outstanding = [len(pending_jobs)]
+
+        def on_apn_page(job_idx):
+            def callback(page, error):
+                if page is not None:
+                    normalized_record = normalized_records[pending[job_idx]]
+                    rsl.merge_apn_page(normalized_record, page)
+                    if journal is not None:
+                        journal.append(normalized_record)
+                    if known is not None:
+                        known.add(normalized_record)
+                apn_pages[job_idx] = page
+                outstanding[0] -= 1
+                if outstanding[0] == 0:
+                    finish(normalized_records, pending_jobs, apn_pages)
+            return callback
+
+        if not pending_jobs:
+            finish(normalized_records, pending_jobs, apn_pages)
+        apn_caller = AsyncCRIISCallerAPNQuery(pool)
+        for job_idx, (joinkey, date, apn_url) in enumerate(pending_jobs):
+            logging.info("Looking up APNs for %s (%s)", joinkey, date)
+            apn_caller.fetch(apn_url, on_apn_page(job_idx))
+
+    def finish(normalized_records, apn_jobs, apn_pages):
+        rsl.count_query_records(normalized_records, apn_jobs)
+        try:
+            state['records'] = rsl.sort_completed_records(
+                normalized_records, apn_jobs, apn_pages)
+        except rsl.DSException, e:
+            state['error'] = e
+        state['done'] = True
+
+    AsyncCRIISCallerDateQuery(pool).fetch(
+        start_date, end_date, record_type_num, on_date_records)
+    try:
+        loop.run(lambda: state['done'])
+    finally:
+        pool.close()
+    if state['error'] is not None:
+        raise state['error']
+    return state['records']
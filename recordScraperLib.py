@@ -6,118 +6,1148 @@ import pprint
 import time
 import socket
 import traceback
+import threading
+import Queue
+import random
+import os
+import gzip
+import zlib
+import hashlib
+import urlparse
+import json
+import multiprocessing
+import sqlite3
+import collections
+from recordMetrics import METRICS, COUNT_BUCKETS
 
-SLEEP_THROTTLE = 200  # ms to sleep between requests
+SLEEP_THROTTLE = 200  # ms between requests the rate controller starts at
+APN_FETCH_CONCURRENCY = 4  # APN detail pages fetched in parallel
+STREAM_CHUNK_BYTES = 16 * 1024  # read size when streaming result pages
+KNOWN_BLANK_TTL_DAYS = 14  # days a known document without reel/image is kept
+RUN_DOCUMENTS_MAX = 100000  # documents a RunDocuments set remembers
+WORK_LEASE_SECONDS = 600  # until a leased WorkQueue item is handed out again
+WORK_MAX_ATTEMPTS = 5  # leases of a WorkQueue item before it is failed
+CRIIS_WEBSITE = 'www.criis.com'
+# The form fields of CRIISCallerBlockLotQuery are modeled on the date
+# query's, and its results are read like a date query's, but neither has been
+# checked against the live Block and Lot Search. Set this once a captured
+# search form and results page in testdata/ (see TestBlockLotQuery) pass;
+# until then bulkScraper only runs against other servers, like the stub.
+BLOCKLOT_FORM_VERIFIED = False
 MULTILINE_WORKAROUND_KEY = "|||"
+# Default HTMLRecordsParser engine: 'htmlparser' runs the page through the
+# stdlib HTMLParser, 'fast' only tokenizes the records tables.
+PARSER_ENGINE = 'htmlparser'
+PARSER_ENGINES = ('htmlparser', 'fast')
+PARSE_QUEUE_CHUNKS = 8  # chunks of a streamed page queued ahead of a worker
+# ParseWorkerPool the result pages are parsed in, if any; see
+# start_parse_workers. Without one they are parsed in the fetching threads.
+PARSE_WORKERS = None
 
 """ Fetch records for date range, including owner and APN information.
-Returns a date-sorted list of normalized records.
+Returns a date-sorted list of normalized records. The date query page is
+parsed while it downloads (in a parse worker once start_parse_workers was
+called), and the APN details of each document are looked
+up (by up to apn_concurrency callers in parallel) as soon as its rows are
+complete. If a RecordJournal is given, documents it already holds are not
+looked up again, and every newly completed document is appended to it. Documents a KnownDocuments set already holds
+reuse its APN details instead of being looked up, and new lookups are added
+to it. If the date query's report has more than max_report_pages pages,
+ReportTooLargeException is raised before any APN lookup. With check_empty
+set, for days that are expected to be empty, the page is only scanned for a
+records row (see check_empty_page) and parsed if it has one.
 """
-def fetch_records_for_daterange(start_date, end_date, record_type_num):
-    date_query_caller = CRIISCallerDateQuery()
-    date_query_parser = HTMLRecordsDateQueryParser()
+def fetch_records_for_daterange(start_date, end_date, record_type_num,
+                                apn_concurrency=APN_FETCH_CONCURRENCY,
+                                journal=None, known=None,
+                                max_report_pages=None, check_empty=False):
+    return fetch_query_records(
+        stream_date_query_records(start_date, end_date, record_type_num,
+                                  max_report_pages, check_empty),
+        apn_concurrency, journal, known)
 
-    apn_query_caller = CRIISCallerAPNQuery()
-    apn_query_parser = HTMLRecordsAPNParser()
-
-    date_query_retries = 0
-    date_query_max_retries = 3
-    html_daterecords = None
-    while date_query_retries < date_query_max_retries:
-        try:
-            html_daterecords = date_query_caller.fetch(
-                start_date, end_date, record_type_num)
-            break
-        except DSException:
-            logging.error("Caught a DSException fetching dates %s to %s " % (
-                    start_date, end_date))
-            date_query_caller.close_connection()
-            time.sleep(5)
-            date_query_caller.create_connection()
-    if html_daterecords == None:
-        raise DSException("Failed to fetch for date range %s to %s" % (
-                    start_date, end_date))
-    date_query_parser.feed(html_daterecords)
-    denorm_records = date_query_parser.get_records()
+""" Fetch the records filed against one block/lot, including owner and APN
+information, like fetch_records_for_daterange: the block/lot query lists
+the documents of every type, and the APN details of each are looked up. """
+def fetch_records_for_blocklot(block, lot,
+                               apn_concurrency=APN_FETCH_CONCURRENCY,
+                               known=None):
+    return fetch_query_records(
+        stream_query_records(CRIISCallerBlockLotQuery, (block, lot),
+                             "block/lot %s-%s" % (block, lot)),
+        apn_concurrency, known=known)
 
+""" Normalizes the (document id, rows) groups of a query's results as they
+come in and looks up the APN details of each document, as described for
+fetch_records_for_daterange. Returns the records in date order. """
+def fetch_query_records(record_groups, apn_concurrency=APN_FETCH_CONCURRENCY,
+                        journal=None, known=None):
+    completed = load_journal(journal)
     normalized_records = []
+    records_by_id = dict()
+    apn_jobs = []
+    job_records = []
+
+    def on_page(job_idx, apn_list_html):
+        normalized_record = job_records[job_idx]
+        merge_apn_page(normalized_record, apn_list_html)
+        if journal is not None:
+            journal.append(normalized_record)
+        if known is not None:
+            known.add(normalized_record)
+
+    apn_pool = APNFetchPool(apn_concurrency)
+    apn_pool.start(on_page)
+    try:
+        for joinkey, record_rows in record_groups:
+            normalized_record = normalize_date_query_rows(joinkey, record_rows)
+            if normalized_record is None:
+                continue
+            if joinkey in records_by_id:
+                merge_date_query_names(records_by_id[joinkey],
+                                       normalized_record)
+                continue
+            if joinkey in completed:
+                normalized_record = completed[joinkey]
+            records_by_id[joinkey] = normalized_record
+            normalized_records.append(normalized_record)
+            if joinkey in completed:
+                continue
+            if known is not None and known.restore(normalized_record):
+                continue
+            apn_jobs.append((joinkey, normalized_record['date'],
+                             record_rows[0]['APNLink']))
+            job_records.append(normalized_record)
+            apn_pool.submit(apn_jobs[-1])
+    finally:
+        # Lookups already under way still get journaled if the query failed.
+        apn_pages = apn_pool.finish()
+    count_query_records(normalized_records, apn_jobs)
+    return sort_completed_records(normalized_records, apn_jobs, apn_pages)
+
+""" Counts the documents of a date query and the APN lookups they took. """
+def count_query_records(normalized_records, apn_jobs):
+    METRICS.inc('records_total', len(normalized_records))
+    METRICS.inc('apn_lookups_total', len(apn_jobs))
+    METRICS.observe('query_records', len(normalized_records),
+                    buckets=COUNT_BUCKETS)
+    METRICS.observe('query_apn_lookups', len(apn_jobs), buckets=COUNT_BUCKETS)
+
+""" Issues the date query (with retries) and yields (document id, rows)
+groups of the parsed records while the page is still being read. A retry
+after a failure mid-page skips the groups that were already yielded. Raises
+ReportTooLargeException for reports of more than max_report_pages pages. """
+def stream_date_query_records(start_date, end_date, record_type_num,
+                              max_report_pages=None, check_empty=False):
+    def check_pages(date_query_parser):
+        check_report_pages(date_query_parser, start_date, end_date,
+                           max_report_pages)
+    return stream_query_records(
+        CRIISCallerDateQuery, (start_date, end_date, record_type_num),
+        "date range %s to %s" % (start_date, end_date), check_pages,
+        check_empty)
+
+""" Streams the results of a query by a caller_class caller, whose
+stream(*stream_args) yields the result page, like
+stream_date_query_records. check_parser(parser), if given, is called
+before each group is yielded. With check_empty set, the page goes through
+check_empty_page first. """
+def stream_query_records(caller_class, stream_args, description,
+                         check_parser=None, check_empty=False):
+    query_caller = caller_class()
+
+    query_retries = 0
+    query_max_retries = 3
+    yielded = 0
+    try:
+        while query_retries < query_max_retries:
+            query_parser = stream_parser(HTMLRecordsDateQueryParser)
+            try:
+                chunks = query_caller.stream(*stream_args)
+                if check_empty:
+                    chunks = check_empty_page(chunks)
+                for idx, group in enumerate(
+                        query_parser.parse_stream(chunks)):
+                    if check_parser is not None:
+                        check_parser(query_parser)
+                    if idx >= yielded:
+                        yielded += 1
+                        yield group
+                return
+            except ArchiveMissException:
+                break
+            except DSException:
+                logging.error("Caught a DSException fetching %s", description)
+                if query_retries + 1 >= query_max_retries or \
+                        not CRIISCaller.retry_budget.try_retry():
+                    break
+                METRICS.inc('criis_retries_total',
+                            caller=query_caller.__class__.__name__)
+                query_caller.reset_connection()
+                CRIISCaller.rate_controller.backoff(query_retries)
+                query_retries += 1
+    finally:
+        query_caller.close_connection()
+    raise DSException("Failed to fetch for %s" % description)
+
+""" Passes the chunks of a results page on once a records row shows up in
+them, which on a page with records is within its first chunk. A page without
+any is an empty report: it is read to its end but not parsed, and nothing is
+passed on. Raises DSException if it ends before </html>, as a truncated page
+would. """
+def check_empty_page(chunks):
+    chunks = iter(chunks)
+    buffered = []
+    tail = ""
+    for chunk in chunks:
+        buffered.append(chunk)
+        if RECORDS_ROW_MARKER in tail + chunk:
+            METRICS.inc('empty_checks_total', result='records')
+            for chunk in buffered:
+                yield chunk
+            for chunk in chunks:
+                yield chunk
+            return
+        tail = (tail + chunk)[-len(RECORDS_ROW_MARKER):]
+    if not PAGE_END_RE.search(''.join(buffered)[-64:]):
+        raise DSException("Results page ended before </html>")
+    METRICS.inc('empty_checks_total', result='empty')
+
+def check_report_pages(date_query_parser, start_date, end_date,
+                       max_report_pages):
+    report_pages = date_query_parser.report_pages
+    if max_report_pages is not None and report_pages is not None and \
+            report_pages > max_report_pages:
+        raise ReportTooLargeException(start_date, end_date, report_pages)
 
-    run_cnt = 0
+""" Normalizes parsed date query records. Returns the normalized records
+(without APN details) and a matching list of (document id, date, APN url)
+jobs for the APN lookups. """
+def normalize_date_query_records(denorm_records):
+    normalized_records = []
+    apn_jobs = []
     # The date query returnes several rows for each record, and each
     # row can have several entries for each key.
     for joinkey, record_rows in denorm_records.iteritems():
-        run_cnt += 1
-        if len(record_rows) == 0:
-            logging.warning("No record rows for joinkey %s", joinkey)
+        normalized_record = normalize_date_query_rows(joinkey, record_rows)
+        if normalized_record is None:
             continue
-        record_rows_zero_keys = record_rows[0].keys()
-        if "RecordDate" not in record_rows_zero_keys or \
-                "DocType" not in record_rows_zero_keys or \
-                "APNLink" not in record_rows_zero_keys:
-            logging.warning("Encountered a bad row with keys: %s" % (
-                    ",".join(record_rows_zero_keys)))
+        normalized_records.append(normalized_record)
+        apn_jobs.append((joinkey, normalized_record['date'],
+                         record_rows[0]['APNLink']))
+    return normalized_records, apn_jobs
+
+""" Returns the completed records of a RecordJournal (or of none) keyed by
+document id. """
+def load_journal(journal):
+    if journal is None:
+        return dict()
+    completed = journal.load()
+    if completed:
+        logging.info("Resuming with %d documents from %s", len(completed),
+                     journal.path)
+    return completed
+
+""" Replaces normalized records with their completed versions from the
+journal. Returns the indices of the records that still need APN lookups. """
+def restore_journaled_records(normalized_records, journal):
+    if journal is None:
+        return range(len(normalized_records))
+    completed = load_journal(journal)
+    pending = []
+    for idx, normalized_record in enumerate(normalized_records):
+        if normalized_record['id'] in completed:
+            normalized_records[idx] = completed[normalized_record['id']]
+        else:
+            pending.append(idx)
+    return pending
+
+""" Fills in the records at the pending indices that a KnownDocuments set
+holds. Returns the indices that still need APN lookups. """
+def restore_known_records(normalized_records, pending, known):
+    if known is None:
+        return pending
+    return [idx for idx in pending
+            if not known.restore(normalized_records[idx])]
+
+""" Parses a fetched APN page into its normalized record. """
+def merge_apn_page(normalized_record, apn_list_html):
+    records = parse_page(HTMLRecordsAPNParser, apn_list_html)
+    with METRICS.timer('normalize_seconds', step='apn_merge'):
+        return merge_apn_records(normalized_record, records)
+
+""" Parses a whole page with a parser_class parser and returns its records,
+in a parse worker if they were started. """
+def parse_page(parser_class, page):
+    if PARSE_WORKERS is not None:
+        return PARSE_WORKERS.parse_page(parser_class, page)
+    parser = parser_class()
+    parser.feed(page)
+    return parser.get_records()
+
+""" Returns a parser_class parser for parse_stream(), or a stand-in that
+streams the page to a parse worker if they were started. """
+def stream_parser(parser_class):
+    if PARSE_WORKERS is not None:
+        return WorkerStreamParser(parser_class, PARSE_WORKERS)
+    return parser_class()
+
+""" Returns the normalized records in date order once every APN page has
+been merged. Raises a DSException if any page is missing. """
+def sort_completed_records(normalized_records, apn_jobs, apn_pages):
+    failed_ids = [job[0] for job, page in zip(apn_jobs, apn_pages)
+                  if page is None]
+    if failed_ids:
+        raise DSException("Failed to fetch APNs for %s" % ",".join(failed_ids))
+    normalized_records.sort(key=record_sort_key)
+    return normalized_records
+
+""" Builds a normalized record (without APN details) from the date query rows
+of one document. Returns None if the rows are unusable. """
+def normalize_date_query_rows(joinkey, record_rows):
+    with METRICS.timer('normalize_seconds', step='date_query_rows'):
+        return normalize_rows(joinkey, record_rows)
+
+def normalize_rows(joinkey, record_rows):
+    if len(record_rows) == 0:
+        logging.warning("No record rows for joinkey %s", joinkey)
+        return None
+    record_rows_zero_keys = record_rows[0].keys()
+    if "RecordDate" not in record_rows_zero_keys or \
+            "DocType" not in record_rows_zero_keys or \
+            "APNLink" not in record_rows_zero_keys:
+        logging.warning("Encountered a bad row with keys: %s" % (
+                ",".join(record_rows_zero_keys)))
+        return None
+    grantors = list()
+    grantees = list()
+    # Fetch the grantors and grantees
+    for row in record_rows:
+        if not row.get('Name'):
             continue
-        normalized_record = dict()
-        normalized_record['id'] = joinkey
-        normalized_record['date'] = record_rows[0]['RecordDate']
-        normalized_record['doctype'] = record_rows[0]['DocType']
-        normalized_record['grantors'] = list()
-        normalized_record['grantees'] = list()
-        # Records can conceivably span two images, which may span two reels...
-        normalized_record['reel_image'] = list()
-        # Some deeds cover multiple APNs
-        normalized_record['apn'] = list()
-
-        # Fetch the grantors and grantees
-        for row in record_rows:
-            if not row.get('Name'):
-                continue
-            names = row['Name'].split(MULTILINE_WORKAROUND_KEY)
-            if row.get('GrantorGrantee','') == 'E':
-                normalized_record['grantees'] += names
-            elif row.get('GrantorGrantee','') == 'R':
-                normalized_record['grantors'] += names
-        normalized_record['grantors'] = list(set(normalized_record['grantors']))
-        normalized_record['grantees'] = list(set(normalized_record['grantees']))
-
-        # Fetch the APNs.
-        apn_url = record_rows[0]['APNLink']
-        logging.info("Looking up APNs for %s (%s)", joinkey,
-                     normalized_record['date'])
-        apn_fetch_retries = 0
-        apn_fetch_max_retries = 3
-        while apn_fetch_retries < apn_fetch_max_retries:
+        names = row['Name'].split(MULTILINE_WORKAROUND_KEY)
+        if row.get('GrantorGrantee','') == 'E':
+            grantees += names
+        elif row.get('GrantorGrantee','') == 'R':
+            grantors += names
+    # Records can conceivably span two images, which may span two reels, and
+    # some deeds cover multiple APNs. Both are filled in from the APN page.
+    return Record(joinkey, record_rows[0]['RecordDate'],
+                  record_rows[0]['DocType'], grantors=list(set(grantors)),
+                  grantees=list(set(grantees)))
+
+""" Adds the names of a second group of date query rows for the same document
+to its normalized record. Rows of a document are normally contiguous, but a
+streamed page yields a group again if its rows ever come back. """
+def merge_date_query_names(normalized_record, other_record):
+    for key in ('grantors', 'grantees'):
+        normalized_record[key] = list(
+            set(normalized_record[key]) | set(other_record[key]))
+    return normalized_record
+
+""" Adds the reel/image and APN entries of a parsed APN detail page to a
+normalized record. """
+def merge_apn_records(normalized_record, denorm_apn_records):
+    joinkey = normalized_record['id']
+    reel_image = normalized_record['reel_image']
+    apn = normalized_record['apn']
+    for apn_joinkey, apn_record_rows in denorm_apn_records.iteritems():
+        if apn_joinkey != joinkey:
+            logging.warning("APN fetching resulted in conflicting "
+                            "document IDs: %s vs %s", joinkey, apn_joinkey)
+
+        for apn_row in apn_record_rows:
+            reel = apn_row.get('Reel','')
+            image = apn_row.get('Image','')
+            if reel and image:
+                reel_image.append(reel + ',' + image)
+            apn += apn_row.get('APN','').split(MULTILINE_WORKAROUND_KEY)
+
+    normalized_record['reel_image'] = list(set(reel_image))
+    normalized_record['apn'] = list(set(apn))
+    return normalized_record
+
+""" Append-only journal of the completed normalized records of one day,
+stored as one JSON document per line. A scrape that dies mid-day resumes
+from it instead of looking up every document again. """
+class RecordJournal(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    """ Returns the journaled records keyed by document id. A torn last line
+    from a crash mid-write is ignored. """
+    def load(self):
+        completed = dict()
+        if not os.path.exists(self.path):
+            return completed
+        f = open(self.path, 'r')
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning("Ignoring torn journal line in %s",
+                                    self.path)
+                    continue
+                completed[record['id']] = Record.from_dict(record)
+        finally:
+            f.close()
+        return completed
+
+    def append(self, record):
+        line = encode_record(record) + "\n"
+        with self.lock:
+            f = open(self.path, 'a')
             try:
-                apn_list_html = apn_query_caller.fetch(apn_url)
-                break
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+""" The RecordJournals of the days of a multi-day date query, used like one
+journal. journals maps filing dates (MM/DD/YYYY, as in records) to journals;
+records go to the journal of their date, or to default_journal. """
+class MultiDayJournal(object):
+    def __init__(self, journals, default_journal):
+        self.journals = journals
+        self.default_journal = default_journal
+        self.path = ",".join(sorted(
+                journal.path for journal in journals.itervalues()))
+
+    def load(self):
+        completed = dict()
+        for journal in self.journals.itervalues():
+            completed.update(journal.load())
+        return completed
+
+    def append(self, record):
+        self.journals.get(record['date'], self.default_journal).append(record)
+
+    def remove(self):
+        for journal in self.journals.itervalues():
+            journal.remove()
+
+""" Maps equal strings to one shared instance, so the names, dates and doc
+types repeated across records are held once. The intern() builtin only
+takes byte strings, while records read back from JSON hold unicode, and
+its strings live as long as the process. An interner lives as long as the
+records of the corpus (or page) it was made for. """
+class StringInterner(object):
+    def __init__(self):
+        self.strings = dict()
+
+    def intern(self, string):
+        return self.strings.setdefault(string, string)
+
+    def intern_all(self, strings):
+        return tuple([self.strings.setdefault(string, string)
+                      for string in strings])
+
+# Fields of a normalized record, in the key order of the JSON output.
+RECORD_FIELDS = ('id', 'date', 'doctype', 'grantors', 'grantees',
+                 'reel_image', 'apn')
+RECORD_LIST_FIELDS = frozenset(('grantors', 'grantees', 'reel_image', 'apn'))
+
+""" A normalized record (see "Records" in the README). Its list fields are
+stored as tuples, and __slots__ leaves out the per-object dict. Given the
+StringInterner of a corpus, the strings of its fields are interned (document
+ids are unique, so not those), so a corpus of Records takes a fraction of
+the memory of the dicts. Records of a scrape, most of whose strings are not
+repeated, are not interned.
+Fields can also be read and set like dict items, where list fields read as
+fresh lists; to_dict() gives the JSON form. """
+class Record(object):
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, id, date, doctype, grantors=(), grantees=(),
+                 reel_image=(), apn=(), interner=None):
+        self.id = id
+        if interner is None:
+            self.date = date
+            self.doctype = doctype
+            self.grantors = tuple(grantors)
+            self.grantees = tuple(grantees)
+            self.reel_image = tuple(reel_image)
+            self.apn = tuple(apn)
+            return
+        self.date = interner.intern(date)
+        self.doctype = interner.intern(doctype)
+        self.grantors = interner.intern_all(grantors)
+        self.grantees = interner.intern_all(grantees)
+        self.reel_image = interner.intern_all(reel_image)
+        self.apn = interner.intern_all(apn)
+
+    @staticmethod
+    def from_dict(record, interner=None):
+        return Record(record.get('id'), record.get('date'),
+                      record.get('doctype'), record.get('grantors', ()),
+                      record.get('grantees', ()), record.get('reel_image', ()),
+                      record.get('apn', ()), interner)
+
+    def to_dict(self):
+        record = dict()
+        for field in RECORD_FIELDS:
+            record[field] = self[field]
+        return record
+
+    def __getitem__(self, field):
+        if field not in RECORD_FIELDS:
+            raise KeyError(field)
+        if field in RECORD_LIST_FIELDS:
+            return list(getattr(self, field))
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        if field not in RECORD_FIELDS:
+            raise KeyError(field)
+        if field in RECORD_LIST_FIELDS:
+            value = tuple(value)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in RECORD_FIELDS
+
+    def get(self, field, default=None):
+        if field not in RECORD_FIELDS:
+            return default
+        return self[field]
+
+    def keys(self):
+        return list(RECORD_FIELDS)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Record(%r)" % self.to_dict()
+
+""" JSON form of a record, which may be a Record or a plain dict. """
+def encode_record(record):
+    if isinstance(record, Record):
+        record = record.to_dict()
+    return json.dumps(record)
+
+# Fields the parsers extract from a table row.
+ROW_FIELDS = ('RecordDate', 'Document', 'DocType', 'GrantorGrantee', 'Name',
+              'APNLink', 'Reel', 'Image', 'APN')
+
+""" One parsed table row, as produced by the HTML parsers: the text of each
+mapped column, with the entries of multi-line cells joined by
+MULTILINE_WORKAROUND_KEY. Slotted like Record, and interned by the
+interner of its page, if given. Reads like a dict of the fields the row
+has; missing fields are None. """
+class RecordRow(object):
+    __slots__ = ROW_FIELDS
+
+    def __init__(self, fields=None, interner=None):
+        for field in ROW_FIELDS:
+            setattr(self, field, None)
+        if fields:
+            for field, value in fields.iteritems():
+                if interner is not None:
+                    value = interner.intern(value)
+                self[field] = value
+
+    def to_dict(self):
+        row = dict()
+        for field in ROW_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                row[field] = value
+        return row
+
+    def __getitem__(self, field):
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        if field not in ROW_FIELDS:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+    def get(self, field, default=None):
+        if field not in ROW_FIELDS:
+            return default
+        value = getattr(self, field)
+        if value is None:
+            return default
+        return value
+
+    def keys(self):
+        return [field for field in ROW_FIELDS
+                if getattr(self, field) is not None]
+
+    def __eq__(self, other):
+        if isinstance(other, RecordRow):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "RecordRow(%r)" % self.to_dict()
+
+""" The documents whose APN details have been looked up before, with their
+apn and reel_image lists, kept in a SQLite file shared by all runs and worker
+processes. Re-fetching a date range then only costs the date query. New
+documents often have no reel/image yet, so such entries are only trusted for
+blank_ttl_days (None: never). With force set, every document is looked up
+again, and the entries are refreshed. The primary key lookup is exact and
+cheap enough that no in-memory filter is kept in front of it. """
+class KnownDocuments(object):
+    def __init__(self, path, blank_ttl_days=KNOWN_BLANK_TTL_DAYS, force=False):
+        self.path = path
+        self.blank_ttl_days = blank_ttl_days
+        self.force = force
+        self.clock = time.time
+        self.lock = threading.Lock()
+        # Shared by the APN worker threads, under the lock.
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS known_documents (id TEXT PRIMARY KEY, "
+            "apn TEXT, reel_image TEXT, fetched_at REAL)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    """ Copies the stored APN details into the record. Returns False if its
+    document has to be looked up. """
+    def restore(self, record):
+        if self.force:
+            return False
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT apn, reel_image, fetched_at FROM known_documents "
+                "WHERE id = ?", (record['id'],)).fetchone()
+        if row is None:
+            return False
+        apn, reel_image, fetched_at = row
+        reel_image = json.loads(reel_image)
+        if not reel_image and (self.blank_ttl_days is None or
+                self.clock() - fetched_at > self.blank_ttl_days * 86400):
+            return False
+        record['apn'] = json.loads(apn)
+        record['reel_image'] = reel_image
+        return True
+
+    def add(self, record):
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO known_documents "
+                    "(id, apn, reel_image, fetched_at) VALUES (?, ?, ?, ?)",
+                    (record['id'], json.dumps(record['apn']),
+                     json.dumps(record['reel_image']), self.clock()))
+
+""" The documents whose APN details were looked up earlier in this run, kept
+in memory, so that a document listed under several record types is only
+looked up once. Same interface as KnownDocuments. Only the max_entries
+latest documents are kept, which bounds a long-running process. """
+class RunDocuments(object):
+    def __init__(self, max_entries=RUN_DOCUMENTS_MAX):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.documents = collections.OrderedDict()  # id -> (apn, reel_image)
+
+    def close(self):
+        pass
+
+    def restore(self, record):
+        with self.lock:
+            details = self.documents.get(record['id'])
+        if details is None:
+            return False
+        record['apn'] = list(details[0])
+        record['reel_image'] = list(details[1])
+        METRICS.inc('run_documents_reused_total')
+        return True
+
+    def add(self, record):
+        with self.lock:
+            self.documents.pop(record['id'], None)
+            self.documents[record['id']] = (tuple(record['apn']),
+                                            tuple(record['reel_image']))
+            while len(self.documents) > self.max_entries:
+                self.documents.popitem(last=False)
+
+""" Several document sets (RunDocuments, KnownDocuments) asked in turn. A
+document is restored from the first set that has it, and added to all. """
+class DocumentSets(object):
+    def __init__(self, document_sets):
+        self.document_sets = [document_set for document_set in document_sets
+                              if document_set is not None]
+
+    def restore(self, record):
+        for document_set in self.document_sets:
+            if document_set.restore(record):
+                return True
+        return False
+
+    def add(self, record):
+        for document_set in self.document_sets:
+            document_set.add(record)
+
+""" A queue of work items (e.g. block/lot numbers) kept in a SQLite file, so
+a long bulk run survives restarts and several processes can share it. An
+item is pending until a worker leases it, then leased until the worker
+completes it (done) or fails it (pending again, or failed after
+max_attempts leases). A lease that is not settled within lease_seconds
+expires, and the item goes to the next worker that asks, so the items of a
+run that died are picked up again. Pending items are handed out by
+priority, then in the order they were added, the ones failed before
+last. """
+class WorkQueue(object):
+    def __init__(self, path, lease_seconds=WORK_LEASE_SECONDS,
+                 max_attempts=WORK_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.clock = time.time
+        self.lock = threading.Lock()
+        # Shared by the worker threads, under the lock.
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS work (item TEXT PRIMARY KEY, "
+            "state TEXT NOT NULL, owner TEXT, lease_expires REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, updated REAL, "
+            "priority INTEGER NOT NULL DEFAULT 0)")
+        columns = [row[1] for row in self.conn.execute(
+                "PRAGMA table_info(work)")]
+        if 'priority' not in columns:
+            self.conn.execute("ALTER TABLE work ADD COLUMN "
+                              "priority INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS work_state ON work "
+            "(state, attempts, lease_expires)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    """ Queues the items that are not queued yet, to be handed out before
+    the pending items of lower priority. Returns how many were new. """
+    def add(self, items, priority=0):
+        with self.lock:
+            with self.conn:
+                before = self.conn.total_changes
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO work (item, state, updated, "
+                    "priority) VALUES (?, 'pending', ?, ?)",
+                    ((item, self.clock(), priority) for item in items))
+                return self.conn.total_changes - before
+
+    """ Leases up to count items to owner. Returns the items, which may be
+    fewer (or none) if the queue runs dry. """
+    def lease(self, owner, count=1):
+        with self.lock:
+            now = self.clock()
+            # BEGIN IMMEDIATE, so two processes cannot lease the same item.
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                items = [row[0] for row in self.conn.execute(
+                        "SELECT item FROM work WHERE state = 'pending' OR "
+                        "(state = 'leased' AND lease_expires < ?) "
+                        "ORDER BY priority DESC, attempts, rowid LIMIT ?",
+                        (now, count))]
+                self.conn.executemany(
+                    "UPDATE work SET state = 'leased', owner = ?, "
+                    "lease_expires = ?, attempts = attempts + 1, "
+                    "updated = ? WHERE item = ?",
+                    ((owner, now + self.lease_seconds, now, item)
+                     for item in items))
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+        return items
+
+    """ Marks an item leased by owner as done. Returns False if the lease
+    had expired and someone else holds it now. """
+    def complete(self, item, owner):
+        return self.settle(item, owner, 'done', None)
+
+    """ Puts an item leased by owner back, or marks it failed once it was
+    leased max_attempts times. Returns the new state, or None if the lease
+    had expired and someone else holds it now. """
+    def fail(self, item, owner, error):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT attempts FROM work WHERE item = ? AND owner = ? AND "
+                "state = 'leased'", (item, owner)).fetchone()
+        if row is None:
+            return None
+        state = 'failed' if row[0] >= self.max_attempts else 'pending'
+        if not self.settle(item, owner, state, error):
+            return None
+        return state
+
+    def settle(self, item, owner, state, error):
+        with self.lock:
+            with self.conn:
+                return self.conn.execute(
+                    "UPDATE work SET state = ?, owner = NULL, "
+                    "lease_expires = NULL, error = ?, updated = ? "
+                    "WHERE item = ? AND owner = ? AND state = 'leased'",
+                    (state, error, self.clock(), item, owner)).rowcount == 1
+
+    """ Hands the leased items back at once, e.g. after a crash when no
+    other process works on the queue. With failed set, the failed items
+    are put back too, with their attempts reset. Returns how many. """
+    def release(self, failed=False):
+        with self.lock:
+            with self.conn:
+                released = self.conn.execute(
+                    "UPDATE work SET state = 'pending', owner = NULL, "
+                    "lease_expires = NULL, updated = ? "
+                    "WHERE state = 'leased'", (self.clock(),)).rowcount
+                if failed:
+                    released += self.conn.execute(
+                        "UPDATE work SET state = 'pending', attempts = 0, "
+                        "updated = ? WHERE state = 'failed'",
+                        (self.clock(),)).rowcount
+        return released
+
+    """ Number of items per state. """
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT state, COUNT(*) FROM work GROUP BY state").fetchall()
+        counts = dict.fromkeys(('pending', 'leased', 'done', 'failed'), 0)
+        counts.update(rows)
+        return counts
+
+    """ (item, attempts, error) of the failed items. """
+    def failures(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT item, attempts, error FROM work WHERE state = 'failed' "
+                "ORDER BY rowid").fetchall()
+
+""" Sort key ordering normalized records by filing date, then document ID.
+Dates are MM/DD/YYYY, so they are reordered to sort chronologically. """
+def record_sort_key(record):
+    date = record['date']
+    return (date[6:10] + date[0:2] + date[3:5], record['id'])
+
+""" Fetches APN detail pages with a bounded pool of worker threads. Each
+worker owns its own caller, since connections cannot be shared between
+CRIISCallers. """
+class APNFetchPool(object):
+    def __init__(self, concurrency=APN_FETCH_CONCURRENCY, max_retries=3,
+                 caller_factory=None):
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.caller_factory = caller_factory or CRIISCallerAPNQuery
+
+    """ Takes a list of (document id, date, APN url) jobs and returns the
+    page contents in the same order. Pages that could not be fetched after
+    max_retries attempts are None. on_page(idx, page) is called from the
+    worker thread as each page arrives. """
+    def fetch_all(self, apn_jobs, on_page=None):
+        self.start(on_page)
+        for job in apn_jobs:
+            self.submit(job)
+        return self.finish()
+
+    """ Starts a run whose jobs are not all known yet. submit() them as they
+    come in, then finish() waits for the lookups and returns the pages in
+    submission order, like fetch_all. """
+    def start(self, on_page=None):
+        self.work = Queue.Queue()
+        self.results = []
+        self.on_page = on_page
+        self.workers = []
+
+    """ Queues a job and returns its index in the results. Workers are
+    started as jobs arrive, up to concurrency of them. """
+    def submit(self, apn_job):
+        idx = len(self.results)
+        self.results.append(None)
+        self.work.put((idx, apn_job))
+        if len(self.workers) < self.concurrency:
+            worker = threading.Thread(target=self.run_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        return idx
+
+    def finish(self):
+        for worker in self.workers:
+            self.work.put(None)
+        for worker in self.workers:
+            worker.join()
+        return self.results
+
+    def run_worker(self):
+        caller = self.caller_factory()
+        try:
+            while True:
+                job = self.work.get()
+                if job is None:
+                    return
+                idx, (joinkey, date, apn_url) = job
+                logging.info("Looking up APNs for %s (%s)", joinkey, date)
+                page = self.fetch_with_retries(caller, apn_url)
+                self.results[idx] = page
+                if page is not None and self.on_page is not None:
+                    self.on_page(idx, page)
+        finally:
+            caller.close_connection()
+
+    def fetch_with_retries(self, caller, apn_url):
+        for retry in range(0, self.max_retries):
+            try:
+                return caller.fetch(apn_url)
+            except ArchiveMissException:
+                return None
             except DSException:
                 logging.error("Caught a DSException trying to fetch %s." % (
                         apn_url))
-                apn_query_caller.close_connection()
-                time.sleep(5)
-                apn_query_caller.create_connection()
-
-        apn_query_parser.feed(apn_list_html)
-        denorm_apn_records = apn_query_parser.get_records()
-        reel_image = list()
-        apns = list()
-        for apn_joinkey, apn_record_rows in denorm_apn_records.iteritems():
-            if apn_joinkey != joinkey:
-                logging.warning("APN fetching resulted in conflicting "
-                                "document IDs: %s vs %s", joinkey, apn_joinkey)
-
-            for apn_row in apn_record_rows:
-                reel = apn_row.get('Reel','')
-                image = apn_row.get('Image','')
-                if reel and image:
-                    normalized_record['reel_image'].append(reel + ',' + image)
-                normalized_record['apn'] += apn_row.get('APN','').split(
-                    MULTILINE_WORKAROUND_KEY)
-
-        normalized_record['reel_image'] = list(set(normalized_record['reel_image']))
-        normalized_record['apn'] = list(set(normalized_record['apn']))
-        normalized_records.append(normalized_record)
-    return normalized_records
+                if retry + 1 >= self.max_retries or \
+                        not CRIISCaller.retry_budget.try_retry():
+                    break
+                METRICS.inc('criis_retries_total',
+                            caller=caller.__class__.__name__)
+                caller.reset_connection()
+                CRIISCaller.rate_controller.backoff(retry)
+        return None
+
+""" Parses result pages in worker processes, so parsing overlaps with the
+network waits of the fetching threads instead of taking turns with them for
+the GIL. A worker parses one page at a time; fetchers that find every worker
+busy block in acquire() until one is free, and a streamed page that outruns
+its worker blocks on the worker's bounded chunk queue. The workers are
+forked, so create the pool before starting any threads. """
+class ParseWorkerPool(object):
+    def __init__(self, processes, queue_chunks=PARSE_QUEUE_CHUNKS):
+        self.workers = [ParseWorker(queue_chunks)
+                        for i in range(max(1, processes))]
+        self.idle = Queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def acquire(self):
+        wait_start = time.time()
+        worker = self.idle.get()
+        METRICS.observe('parse_worker_wait_seconds', time.time() - wait_start)
+        return worker
+
+    def release(self, worker):
+        self.idle.put(worker)
+
+    """ Parses a whole page like parse_page() and returns its records. """
+    def parse_page(self, parser_class, page):
+        worker = self.acquire()
+        try:
+            return worker.parse_page(parser_class, page)
+        finally:
+            self.release(worker)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+""" One parser process and the queues to it: requests (bounded, so a page
+cannot be queued much further ahead than it is parsed) and results. """
+class ParseWorker(object):
+    def __init__(self, queue_chunks=PARSE_QUEUE_CHUNKS):
+        self.requests = multiprocessing.Queue(queue_chunks)
+        self.results = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=run_parse_worker, args=(self.requests, self.results))
+        self.process.daemon = True
+        self.process.start()
+
+    def parse_page(self, parser_class, page):
+        self.requests.put(('page', parser_class, PARSER_ENGINE, page))
+        message = self.receive()
+        if message[0] == 'error':
+            raise ParseWorkerException(message[1])
+        METRICS.merge(message[2])
+        return message[1]
+
+    """ Returns the next result message. Raises ParseWorkerException if the
+    process died instead. """
+    def receive(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except Queue.Empty:
+                if not self.process.is_alive():
+                    raise ParseWorkerException(
+                        "Parse worker %d exited with %s" % (
+                            self.process.pid, self.process.exitcode))
+
+    def stop(self):
+        if self.process.is_alive():
+            self.requests.put(('stop',))
+        self.process.join()
+
+""" Raised when a parse worker failed to parse a page, or died. """
+class ParseWorkerException(Exception):
+    pass
+
+""" Main loop of a parse worker process. Requests are
+  ('page', parser class, engine, page)  parse a whole page, answered with
+                                        ('records', records, metrics)
+  ('begin', parser class, engine)       start a streamed page
+  ('chunk', chunk)                      answered with ('groups', completed
+                                        groups, report pages)
+  ('end',)                              answered with the last groups and
+                                        ('done', metrics)
+  ('abort',)                            drop the page, answered ('aborted',)
+  ('stop',)
+Records and rows come back as plain dicts, with the worker's METRICS since
+the last answer. A failed page is answered with ('error', message), and
+the chunks after it are ignored until its end or abort. """
+def run_parse_worker(requests, results):
+    # The counts of the parent at fork time are not this process's.
+    METRICS.reset()
+    parser = None
+    while True:
+        message = requests.get()
+        kind = message[0]
+        try:
+            if kind == 'stop':
+                return
+            elif kind == 'page':
+                parser = message[1](message[2])
+                parser.feed(message[3])
+                records = dict((joinkey, plain_rows(rows)) for joinkey, rows
+                               in parser.get_records().iteritems())
+                parser = None
+                results.put(('records', records,
+                             METRICS.snapshot(reset=True)))
+            elif kind == 'begin':
+                parser = message[1](message[2])
+                parser.begin_stream()
+            elif kind == 'chunk':
+                if parser is not None:
+                    parser.feed_chunk(message[1])
+                    results.put(('groups', plain_groups(parser),
+                                 parser.report_pages))
+            elif kind == 'end' and parser is not None:
+                parser.end_stream()
+                results.put(('groups', plain_groups(parser),
+                             parser.report_pages))
+                parser = None
+                results.put(('done', METRICS.snapshot(reset=True)))
+            else:
+                parser = None
+                results.put(('aborted',))
+        except Exception, e:
+            logging.error("Parse worker failed: %s", traceback.format_exc())
+            parser = None
+            results.put(('error', "%s: %s" % (e.__class__.__name__, e)))
+
+def plain_rows(rows):
+    return [row.to_dict() for row in rows]
+
+def plain_groups(parser):
+    return [(joinkey, plain_rows(rows))
+            for joinkey, rows in parser.pop_completed_records()]
+
+""" Stands in for a parser_class parser whose parse_stream() runs in a parse
+worker. It yields the same (joinkey, rows) groups and keeps report_pages up
+to date. A reader thread pulls the chunks off the network and queues them
+for the worker, so the page keeps downloading while the worker parses what
+already arrived and the groups it completed are being looked up. """
+class WorkerStreamParser(object):
+    def __init__(self, parser_class, pool):
+        self.parser_class = parser_class
+        self.pool = pool
+        self.report_pages = None
+
+    """ Yields the groups of the page read from chunks. Errors reading the
+    chunks are raised here once the worker dropped the page, after the
+    groups completed before them, as with a parser in this thread. """
+    def parse_stream(self, chunks):
+        worker = self.pool.acquire()
+        self.cancelled = threading.Event()
+        self.read_error = None
+        parse_error = None
+        finished = False
+        worker.requests.put(('begin', self.parser_class, PARSER_ENGINE))
+        reader = threading.Thread(target=self.read_chunks,
+                                  args=(chunks, worker))
+        reader.daemon = True
+        reader.start()
+        try:
+            while not finished:
+                message = worker.receive()
+                if message[0] == 'groups':
+                    self.report_pages = message[2]
+                    if parse_error is None:
+                        for group in message[1]:
+                            yield group
+                elif message[0] == 'error':
+                    parse_error = ParseWorkerException(message[1])
+                    self.cancelled.set()
+                elif message[0] == 'done':
+                    METRICS.merge(message[1])
+                    finished = True
+                elif message[0] == 'aborted':
+                    finished = True
+                    if parse_error is None:
+                        parse_error = self.read_error
+        finally:
+            if not finished:
+                # The caller stopped early: have the worker drop the page.
+                self.cancelled.set()
+                while worker.receive()[0] not in ('done', 'aborted'):
+                    pass
+            reader.join()
+            self.pool.release(worker)
+        if parse_error is not None:
+            raise parse_error
+
+    def read_chunks(self, chunks, worker):
+        try:
+            for chunk in chunks:
+                if self.cancelled.is_set():
+                    break
+                worker.requests.put(('chunk', chunk))
+            else:
+                worker.requests.put(('end',))
+                return
+        except Exception, e:
+            self.read_error = e
+        worker.requests.put(('abort',))
+
+""" Starts the ParseWorkerPool of processes workers that result pages are
+parsed in from then on. """
+def start_parse_workers(processes):
+    global PARSE_WORKERS
+    PARSE_WORKERS = ParseWorkerPool(processes)
+    return PARSE_WORKERS
+
+def stop_parse_workers():
+    global PARSE_WORKERS
+    if PARSE_WORKERS is not None:
+        PARSE_WORKERS.stop()
+        PARSE_WORKERS = None
 
 """ The system we're calling was built in the 90s, so it sometimes has
 issues. This exception indicates a recoverable failure from criis.com. """
@@ -126,6 +1156,475 @@ class DSException(Exception):
         logging.error(value)
         Exception.__init__(self, value)
 
+""" Raised when replaying from a ResponseArchive that lacks a page. Retrying
+cannot help, so callers give up on the page immediately. """
+class ArchiveMissException(DSException):
+    pass
+
+""" Raised when a date query's report has more pages than the caller allows,
+so it can retry with a shorter date range. Not a DSException: the server is
+fine, and retrying the same query would not help. """
+class ReportTooLargeException(Exception):
+    def __init__(self, start_date, end_date, report_pages):
+        Exception.__init__(self, "Report for %s to %s has %d pages" % (
+                start_date, end_date, report_pages))
+        self.report_pages = report_pages
+
+""" On-disk archive of the raw pages returned by call_criis_with_redirection,
+keyed by a hash of the request (URL plus normalized form parameters). Pages
+are stored gzipped. Reads refresh a page's file mtime, and the least recently
+used pages are evicted once the archive grows past max_bytes. Pages fetched
+more than max_age_days ago (per the gzip header) count as misses, so recent
+documents whose reel/image was still blank get refetched. With offline set,
+every archived page is served regardless of age and misses raise
+ArchiveMissException instead of going to the network. """
+class ResponseArchive(object):
+    def __init__(self, path, max_bytes=2 * 1024 ** 3, max_age_days=None,
+                 offline=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.offline = offline
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.size_bytes = sum(entry[1] for entry in self.entries())
+
+    @staticmethod
+    def request_key(url, params):
+        params = urllib.urlencode(sorted(urlparse.parse_qsl(
+                    params or "", keep_blank_values=True)))
+        return hashlib.sha1(url + "?" + params).hexdigest()
+
+    def path_for_key(self, key):
+        return os.path.join(self.path, key[0:2], key + ".html.gz")
+
+    """ Returns the archived page for the request, or None. """
+    def get(self, url, params):
+        page_path = self.path_for_key(ResponseArchive.request_key(url, params))
+        try:
+            f = gzip.open(page_path, 'rb')
+            try:
+                page = f.read()
+                fetched_at = f.mtime
+            finally:
+                f.close()
+            os.utime(page_path, None)
+        except (IOError, OSError):
+            if self.offline:
+                raise ArchiveMissException(
+                    "Replay archive has no page for %s?%s" % (url, params))
+            return None
+        if not self.offline and self.max_age_days is not None and \
+                time.time() - fetched_at > self.max_age_days * 86400:
+            return None
+        return page
+
+    def put(self, url, params, page):
+        key = ResponseArchive.request_key(url, params)
+        page_path = self.path_for_key(key)
+        if not os.path.isdir(os.path.dirname(page_path)):
+            try:
+                os.makedirs(os.path.dirname(page_path))
+            except OSError:
+                pass  # Created by another thread.
+        tmp_path = "%s.%d.%d.tmp" % (page_path, os.getpid(),
+                                     threading.current_thread().ident)
+        f = gzip.open(tmp_path, 'wb')
+        try:
+            f.write(page)
+        finally:
+            f.close()
+        with self.lock:
+            # Archiving a page again replaces its file.
+            replaced = 0
+            if os.path.exists(page_path):
+                replaced = os.path.getsize(page_path)
+            os.rename(tmp_path, page_path)
+            self.size_bytes += os.path.getsize(page_path) - replaced
+            if self.size_bytes > self.max_bytes:
+                self.evict()
+
+    """ Lists (mtime, size, path) for every archived page. """
+    def entries(self):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                if not filename.endswith(".html.gz"):
+                    continue
+                page_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(page_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, page_path))
+        return entries
+
+    """ Drops the least recently used pages until the archive is back under
+    90% of max_bytes. Call with the lock held. """
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(entry[1] for entry in entries)
+        evicted = 0
+        for mtime, size, page_path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(page_path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        self.size_bytes = total
+        logging.info("Evicted %d pages from the response archive.", evicted)
+
+""" Paces the requests of all CRIISCallers. This is a token bucket whose
+refill rate follows the server: it grows additively while responses come
+back quickly and is cut multiplicatively on timeouts or when the average
+latency exceeds target_latency. Failed calls wait for a jittered,
+exponentially growing backoff. Thread-safe, so one instance can be shared
+by every caller. If a SharedRequestBudget is set as budget, requests also
+wait for a slot in that cross-process budget. """
+class RateController(object):
+    def __init__(self, rate=1000.0 / SLEEP_THROTTLE, min_rate=0.2,
+                 max_rate=20.0, burst=1.0, increase=0.05, decrease=0.5,
+                 target_latency=2.0, base_backoff=1.0, max_backoff=60.0):
+        self.rate = rate  # requests per second
+        self.min_rate = min_rate
+        self.configured_min_rate = min_rate  # restored by set_max_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = time.time
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = self.clock()
+        self.last_decrease = 0
+        self.latency = None  # moving average, seconds
+        self.timeout_rate = 0.0  # moving average of failed calls
+        self.budget = None
+
+    """ Takes a token and returns the seconds to wait before using it. """
+    def reserve(self):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+        if self.budget is not None:
+            wait = max(wait, self.budget.reserve())
+        return wait
+
+    """ Blocks until the next request may be sent. Returns the time slept. """
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            METRICS.inc('throttle_sleep_seconds_total', wait)
+            time.sleep(wait)
+        return wait
+
+    """ Moves the ceiling of the rate, e.g. for the hours of a schedule.
+    The rate drops to the new ceiling at once but only climbs up to it as
+    requests succeed. The floor drops with a ceiling below it, and goes back
+    to the configured min_rate once the ceiling is raised again. """
+    def set_max_rate(self, max_rate):
+        with self.lock:
+            self.max_rate = max_rate
+            self.min_rate = min(self.configured_min_rate, max_rate)
+            self.rate = max(self.min_rate, min(self.rate, max_rate))
+
+    def record_success(self, latency):
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            self.timeout_rate *= 0.9
+            if self.latency > self.target_latency:
+                self.slow_down()
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def record_failure(self):
+        with self.lock:
+            self.timeout_rate = 0.9 * self.timeout_rate + 0.1
+            self.slow_down()
+
+    """ Multiplicative decrease, at most once per request interval so a burst
+    of concurrent timeouts only counts once. Call with the lock held. """
+    def slow_down(self):
+        now = self.clock()
+        if now - self.last_decrease < 1.0 / self.rate:
+            return
+        self.last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        logging.info("Slowing down to %.2f requests/s (latency %.2fs, "
+                     "timeout rate %.2f)", self.rate, self.latency or 0,
+                     self.timeout_rate)
+
+    """ Seconds to wait before retry number attempt (counting from 0). """
+    def backoff_delay(self, attempt):
+        delay = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def backoff(self, attempt):
+        sleep_sec = self.backoff_delay(attempt)
+        logging.error("Retrying in %2.2f seconds", sleep_sec)
+        METRICS.inc('backoff_sleep_seconds_total', sleep_sec)
+        time.sleep(sleep_sec)
+        return sleep_sec
+
+""" Caps the retries of all callers at a share of the requests they send.
+Every request adds ratio to the balance and every retry takes one from it,
+so however deeply retry loops are nested, at most about one call in
+1 / ratio is a retry. The balance starts at (and is capped at) max_balance,
+which lets the first failures of a run retry right away. """
+class RetryBudget(object):
+    def __init__(self, ratio=0.2, max_balance=20.0):
+        self.ratio = ratio
+        self.max_balance = max_balance
+        self.balance = max_balance
+        self.lock = threading.Lock()
+
+    def record_request(self):
+        with self.lock:
+            self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    """ Takes a retry from the budget. Returns False if it is used up. """
+    def try_retry(self):
+        with self.lock:
+            if self.balance < 1:
+                METRICS.inc('retry_budget_exhausted_total')
+                return False
+            self.balance -= 1
+            return True
+
+""" Pauses every caller once the server looks down. After
+failure_threshold failed calls in a row the circuit opens, and no request
+is sent for cooldown seconds. Then one caller gets to probe: if its call
+succeeds the circuit closes, if it fails the circuit opens again for twice
+as long (up to max_cooldown). A probe that reports neither within
+cooldown seconds is replaced by the next caller. """
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold=8, cooldown=30.0, max_cooldown=600.0,
+                 probe_poll=1.0):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_poll = probe_poll  # seconds between checks on a probe
+        self.clock = time.time
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0  # in a row
+        self.opened_at = None
+        self.probe_started = None
+
+    """ Returns the seconds to wait before checking again, or 0 if a request
+    may be sent now. """
+    def delay(self):
+        with self.lock:
+            if self.state == 'closed':
+                return 0.0
+            now = self.clock()
+            if self.state == 'open':
+                reopen = self.opened_at + self.cooldown
+                if now < reopen:
+                    return reopen - now
+                self.state = 'half_open'
+                self.probe_started = now
+                logging.info("Circuit half open, probing %s",
+                             CRIISCaller.website)
+                return 0.0
+            if now - self.probe_started > self.cooldown:
+                self.probe_started = now
+                return 0.0
+            return self.probe_poll
+
+    """ Blocks while the circuit is open. Returns the time slept. """
+    def wait(self):
+        waited = 0.0
+        pause = self.delay()
+        while pause > 0:
+            METRICS.inc('circuit_wait_seconds_total', pause)
+            time.sleep(pause)
+            waited += pause
+            pause = self.delay()
+        return waited
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != 'closed':
+                logging.info("Circuit closed, %s answers again",
+                             CRIISCaller.website)
+                self.state = 'closed'
+                self.cooldown = self.base_cooldown
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open':
+                self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+                self.open()
+            elif self.state == 'closed' and \
+                    self.failures >= self.failure_threshold:
+                self.open()
+
+    """ Call with the lock held. """
+    def open(self):
+        self.state = 'open'
+        self.opened_at = self.clock()
+        METRICS.inc('circuit_opened_total')
+        logging.error("%d failed calls in a row, pausing all calls for "
+                      "%.0f seconds", self.failures, self.cooldown)
+
+""" A requests-per-second budget shared by several processes. Each request
+reserves the next free slot, and slots are spaced 1/rate seconds apart.
+Create it before forking the workers (it lives in shared memory) and hand it
+to each worker's RateController. """
+class SharedRequestBudget(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_slot = multiprocessing.Value('d', 0.0)
+
+    """ Reserves a slot and returns the seconds to wait for it. """
+    def reserve(self):
+        with self.next_slot.get_lock():
+            now = time.time()
+            slot = max(now, self.next_slot.value)
+            self.next_slot.value = slot + 1.0 / self.rate
+        return slot - now
+
+""" A keep-alive HTTP connection to CRIIS and its reuse counters. It
+outlives the callers that use it: they check it out of a CRIISSessionPool
+and return it when done, so the next day's queries go out on the same
+connection. httplib reopens the connection by itself when the server closed
+it after a response. """
+class CRIISSession(object):
+    def __init__(self, website, timeout=10):
+        self.website = website
+        self.timeout = timeout
+        self.conn = None
+        self.response = None  # the last response, which may be unread
+        self.connections = 0  # TCP connections opened
+        self.requests = 0
+        self.reused = 0  # requests sent on an already open connection
+        self.wire_bytes = 0  # response bytes as transferred
+        self.page_bytes = 0  # response bytes after decoding
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(self.website,
+                                               timeout=self.timeout)
+        return self.conn
+
+    def is_open(self):
+        return self.conn is not None and self.conn.sock is not None
+
+    """ Counts a request about to be sent. Returns whether it goes out on
+    an open connection. """
+    def count_request(self):
+        reused = self.is_open()
+        self.requests += 1
+        if reused:
+            self.reused += 1
+            METRICS.inc('criis_connection_reuses_total')
+        else:
+            self.connections += 1
+            METRICS.inc('criis_connections_total')
+        return reused
+
+    def count_bytes(self, wire_bytes, page_bytes):
+        self.wire_bytes += wire_bytes
+        self.page_bytes += page_bytes
+        METRICS.inc('criis_wire_bytes_total', wire_bytes)
+        METRICS.inc('criis_page_bytes_total', page_bytes)
+
+    """ Whether the connection can take another request: a response that
+    was not read to the end leaves it unusable. """
+    def is_idle(self):
+        return self.response is None or self.response.isclosed()
+
+    """ Drops the connection, e.g. after a failure. The next request opens a
+    new one. """
+    def reset(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+        self.response = None
+
+""" The CRIISSessions of a process, checked out by one caller at a time
+since a connection cannot be shared concurrently. """
+class CRIISSessionPool(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = dict()  # website -> idle sessions
+        self.sessions = []  # every session, for stats()
+
+    def checkout(self, website):
+        with self.lock:
+            idle = self.idle.get(website)
+            if idle:
+                return idle.pop()
+            session = CRIISSession(website)
+            self.sessions.append(session)
+            return session
+
+    def checkin(self, session):
+        if not session.is_idle():
+            session.reset()
+        with self.lock:
+            self.idle.setdefault(session.website, []).append(session)
+
+    """ Totals of the sessions' counters, with the share of requests that
+    reused a connection and the compression ratio of the responses. """
+    def stats(self):
+        with self.lock:
+            sessions = list(self.sessions)
+        stats = dict((name, sum(getattr(session, name)
+                                for session in sessions))
+                     for name in ('connections', 'requests', 'reused',
+                                  'wire_bytes', 'page_bytes'))
+        stats['sessions'] = len(sessions)
+        stats['reuse_ratio'] = stats['reused'] / float(
+            max(1, stats['requests']))
+        stats['compression_ratio'] = stats['wire_bytes'] / float(
+            max(1, stats['page_bytes']))
+        return stats
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions, self.idle = self.sessions, [], dict()
+        for session in sessions:
+            session.reset()
+
+""" Decodes a response body sent with Content-Encoding: gzip, piece by
+piece. Bodies without it pass through. """
+class ResponseDecoder(object):
+    def __init__(self, response):
+        self.decompressor = None
+        if (response.getheader('Content-Encoding') or "").lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decode(self, data):
+        if self.decompressor is None:
+            return data
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        if self.decompressor is None:
+            return ""
+        return self.decompressor.flush()
+
 RECORD_TYPES = {
     "DEED" : "001",
     "DEED_OF_TRUST" : "002",
@@ -140,61 +1639,218 @@ Note that the http_connection cannot be shared concurrently between two
 CRIISCallers.
 """
 class CRIISCaller(object):
-    website = 'www.criis.com'
+    website = CRIIS_WEBSITE
+    sessions = CRIISSessionPool()
+    rate_controller = RateController()
+    retry_budget = RetryBudget()
+    circuit_breaker = CircuitBreaker()
+    archive = None  # ResponseArchive shared by all callers, if any
 
     def __init__(self):
-        self.conn = None
+        self.session = None
+        self.request_sent_at = time.time()
+        self.request_method = None
         self.create_connection()
         self.default_headers = {
             'Content-type': 'application/x-www-form-urlencoded', 
             'Accept':       'text/html',
+            'Accept-Encoding': 'gzip',
             'User-Agent':   'sararcher@outlook.com'
         }
 
     def __del__(self):
         self.close_connection()
 
+    """ Checks a session out of the shared pool, reusing its connection if
+    it has one open. """
     def create_connection(self):
         self.close_connection()
-        self.conn = httplib.HTTPConnection(self.website, timeout=10)    
-        logging.info('Connection to %s opened.', self.website)
+        self.session = self.sessions.checkout(self.website)
 
-    """ Call this when you're done with the object so we don't keep
-    unused open HTTP connections."""
+    """ Call this when you're done with the object. The session goes back
+    to the pool, its connection open for the next caller. """
     def close_connection(self):
-        if (self.conn != None):
-            self.conn.close()
-        self.conn = None
+        if self.session is not None:
+            self.sessions.checkin(self.session)
+        self.session = None
+
+    """ Drops the connection after a failure, so the next request opens a
+    new one. """
+    def reset_connection(self):
+        if self.session is None:
+            self.create_connection()
+        else:
+            self.session.reset()
 
-    """ Returns string contents of the page. """
+    @property
+    def conn(self):
+        return self.session.connection()
+
+    """ Returns string contents of the page, from the archive if it has it. """
     def call_criis_with_redirection(self, url, params, headers=None):
+        if self.archive is not None:
+            page = self.archive.get(url, params)
+            if page is not None:
+                return page
+        page = self.fetch_with_redirection(url, params, headers)
+        if self.archive is not None:
+            self.archive.put(url, params, page)
+        return page
+
+    """ Like call_criis_with_redirection, but yields the page in chunks as
+    they are read from the connection. """
+    def stream_criis_with_redirection(self, url, params, headers=None):
+        if self.archive is not None:
+            page = self.archive.get(url, params)
+            if page is not None:
+                yield page
+                return
+        response = self.open_with_redirection(url, params, headers)
+        decoder = ResponseDecoder(response)
+        # Only the archive needs the whole page.
+        chunks = [] if self.archive is not None else None
+        read_seconds = 0.0
+        while True:
+            read_start = time.time()
+            try:
+                data = response.read(STREAM_CHUNK_BYTES)
+                chunk = decoder.decode(data) if data else decoder.flush()
+            except (socket.error, httplib.HTTPException, zlib.error), e:
+                self.count_failure('read', e)
+                raise DSException("Failed to read %s: %s" % (url, str(e)))
+            read_seconds += time.time() - read_start
+            self.session.count_bytes(len(data), len(chunk))
+            if not data:
+                self.observe_phase('GET', 'read', read_seconds)
+                if chunk:
+                    if chunks is not None:
+                        chunks.append(chunk)
+                    yield chunk
+                break
+            if not chunk:
+                continue
+            if chunks is not None:
+                chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            self.archive.put(url, params, "".join(chunks))
+
+    def fetch_with_redirection(self, url, params, headers=None):
+        response = self.open_with_redirection(url, params, headers)
+        decoder = ResponseDecoder(response)
+        read_start = time.time()
+        try:
+            data = response.read()
+            page = decoder.decode(data) + decoder.flush()
+        except (socket.error, httplib.HTTPException, zlib.error), e:
+            self.count_failure('read', e)
+            raise DSException("Failed to read %s: %s" % (url, str(e)))
+        self.observe_phase('GET', 'read', time.time() - read_start)
+        self.session.count_bytes(len(data), len(page))
+        return page
+
+    """ Records the seconds a phase (send, response or read) of a request
+    took. """
+    def observe_phase(self, method, phase, seconds):
+        METRICS.observe('criis_http_seconds', seconds,
+                        caller=self.__class__.__name__, method=method,
+                        phase=phase)
+
+    """ Counts a failed phase of a request and tells the rate controller. """
+    def count_failure(self, phase, error):
+        kind = 'timeout' if isinstance(error, socket.timeout) else 'error'
+        METRICS.inc('criis_failures_total', caller=self.__class__.__name__,
+                    phase=phase, kind=kind)
+        self.rate_controller.record_failure()
+        self.circuit_breaker.record_failure()
+
+    """ Takes a retry from the shared retry budget, or raises a DSException
+    if it is used up. """
+    def take_retry(self, error):
+        if not self.retry_budget.try_retry():
+            raise DSException("Retry budget exhausted, giving up after: %s"
+                              % str(error))
+
+    """ Posts the query and follows the redirect to the results page.
+    Returns the results response, with its body still unread. """
+    def open_with_redirection(self, url, params, headers=None):
         if not headers:
             headers = self.default_headers
-        self.call_http_with_retries('POST', url, params, headers)
-        response = self.get_response_with_retries()
-        if response.status != 302:
-            raise DSException('No redirect returned.') 
+        response = self.call_http('POST', url, params, headers)
+        # Read the (empty) redirect body, or the connection cannot take the
+        # GET.
+        self.read_redirect_body(response)
+        self.check_status(response, 302, 'No redirect returned.')
 
         redirect_url = response.getheader('Location')
-        self.call_http_with_retries('GET', redirect_url)
-        response = self.get_response_with_retries()
-        if response.status != 200:
-            raise DSException('Post-redirect page fetching failed.') 
-        return response.read()
-
-    # TODO: Refactor to avoid duplicating sleep logic and constants.
-    def get_response_with_retries(self):
-        sleep_per_retry_ms = 2000
+        response = self.call_http('GET', redirect_url, None, headers)
+        self.check_status(response, 200, 'Post-redirect page fetching failed.')
+        return response
+
+    """ Counts a response with another status than expected (a 500, say) as
+    a failed call, and raises DSException(message) for it. Only a response
+    with the expected status tells the rate controller and the circuit
+    breaker the server is well. """
+    def check_status(self, response, expected, message):
+        if response.status != expected:
+            error = DSException("%s (HTTP %d)" % (message, response.status))
+            self.count_failure('status', error)
+            raise error
+        self.rate_controller.record_success(self.response_latency)
+        self.circuit_breaker.record_success()
+
+    def read_redirect_body(self, response):
+        try:
+            response.read()
+        except (socket.error, httplib.HTTPException), e:
+            self.count_failure('read', e)
+            raise DSException("Failed to read redirect: %s" % str(e))
+
+    """ Sends a request and returns its response. If the server closed a
+    reused keep-alive connection before answering, the request is sent
+    once more on a new connection. """
+    def call_http(self, req_type, url, params=None, headers=None):
+        for attempt in range(2):
+            reused = self.session.count_request()
+            self.call_http_with_retries(req_type, url, params, headers)
+            response = self.get_response_with_retries(reused)
+            if response is not None:
+                self.session.response = response
+                return response
+            METRICS.inc('criis_stale_connections_total')
+            self.reset_connection()
+        raise DSException("Connection to %s closed before answering" % (
+                self.website))
+
+    """ Waits for the response to the request just sent, retrying on
+    timeouts. Returns None if the request went out on a reused
+    connection (reused) that the server had closed. """
+    def get_response_with_retries(self, reused=False):
         max_retries = 5
         for retry in range(0, max_retries):
             try:
-                return self.conn.getresponse()
+                response = self.conn.getresponse()
+                latency = time.time() - self.request_sent_at
+                # Counted as a success by check_status, once its status
+                # is known to be the expected one.
+                self.response_latency = latency
+                self.observe_phase(self.request_method, 'response', latency)
+                return response
             except socket.timeout, e:
                 logging.error('Timeout #%d: %s', retry+1, str(e))
                 logging.info(traceback.format_exc())
-                sleep_sec = sleep_per_retry_ms / 1000.0
-                logging.error("Retrying in %f seconds", sleep_sec)
-                time.sleep(sleep_sec)
+                self.count_failure('response', e)
+                self.take_retry(e)
+                self.rate_controller.backoff(retry)
+            except (socket.error, httplib.HTTPException), e:
+                # The connection is gone, so the request has to be resent.
+                if reused and retry == 0:
+                    logging.info("Reused connection to %s was closed: %s",
+                                 self.website, str(e))
+                    return None
+                self.count_failure('response', e)
+                raise DSException("Connection to %s failed: %s" % (
+                        self.website, str(e)))
 
         raise DSException(
             "Failed to getresponse after %d attempts. Bailing." % max_retries)
@@ -203,23 +1859,33 @@ class CRIISCaller(object):
     def call_http_with_retries(self, req_type, url, params=None, headers=None):
         if not params:
             params = ""
+        # httplib only sends a str body in the same packet as the headers.
+        # Sent apart, the body waits for the server's delayed ACK of the
+        # headers on a reused connection.
+        if isinstance(params, unicode):
+            params = params.encode('utf-8')
         if not headers:
             headers = self.default_headers
-        additional_sleep_per_retry_ms = 3000
         max_retries = 10
         # Pour one out for the underprovisioned homies.
-        time.sleep(SLEEP_THROTTLE/1000.0)
+        self.circuit_breaker.wait()
+        self.rate_controller.acquire()
+        self.retry_budget.record_request()
         for retry in range(0, max_retries):
             try:
+                self.request_sent_at = time.time()
+                self.request_method = req_type
                 self.conn.request(req_type, url, params, headers)
+                self.observe_phase(req_type, 'send',
+                                   time.time() - self.request_sent_at)
                 return
-            except socket.timeout, e:
-                logging.error('Timeout #%d: %s', retry+1, str(e))
+            except (socket.error, httplib.HTTPException), e:
+                logging.error('Request failure #%d: %s', retry+1, str(e))
                 logging.info(traceback.format_exc())
-                sleep_sec = (retry + 1) * additional_sleep_per_retry_ms / 1000.0
-                logging.error("Retrying in %2.2f seconds")
-                time.sleep(sleep_sec)
-                self.create_connection()
+                self.count_failure('send', e)
+                self.take_retry(e)
+                self.rate_controller.backoff(retry)
+                self.reset_connection()
         raise DSException(
             "Failed to call %s after %d attempts. Bailing." % (url,max_retries))
 
@@ -229,7 +1895,20 @@ class CRIISCallerDateQuery(CRIISCaller):
         CRIISCaller.__init__(self)
 
     def fetch(self, date_start, date_end, doc_type="001"):
-        params = urllib.urlencode({
+        return self.call_criis_with_redirection(
+            "/cgi-bin/new_get_recorded.cgi",
+            CRIISCallerDateQuery.build_params(date_start, date_end, doc_type))
+
+    """ Like fetch, but yields the page in chunks as it arrives. """
+    def stream(self, date_start, date_end, doc_type="001"):
+        return self.stream_criis_with_redirection(
+            "/cgi-bin/new_get_recorded.cgi",
+            CRIISCallerDateQuery.build_params(date_start, date_end, doc_type))
+
+    """ Form parameters of a date-range query. """
+    @staticmethod
+    def build_params(date_start, date_end, doc_type="001"):
+        return urllib.urlencode({
                 'DOC_TYPE': doc_type,
                 'doc_dateA': date_start,
                 'doc_dateB': date_end,
@@ -242,27 +1921,98 @@ class CRIISCallerDateQuery(CRIISCaller):
                 'SCREEN_RETURN_NAME': 'Recorded Document Search',
                 })
 
-        return self.call_criis_with_redirection(
-            "/cgi-bin/new_get_recorded.cgi", params)
+""" Issues a block/lot query to CRIIS. Its results page is taken to list
+the documents filed against the parcel in the table layout of a date
+query's results (see BLOCKLOT_FORM_VERIFIED). """
+class CRIISCallerBlockLotQuery(CRIISCaller):
+    def __init__(self):
+        CRIISCaller.__init__(self)
+
+    def stream(self, block, lot):
+        return self.stream_criis_with_redirection(
+            "/cgi-bin/new_get_recorded.cgi",
+            CRIISCallerBlockLotQuery.build_params(block, lot))
+
+    """ Form parameters of a block/lot query. """
+    @staticmethod
+    def build_params(block, lot):
+        return urllib.urlencode({
+                'APN_BLOCK': block,
+                'APN_LOT': lot,
+                'SEARCH_TYPE': 'APN',
+                'COUNTY':       'sanfrancisco',
+                'YEARSEGMENT':  'current',
+                'ORDER_TYPE':   'Recorded Official',
+                'LAST_RECORD': '1',
+                'SCREENRETURN': 'apn_search.cgi',
+                'SCREEN_RETURN_NAME': 'Block and Lot Search',
+                })
 
 class CRIISCallerAPNQuery(CRIISCaller):
     def __init__(self):
         CRIISCaller.__init__(self)
 
     def fetch(self, apn_url):
-        if "?" not in apn_url:
-            raise DSException("Malformed APN Url: %s", apn_url)
-        url, params = apn_url.split("?")
+        url, params = CRIISCallerAPNQuery.split_apn_url(apn_url)
         return self.call_criis_with_redirection(url, params)
 
+    """ Splits an APNLink into the CGI path and its form parameters. """
+    @staticmethod
+    def split_apn_url(apn_url):
+        if "?" not in apn_url:
+            raise DSException("Malformed APN Url: %s" % apn_url)
+        return apn_url.split("?", 1)
+
 #
 # HTML Parsers
 #
 
-""" Base class of a parser of city records served via criis.com HTML pages. """
+# CyberQuery splits long reports into pages (anchors within the one results
+# page) and announces their number in the page header.
+REPORT_PAGES_RE = re.compile(
+    r'<meta\s+name="CQCS-Report-Pages"\s+content="(\d+)"', re.I)
+
+# The APN detail link of a records row, which empty reports have none of.
+RECORDS_ROW_MARKER = "l_doc_ref_no="
+PAGE_END_RE = re.compile(r'</html>\s*$', re.I)
+
+# Tokens of the fast engine: tags, comments, char/entity refs and lone
+# ampersands, which HTMLParser hands to handle_data on their own.
+FAST_TOKEN_RE = re.compile(
+    r'<(/?)([a-zA-Z][^\s/>]*)([^>]*)>|<!--.*?-->'
+    r'|&#(?:[0-9]+|[xX][0-9a-fA-F]+);?|&[a-zA-Z][-.a-zA-Z0-9]*;?|&', re.S)
+# These three run on the lowercased page.
+FAST_TABLE_START_RE = re.compile(r'<table(?=[\s/>])([^>]*)>')
+FAST_TABLE_END_RE = re.compile(r'</\s*table\s*>')
+FAST_FONT_RE = re.compile(r'<(/?)font(?=[\s/>])([^>]*)>')
+FAST_ATTR_RE = re.compile(
+    r'([^\s/=>]+)(?:\s*=\s*(\'[^\']*\'|"[^"]*"|[^\s>]*))?')
+FAST_TR_END_RE = re.compile(r'</tr\s*>', re.I)
+# A records row in its usual shape: every cell is either empty or a single
+# font holding plain text, optionally wrapped in a link or bold tag. Rows
+# like this are handled in one regex match instead of tag by tag.
+FAST_CELL = (r'<td\b[^>]*>(?:(&nbsp;)|<font\b([^>]*)>'
+             r'(?:<a href="([^"]*)"[^>]*>|<b>)?([^<&]*)(?:</a>|</b>)?</font>)'
+             r'</td>')
+FAST_ROW_RE = re.compile(r'\s*<tr\b[^>]*>\s*((?:%s\s*)*)$' % FAST_CELL)
+FAST_CELL_RE = re.compile(FAST_CELL)
+FAST_START_TAGS = frozenset(('table', 'tr', 'td', 'font', 'a'))
+FAST_END_TAGS = frozenset(('table', 'tr', 'font'))
+FAST_ATTR_TAGS = frozenset(('table', 'font', 'a'))
+
+""" Base class of a parser of city records served via criis.com HTML pages.
+The 'fast' engine feeds the same handlers as HTMLParser would, but only
+tokenizes the records tables and skips the rest of the page. """
 class HTMLRecordsParser(HTMLParser):
-    def __init__(self):
+    # Whether the fast engine may match whole rows at once. That skips the
+    # data outside font tags, which handle_data ignores anyway.
+    fast_rows = True
+
+    def __init__(self, engine=None):
         HTMLParser.__init__(self)
+        self.engine = engine or PARSER_ENGINE
+        if self.engine not in PARSER_ENGINES:
+            raise ValueError("Unknown parser engine %s" % self.engine)
         self.in_records_table = False
         self.column = -1
         self.in_font = False
@@ -271,21 +2021,216 @@ class HTMLRecordsParser(HTMLParser):
         self.join_key = "Document"  # The column we join APNs and records on.
         self.is_apn = False
         self.column_to_field = dict()
+        self.href_cache = dict()
+        self.strings = StringInterner()
+        self.begin_stream()
 
     """ Process criis.com page content. Call get_records() after this. """
     def feed(self, pagecontent):
+        self.begin_stream()
+        self.feed_chunk(pagecontent)
+        self.end_stream()
+
+    """ Parses a page that arrives as an iterable of chunks. Yields each
+    (joinkey, rows) group of records as soon as a row of the next document
+    shows it is complete, so only the unfinished groups are held. """
+    def parse_stream(self, chunks):
+        self.begin_stream()
+        for chunk in chunks:
+            self.feed_chunk(chunk)
+            for group in self.pop_completed_records():
+                yield group
+        self.end_stream()
+        for group in self.pop_completed_records():
+            yield group
+
+    """ Resets the parser for a new page, to be passed to feed_chunk() piece
+    by piece and finished with end_stream(). """
+    def begin_stream(self):
         self.data = dict()
         self.records = dict()
-        data_trimmed = ""
-        # The criis.com header tags have broken html and no data, so we drop
-        # everything before the body tag.
-        for line in pagecontent.split("\n"):
-            if len(data_trimmed) == 0:
-                if "<body " not in line:
-                    continue
-                data_trimmed += "<html>\n"
-            data_trimmed += line + "\n"
-        HTMLParser.feed(self, data_trimmed)
+        self.stream_buffer = ""
+        self.in_body = False
+        self.last_joinkey = None
+        self.completed_joinkeys = []
+        # Number of report pages announced in the page header, if any.
+        self.report_pages = None
+        self.parse_seconds = 0.0
+        self.rows_parsed = 0
+
+    def feed_chunk(self, chunk):
+        parse_start = time.time()
+        try:
+            self.parse_chunk(chunk)
+        finally:
+            self.parse_seconds += time.time() - parse_start
+
+    def parse_chunk(self, chunk):
+        pending = self.stream_buffer + chunk
+        if not self.in_body:
+            # The criis.com header tags have broken html and no data, so we
+            # drop everything before the body tag.
+            body = pending.find("<body ")
+            if body < 0:
+                self.stream_buffer = pending
+                return
+            body = pending.rfind("\n", 0, body) + 1
+            report_pages = REPORT_PAGES_RE.search(pending, 0, body)
+            if report_pages:
+                self.report_pages = int(report_pages.group(1))
+            pending = "<html>\n" + pending[body:]
+            self.in_body = True
+        # Only parse up to the end of the last complete row. HTMLParser would
+        # otherwise split a cell's text at the chunk boundary.
+        cut = pending.lower().rfind("</tr>")
+        if cut < 0:
+            self.stream_buffer = pending
+            return
+        cut += len("</tr>")
+        self.stream_buffer = pending[cut:]
+        self.parse_complete_rows(pending[:cut])
+
+    def end_stream(self):
+        parse_start = time.time()
+        if self.in_body:
+            self.parse_complete_rows(self.stream_buffer + "\n")
+        self.stream_buffer = ""
+        self.flush_data_to_records()
+        if self.last_joinkey is not None:
+            self.completed_joinkeys.append(self.last_joinkey)
+            self.last_joinkey = None
+        self.parse_seconds += time.time() - parse_start
+        METRICS.observe('parse_seconds', self.parse_seconds,
+                        parser=self.__class__.__name__, engine=self.engine)
+        METRICS.inc('parsed_rows_total', self.rows_parsed,
+                    parser=self.__class__.__name__)
+
+    def parse_complete_rows(self, pagecontent):
+        if self.engine == 'fast':
+            self.feed_fast(pagecontent, 0)
+        else:
+            HTMLParser.feed(self, pagecontent)
+
+    """ Returns the (joinkey, rows) groups completed since the last call and
+    drops them from the records. """
+    def pop_completed_records(self):
+        groups = [(joinkey, self.records.pop(joinkey))
+                  for joinkey in self.completed_joinkeys
+                  if joinkey in self.records]
+        self.completed_joinkeys = []
+        return groups
+
+    """ Finds the records tables from pos on and tokenizes only those. Font
+    tags in between are still tracked, since in_font carries over. The page
+    may also be fed in pieces that end after a row. """
+    def feed_fast(self, pagecontent, pos):
+        # Tags are case-insensitive, attribute values are not: search the
+        # lowercased page, but read attributes from the original.
+        lowered = pagecontent.lower()
+        while True:
+            if self.in_records_table:
+                table_end = FAST_TABLE_END_RE.search(lowered, pos)
+                if table_end is None:
+                    self.feed_fast_region(pagecontent, pos, len(pagecontent))
+                    return
+                self.feed_fast_region(pagecontent, pos, table_end.start())
+                self.handle_endtag('table')
+                pos = table_end.end()
+            table = FAST_TABLE_START_RE.search(lowered, pos)
+            gap_end = table.start() if table else len(pagecontent)
+            for font in FAST_FONT_RE.finditer(lowered, pos, gap_end):
+                if font.group(1):
+                    self.handle_endtag('font')
+                else:
+                    self.handle_starttag('font', self.parse_attrs(
+                            pagecontent[font.start(2):font.end(2)]))
+            if table is None:
+                return
+            attrs = self.parse_attrs(pagecontent[table.start(1):table.end(1)])
+            pos = table.end()
+            if HTMLRecordsParser.get_attribute(attrs, 'class') == 'records':
+                self.handle_starttag('table', attrs)
+
+    """ Feeds one records table, row by row. """
+    def feed_fast_region(self, pagecontent, start, end):
+        if not self.fast_rows:
+            self.replay_events(pagecontent, start, end)
+            return
+        region = pagecontent[start:end]
+        if region.count('</tr>') == region.lower().count('</tr'):
+            pieces = region.split('</tr>')
+        else:
+            pieces = FAST_TR_END_RE.split(region)
+        for piece in pieces[:-1]:
+            if self.in_font or not self.feed_fast_row(piece):
+                self.replay_events(piece, 0, len(piece))
+            self.handle_endtag('tr')
+        self.replay_events(pieces[-1], 0, len(pieces[-1]))
+
+    """ Handles a row in its usual shape (see FAST_ROW_RE) with the same
+    effect as its tag events. Returns False for any other row. """
+    def feed_fast_row(self, piece):
+        row = FAST_ROW_RE.match(piece)
+        if row is None:
+            return False
+        self.column = -1
+        for nbsp, font_attrs, href, text in FAST_CELL_RE.findall(row.group(1)):
+            self.column += 1
+            if nbsp:
+                continue
+            if 'color' not in font_attrs or HTMLRecordsParser.get_attribute(
+                    self.parse_attrs(font_attrs), 'color') is None:
+                self.in_font = True
+            if href:
+                if href not in self.href_cache:
+                    self.href_cache[href] = self.unescape(href)
+                self.handle_starttag('a', [('href', self.href_cache[href])])
+            if text:
+                self.handle_data(text)
+            self.in_font = False
+        return True
+
+    """ Replays the HTMLParser events for pagecontent[start:end]. """
+    def replay_events(self, pagecontent, start, end):
+        pos = start
+        handle_data = self.handle_data
+        for token in FAST_TOKEN_RE.finditer(pagecontent, start, end):
+            if token.start() > pos:
+                handle_data(pagecontent[pos:token.start()])
+            pos = token.end()
+            tag = token.group(2)
+            if tag is None:
+                if token.group() == '&':
+                    handle_data('&')
+                continue
+            tag = tag.lower()
+            if token.group(1):
+                if tag in FAST_END_TAGS:
+                    self.handle_endtag(tag)
+            elif tag in FAST_START_TAGS:
+                rest = token.group(3)
+                attrs = []
+                if tag in FAST_ATTR_TAGS:
+                    attrs = self.parse_attrs(rest)
+                self.handle_starttag(tag, attrs)
+                if rest.endswith('/') and tag in FAST_END_TAGS:
+                    self.handle_endtag(tag)
+        if pos < end:
+            handle_data(pagecontent[pos:end])
+
+    """ Parses the attributes of a start tag like HTMLParser does: lowercased
+    names, unquoted and unescaped values, None for valueless attributes. """
+    def parse_attrs(self, attrtext):
+        attrs = []
+        for name, value in FAST_ATTR_RE.findall(attrtext):
+            if not value:
+                value = None
+            elif value[0] in '\'"' and value[0] == value[-1]:
+                value = value[1:-1]
+            if value and '&' in value:
+                value = self.unescape(value)
+            attrs.append((name.lower(), value))
+        return attrs
 
     @staticmethod
     def get_attribute(list, attribute):
@@ -321,15 +2266,14 @@ class HTMLRecordsParser(HTMLParser):
         if self.in_records_table and self.in_font:
             if self.column in self.column_to_field:
                 fieldname = self.column_to_field[self.column]
-                if fieldname in self.data.keys():
+                if fieldname in self.data:
                     self.data[fieldname].append(celldata)
                 else:
                     self.data[fieldname] = [celldata]
 
     def flush_data_to_records(self):
-        required_keys = self.column_to_field.values()
-        for k in required_keys:
-            if k not in self.data.keys():
+        for k in self.column_to_field.itervalues():
+            if k not in self.data:
                 self.data = dict()
                 return False;
 
@@ -338,13 +2282,17 @@ class HTMLRecordsParser(HTMLParser):
             # not sure of a better way to treat this
             self.data[k] = MULTILINE_WORKAROUND_KEY.join(
                 self.data[k])
-            joinkeyvalue = self.data[self.join_key]
-            if type(joinkeyvalue) == list:
-                joinkeyvalue = joinkeyvalue[0]
-            if joinkeyvalue in self.records.keys():
-                self.records[joinkeyvalue].append(self.data)
-            else:
-                self.records[joinkeyvalue] = [self.data]
+        row = RecordRow(self.data, self.strings)
+        self.rows_parsed += 1
+        joinkeyvalue = row[self.join_key]
+        if joinkeyvalue != self.last_joinkey:
+            if self.last_joinkey is not None:
+                self.completed_joinkeys.append(self.last_joinkey)
+            self.last_joinkey = joinkeyvalue
+        if joinkeyvalue in self.records:
+            self.records[joinkeyvalue].append(row)
+        else:
+            self.records[joinkeyvalue] = [row]
         self.data = dict()
         return True
 
@@ -357,8 +2305,8 @@ class HTMLRecordsParser(HTMLParser):
 
 """ Parser for HTML pages listing date-queried records. """
 class HTMLRecordsDateQueryParser(HTMLRecordsParser):
-    def __init__(self):
-        HTMLRecordsParser.__init__(self)
+    def __init__(self, engine=None):
+        HTMLRecordsParser.__init__(self, engine)
         self.column_to_field = {
             2: 'RecordDate',
             3: 'Document',
@@ -414,8 +2362,11 @@ class HTMLRecordsDateQueryParser(HTMLRecordsParser):
 
 """ Parser for HTML pages listing APNs of records. """
 class HTMLRecordsAPNParser(HTMLRecordsParser):
-    def __init__(self):
-        HTMLRecordsParser.__init__(self)
+    # Sniffing needs every cell's data, not just the font contents.
+    fast_rows = False
+
+    def __init__(self, engine=None):
+        HTMLRecordsParser.__init__(self, engine)
         self.is_apn = True
         # APN Pages are malformed when the images and reels are not populated.
         # When that's the case, we need to sort out what's what manually.
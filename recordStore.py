@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+import logging
+import os
+import re
+import sqlite3
+import sys
+import recordOutput
+import recordScraperLib as rs
+
+# A single SQLite database compacted from the per-day output files, indexed
+# for lookups over the whole corpus: by document id, filing date, APN and
+# grantor/grantee name. Ingesting is idempotent: a document is replaced as a
+# whole whenever it is seen again, and unchanged day files are skipped. A
+# document dropped from a changed day file is removed, unless another
+# ingested file still lists it.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    day TEXT NOT NULL,
+    date TEXT,
+    doctype TEXT
+);
+CREATE INDEX IF NOT EXISTS documents_day ON documents (day);
+CREATE TABLE IF NOT EXISTS document_values (
+    document_id TEXT NOT NULL,
+    field TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    normalized TEXT
+);
+CREATE INDEX IF NOT EXISTS document_values_id
+    ON document_values (document_id);
+CREATE INDEX IF NOT EXISTS document_values_normalized
+    ON document_values (normalized, field);
+CREATE TABLE IF NOT EXISTS ingested_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    documents INTEGER
+);
+CREATE TABLE IF NOT EXISTS file_documents (
+    path TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    PRIMARY KEY (path, document_id)
+);
+CREATE INDEX IF NOT EXISTS file_documents_id
+    ON file_documents (document_id);
+"""
+
+# The list fields of a record are kept in document_values. Names and APNs
+# get a normalized form for the lookups; reel/image is only stored.
+NAME_FIELDS = ('grantors', 'grantees')
+INGEST_BATCH_FILES = 100  # day files per ingest transaction
+NAME_PUNCTUATION_RE = re.compile(r"[^\w\s]", re.U)
+
+""" Uppercases a grantor/grantee name and reduces it to words, so that
+'Levine,  Matthew A ' finds 'LEVINE MATTHEW A'. """
+def normalize_name(name):
+    return " ".join(NAME_PUNCTUATION_RE.sub(" ", name.upper()).split())
+
+""" Normalized form of an APN (block and lot), e.g. ' 2004-062' -> '2004-062'.
+"""
+def normalize_apn(apn):
+    return apn.strip().upper()
+
+def normalize_value(field, value):
+    if field in NAME_FIELDS:
+        return normalize_name(value)
+    elif field == 'apn':
+        return normalize_apn(value)
+    return None
+
+""" Converts a record's MM/DD/YYYY date to a sortable YYYYMMDD day. """
+def date_to_day(date):
+    if not date or len(date) != 10:
+        return ""
+    return date[6:10] + date[0:2] + date[3:5]
+
+class RecordStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    """ Inserts or replaces records (Records or dicts) in one transaction.
+    Returns the number of records written. """
+    def upsert(self, records):
+        with self.conn:
+            return self.upsert_many(records)
+
+    """ Replaces records with bulk statements, without committing. """
+    def upsert_many(self, records):
+        documents = []
+        values = []
+        for record in records:
+            document_id = record['id']
+            documents.append((document_id, date_to_day(record['date']),
+                              record['date'], record['doctype']))
+            for field in rs.RECORD_LIST_FIELDS:
+                for position, value in enumerate(record.get(field) or []):
+                    values.append((document_id, field, position, value,
+                                   normalize_value(field, value)))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO documents (id, day, date, doctype) "
+            "VALUES (?, ?, ?, ?)", documents)
+        self.conn.executemany(
+            "DELETE FROM document_values WHERE document_id = ?",
+            [(document[0],) for document in documents])
+        self.conn.executemany(
+            "INSERT INTO document_values "
+            "(document_id, field, position, value, normalized) "
+            "VALUES (?, ?, ?, ?, ?)", values)
+        return len(documents)
+
+    """ Ingests one output file unless it was ingested before with the same
+    size and mtime (or force is set). Returns the number of records read,
+    or None if the file was skipped. """
+    def ingest_file(self, path, force=False):
+        with self.conn:
+            return self.add_file(path, force)
+
+    """ ingest_file without committing. """
+    def add_file(self, path, force=False):
+        stat = os.stat(path)
+        if not force:
+            row = self.conn.execute(
+                "SELECT size, mtime FROM ingested_files WHERE path = ?",
+                (path,)).fetchone()
+            if row is not None and row[0] == stat.st_size and \
+                    row[1] == stat.st_mtime:
+                return None
+        records = list(recordOutput.iter_records(path))
+        count = self.upsert_many(records)
+        document_ids = set(record['id'] for record in records)
+        dropped = set(row[0] for row in self.conn.execute(
+                "SELECT document_id FROM file_documents WHERE path = ?",
+                (path,))) - document_ids
+        self.conn.execute("DELETE FROM file_documents WHERE path = ?",
+                          (path,))
+        self.conn.executemany(
+            "INSERT INTO file_documents (path, document_id) VALUES (?, ?)",
+            [(path, document_id) for document_id in document_ids])
+        self.remove_unlisted(dropped)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO ingested_files "
+            "(path, size, mtime, documents) VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime, count))
+        return count
+
+    """ Removes the documents of document_ids that no ingested file lists,
+    without committing. """
+    def remove_unlisted(self, document_ids):
+        removed = [(document_id,) for document_id in document_ids
+                   if self.conn.execute(
+                "SELECT 1 FROM file_documents WHERE document_id = ? LIMIT 1",
+                (document_id,)).fetchone() is None]
+        self.conn.executemany("DELETE FROM documents WHERE id = ?", removed)
+        self.conn.executemany(
+            "DELETE FROM document_values WHERE document_id = ?", removed)
+        if removed:
+            logging.info("Removed %d documents no longer listed",
+                         len(removed))
+
+    """ Ingests every output file in output_path, committing every
+    INGEST_BATCH_FILES files. Tombstones, journals and temp files are left
+    alone. Returns (files ingested, records read). """
+    def ingest_directory(self, output_path, force=False):
+        paths = []
+        for filename in sorted(os.listdir(output_path)):
+            try:
+                recordOutput.format_for_path(filename)
+            except ValueError:
+                continue
+            paths.append(os.path.join(output_path, filename))
+        files = 0
+        records = 0
+        for start in range(0, len(paths), INGEST_BATCH_FILES):
+            with self.conn:
+                for path in paths[start:start + INGEST_BATCH_FILES]:
+                    count = self.add_file(path, force)
+                    if count is None:
+                        continue
+                    logging.info("Ingested %d records from %s", count, path)
+                    files += 1
+                    records += count
+        return (files, records)
+
+    """ Returns the stored record with this document id, or None. """
+    def get(self, document_id):
+        records = self.load_records([document_id])
+        if not records:
+            return None
+        return records[0]
+
+    """ Records filed between two YYYYMMDD days (inclusive), in date order.
+    """
+    def records_between(self, start_day, end_day):
+        return self.load_records(self.query_ids(
+                "SELECT id FROM documents WHERE day BETWEEN ? AND ?",
+                (start_day, end_day)))
+
+    """ Records covering an APN (block and lot), in date order. """
+    def records_for_apn(self, apn):
+        return self.load_records(self.query_ids(
+                "SELECT document_id FROM document_values "
+                "WHERE normalized = ? AND field = 'apn'",
+                (normalize_apn(apn),)))
+
+    """ Records with a grantor or grantee of this name. role narrows the
+    match to 'grantors' or 'grantees'. With prefix set, names starting with
+    the given one match as well ('SMITH' finds 'SMITH JOHN'). """
+    def records_for_name(self, name, role=None, prefix=False):
+        name = normalize_name(name)
+        fields = NAME_FIELDS if role is None else (role,)
+        if prefix:
+            # A range scan, so the index is used even for prefixes.
+            condition = "normalized >= ? AND normalized < ?"
+            params = (name, name + u"\uffff")
+        else:
+            condition = "normalized = ?"
+            params = (name,)
+        return self.load_records(self.query_ids(
+                "SELECT document_id FROM document_values WHERE %s "
+                "AND field IN (%s)" % (condition, ",".join("?" * len(fields))),
+                params + fields))
+
+    def query_ids(self, sql, params):
+        seen = set()
+        ids = []
+        for (document_id,) in self.conn.execute(sql, params):
+            if document_id not in seen:
+                seen.add(document_id)
+                ids.append(document_id)
+        return ids
+
+    """ Loads the Records of a list of document ids, in date order. """
+    def load_records(self, document_ids):
+        records = []
+        strings = rs.StringInterner()
+        # SQLite caps the number of bound parameters per statement.
+        for start in range(0, len(document_ids), 500):
+            batch = document_ids[start:start + 500]
+            marks = ",".join("?" * len(batch))
+            values = dict()
+            for document_id, field, value in self.conn.execute(
+                    "SELECT document_id, field, value FROM document_values "
+                    "WHERE document_id IN (%s) "
+                    "ORDER BY document_id, field, position" % marks, batch):
+                values.setdefault(document_id, dict()).setdefault(
+                    field, []).append(value)
+            for document_id, date, doctype in self.conn.execute(
+                    "SELECT id, date, doctype FROM documents "
+                    "WHERE id IN (%s)" % marks, batch):
+                fields = values.get(document_id, dict())
+                records.append(rs.Record(
+                        document_id, date, doctype,
+                        grantors=fields.get('grantors', ()),
+                        grantees=fields.get('grantees', ()),
+                        reel_image=fields.get('reel_image', ()),
+                        apn=fields.get('apn', ()), interner=strings))
+        records.sort(key=rs.record_sort_key)
+        return records
+
+def usage():
+    print
+    print 'Usage: ./recordStore.py ingest STORE data_path'
+    print '       ./recordStore.py apn STORE BLOCK-LOT'
+    print '       ./recordStore.py name STORE NAME'
+    print '       ./recordStore.py dates STORE YYYYMMDD:YYYYMMDD'
+    print
+    print """Compacts the output files of recordScraper in data_path into the SQLite database STORE, or looks up records in it. Lookups print one JSON record per line."""
+    sys.exit(2)
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    if len(argv) != 4:
+        usage()
+    command, store_path, argument = argv[1:4]
+    store = RecordStore(store_path)
+    try:
+        if command == 'ingest':
+            files, records = store.ingest_directory(argument)
+            logging.info("Ingested %d records from %d files.", records, files)
+            return
+        elif command == 'apn':
+            records = store.records_for_apn(argument)
+        elif command == 'name':
+            records = store.records_for_name(argument)
+        elif command == 'dates' and len(argument) == 17:
+            records = store.records_between(argument[0:8], argument[9:17])
+        else:
+            usage()
+        for record in records:
+            print rs.encode_record(record)
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
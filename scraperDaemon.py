@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+import datetime
+import getopt
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import recordScraperLib as rs
+import recordScraper
+import recordOutput
+import recordMetrics
+from recordMetrics import METRICS
+
+# Keeps fetching days for as long as it runs, instead of one fixed date range
+# per cron job. The days to fetch are kept in a WorkQueue file: a backlog of
+# backfill days, and every day the last CATCH_UP_DAYS days, which are handed
+# out first. The request rate and APN concurrency follow an OffPeakSchedule:
+# a trickle (or a pause, with --peak-rate=0) during business hours, the full
+# rate the rest of the time, so long backfills use the night and weekend
+# without anyone splitting the date ranges by hand.
+
+PEAK_HOURS = "07:00-19:00"  # business hours of criis.com, local time
+PEAK_WEEKDAYS = (0, 1, 2, 3, 4)  # Monday to Friday
+PEAK_RATE = 1.0  # requests per second during business hours
+PEAK_APN_CONCURRENCY = 1
+CATCH_UP_DAYS = 1  # yesterday
+CATCH_UP_PRIORITY = 1  # ahead of the backfill days
+IDLE_POLL_SECONDS = 300  # sleep when the queue is empty or paused
+DAY_FORMAT = "%Y%m%d"  # of the days in the queue
+
+LONG_OPTIONS = [
+    'backfill=',
+    'peak-hours=',
+    'peak-rate=',
+    'peak-apn-concurrency=',
+    'off-peak-rate=',
+    'off-peak-apn-concurrency=',
+    'catch-up-days=',
+    'poll=',
+    'day-attempts=',
+    'format=',
+    'known=',
+    'known-blank-ttl-days=',
+    'archive=',
+    'archive-max-mb=',
+    'website=',
+    'metrics=',
+    'metrics-interval=',
+]
+
+""" Business hours, when criis.com is used by people and the scraper only
+trickles: from peak_start to peak_end (datetime.times, peak_start first) on
+the given weekdays. All other times are off-peak. """
+class OffPeakSchedule(object):
+    def __init__(self, peak_start, peak_end, peak_weekdays=PEAK_WEEKDAYS):
+        if peak_start >= peak_end:
+            raise ValueError("Peak hours must start before they end")
+        self.peak_start = peak_start
+        self.peak_end = peak_end
+        self.peak_weekdays = peak_weekdays
+
+    """ Parses peak hours given as HH:MM-HH:MM. """
+    @staticmethod
+    def parse(value, peak_weekdays=PEAK_WEEKDAYS):
+        try:
+            start, end = [datetime.datetime.strptime(part, "%H:%M").time()
+                          for part in value.split("-")]
+        except ValueError:
+            raise ValueError("Peak hours must be HH:MM-HH:MM, not %s" % value)
+        return OffPeakSchedule(start, end, peak_weekdays)
+
+    def is_peak(self, now):
+        return now.weekday() in self.peak_weekdays and \
+            self.peak_start <= now.time() < self.peak_end
+
+    """ The first time after now that peak hours start or end. """
+    def next_change(self, now):
+        peak = self.is_peak(now)
+        for offset in range(8):
+            day = now.date() + datetime.timedelta(days=offset)
+            for boundary in (self.peak_start, self.peak_end):
+                change = datetime.datetime.combine(day, boundary)
+                if change > now and self.is_peak(change) != peak:
+                    return change
+        return None  # peak hours on no weekday
+
+""" Sets the rate ceiling and APN concurrency of the hours now is in.
+Returns the phase, 'peak' or 'off_peak'. """
+def apply_schedule(schedule, now, options):
+    if schedule.is_peak(now):
+        phase, rate, apn_concurrency = 'peak', options['peak_rate'], \
+            options['peak_apn_concurrency']
+    else:
+        phase, rate, apn_concurrency = 'off_peak', options['off_peak_rate'], \
+            options['off_peak_apn_concurrency']
+    if rate > 0 and rate != rs.CRIISCaller.rate_controller.max_rate:
+        logging.info("Switching to %s: up to %.2f requests/s, %d APN "
+                     "lookups at once", phase, rate, apn_concurrency)
+        rs.CRIISCaller.rate_controller.set_max_rate(rate)
+    options['max_rate'] = rate
+    options['apn_concurrency'] = apn_concurrency
+    return phase
+
+""" Queues the days of a YYYYMMDD:YYYYMMDD range as backfill. Returns how
+many were new. """
+def queue_backfill(queue, date_range):
+    start_date, end_date = date_range.split(":")
+    return queue.add([
+            recordScraper.convert_mmddyyyy_to_date(cur_date).strftime(
+                DAY_FORMAT)
+            for cur_date in recordScraper.expand_dates_to_MMDDYYYY_list(
+                start_date, end_date)])
+
+""" Queues the catch_up_days days before today ahead of the backfill. Days
+queued before keep their state, so a day is caught up once. Returns how
+many were new. """
+def queue_catch_up(queue, today, catch_up_days):
+    return queue.add([(today - datetime.timedelta(days=offset)).strftime(
+                DAY_FORMAT) for offset in range(1, catch_up_days + 1)],
+                     priority=CATCH_UP_PRIORITY)
+
+""" Fetches the next day of the queue under the schedule's settings for
+now. Returns the day fetched, 'paused' during peak hours with a zero peak
+rate, or 'idle' if the queue had no day to hand out. """
+def run_once(queue, owner, schedule, now, record_type_name, output_path,
+             options):
+    phase = apply_schedule(schedule, now, options)
+    if options['max_rate'] <= 0:
+        return 'paused'
+    items = queue.lease(owner)
+    if not items:
+        return 'idle'
+    day = items[0]
+    cur_date = datetime.datetime.strptime(day, DAY_FORMAT).strftime("%m%d%Y")
+    logging.info("Fetching records for %s (%s)", cur_date, phase)
+    failed = recordScraper.fetch_window([cur_date], record_type_name,
+                                        output_path, options)
+    METRICS.inc('daemon_days_total', phase=phase)
+    if failed:
+        state = queue.fail(day, owner, "Failed to fetch %s" % cur_date)
+        logging.error("Failed to fetch %s, %s", cur_date, state or
+                      "lease lost")
+    elif not queue.complete(day, owner):
+        logging.warning("Lease on %s expired before it was done", cur_date)
+    return day
+
+""" Runs until stop is set: queues the catch-up days once a day, and
+fetches the queued days one at a time, sleeping while paused or idle. The
+schedule is applied between days. """
+def run_daemon(queue, schedule, record_type_name, output_path, options,
+               stop):
+    owner = "%s:%d" % (socket.gethostname(), os.getpid())
+    caught_up = None
+    while not stop.is_set():
+        now = datetime.datetime.now()
+        if caught_up != now.date():
+            added = queue_catch_up(queue, now.date(),
+                                   options['catch_up_days'])
+            if added:
+                logging.info("Queued %d days to catch up on", added)
+            caught_up = now.date()
+        result = run_once(queue, owner, schedule, now, record_type_name,
+                          output_path, options)
+        if result in ('paused', 'idle'):
+            wait = options['poll']
+            if result == 'paused':
+                change = schedule.next_change(now)
+                if change is not None:
+                    wait = min(wait, max(1, (change - now).total_seconds()))
+            METRICS.inc('daemon_%s_seconds_total' % result, wait)
+            stop.wait(wait)
+
+def usage():
+    print
+    print 'Usage: ./scraperDaemon.py [options] QUEUE RECORDTYPE data_path'
+    print
+    print """Fetches the days queued in the work queue file QUEUE (see --backfill) and, every day, the days before it, into data_path, until stopped with SIGTERM or ^C. Requests trickle during peak hours on weekdays and go at the full rate the rest of the time."""
+    print
+    print 'Options:'
+    print '  --backfill=YYYYMMDD:YYYYMMDD'
+    print '                        Queue the days of this range'
+    print '  --peak-hours=HH:MM-HH:MM'
+    print '                        Business hours on weekdays, local time'
+    print '                        (default %s)' % PEAK_HOURS
+    print '  --peak-rate=R         Requests per second during peak hours, 0 to'
+    print '                        pause (default %.0f)' % PEAK_RATE
+    print '  --peak-apn-concurrency=N'
+    print '                        APN lookups in flight during peak hours'
+    print '                        (default %d)' % PEAK_APN_CONCURRENCY
+    print '  --off-peak-rate=R     Requests per second off-peak (default %.0f)' % (
+        rs.CRIISCaller.rate_controller.max_rate)
+    print '  --off-peak-apn-concurrency=N'
+    print '                        APN lookups in flight off-peak (default %d)' % (
+        rs.APN_FETCH_CONCURRENCY)
+    print '  --catch-up-days=N     Days before today to fetch every day'
+    print '                        (default %d)' % CATCH_UP_DAYS
+    print '  --poll=S              Seconds to sleep when there is nothing to'
+    print '                        do (default %d)' % IDLE_POLL_SECONDS
+    print '  --day-attempts=N      Give up on a day after N tries (default %d)' % (
+        rs.WORK_MAX_ATTEMPTS)
+    print '  --format=FORMAT       Output format, one of %s' % (
+        ', '.join(recordOutput.OUTPUT_FORMATS))
+    print '  --known=FILE          Remember looked-up documents in FILE'
+    print '  --known-blank-ttl-days=N'
+    print '                        Look up known documents without reel/image'
+    print '                        again after N days (default %d)' % (
+        rs.KNOWN_BLANK_TTL_DAYS)
+    print '  --archive=DIR         Keep the raw result pages in DIR'
+    print '  --archive-max-mb=N    Size cap of the archive (default 2048)'
+    print '  --website=HOST[:PORT] Query this server instead of %s' % (
+        rs.CRIISCaller.website)
+    print '  --metrics=PATH        Dump counters and latency histograms to'
+    print '                        PATH.json and PATH.prom while running'
+    print '  --metrics-interval=S  Seconds between metrics dumps'
+    sys.exit(2)
+
+def parse_commandline_arguments(argv):
+    options = recordScraper.default_options()
+    options.update({
+        'backfill': None,
+        'peak_hours': PEAK_HOURS,
+        'peak_rate': PEAK_RATE,
+        'peak_apn_concurrency': PEAK_APN_CONCURRENCY,
+        'off_peak_rate': options['max_rate'],
+        'off_peak_apn_concurrency': rs.APN_FETCH_CONCURRENCY,
+        'catch_up_days': CATCH_UP_DAYS,
+        'poll': IDLE_POLL_SECONDS,
+        'day_attempts': rs.WORK_MAX_ATTEMPTS,
+    })
+    try:
+        flags, args = getopt.gnu_getopt(argv[1:], '', LONG_OPTIONS)
+        for flag, value in flags:
+            if flag == '--backfill':
+                if len(value) != 17 or value[8] != ':':
+                    raise Exception("Incorrect date format: %s" % value)
+                options['backfill'] = value
+            elif flag == '--peak-hours':
+                OffPeakSchedule.parse(value)
+                options['peak_hours'] = value
+            elif flag in ('--peak-rate', '--off-peak-rate'):
+                options[flag[2:].replace('-', '_')] = float(value)
+                if float(value) < 0:
+                    raise Exception("Rates cannot be negative")
+            elif flag in ('--peak-apn-concurrency',
+                          '--off-peak-apn-concurrency'):
+                options[flag[2:].replace('-', '_')] = int(value)
+                if int(value) < 1:
+                    raise Exception("APN concurrency must be at least 1")
+            elif flag == '--catch-up-days':
+                options['catch_up_days'] = int(value)
+            elif flag == '--poll':
+                options['poll'] = float(value)
+            elif flag == '--day-attempts':
+                options['day_attempts'] = int(value)
+                if options['day_attempts'] < 1:
+                    raise Exception("Need at least one attempt per day")
+            elif flag == '--format':
+                if value not in recordOutput.OUTPUT_FORMATS:
+                    raise Exception("Unknown output format %s" % value)
+                options['format'] = value
+            elif flag == '--known':
+                options['known'] = value
+            elif flag == '--known-blank-ttl-days':
+                options['known_blank_ttl_days'] = float(value)
+            elif flag == '--archive':
+                options['archive'] = value
+            elif flag == '--archive-max-mb':
+                options['archive_max_mb'] = int(value)
+            elif flag == '--website':
+                options['website'] = value
+            elif flag == '--metrics':
+                options['metrics'] = value
+            elif flag == '--metrics-interval':
+                options['metrics_interval'] = float(value)
+        if options['off_peak_rate'] <= 0:
+            raise Exception("The off-peak rate must be positive")
+        if len(args) != 3:
+            usage()
+        if not rs.RECORD_TYPES.get(args[1]):
+            raise Exception("Invalid record type, valid types are: %s" %
+                            ", ".join(sorted(rs.RECORD_TYPES.keys())))
+    except Exception, e:
+        print str(e)
+        usage()
+    options['max_rate'] = options['off_peak_rate']
+    options['total_rate'] = options['max_rate']
+    return (args[0], args[1], args[2], options)
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    queue_path, record_type_name, output_path, options = \
+        parse_commandline_arguments(argv)
+    schedule = OffPeakSchedule.parse(options['peak_hours'])
+    recordScraper.configure_callers(options)
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    queue = rs.WorkQueue(queue_path, max_attempts=options['day_attempts'])
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    dumper = None
+    if options['metrics']:
+        dumper = recordMetrics.MetricsDumper(
+            METRICS, options['metrics'], options['metrics_interval']).start()
+    try:
+        if options['backfill']:
+            logging.info("Queued %d days to backfill",
+                         queue_backfill(queue, options['backfill']))
+        run_daemon(queue, schedule, record_type_name, output_path, options,
+                   stop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if dumper is not None:
+            dumper.stop()
+        counts = queue.counts()
+        logging.info("Stopping with %d days pending, %d done, %d failed.",
+                     counts['pending'] + counts['leased'], counts['done'],
+                     counts['failed'])
+        queue.close()
+        recordScraper.log_connection_stats()
+
+if __name__ == '__main__':
+    main(sys.argv)
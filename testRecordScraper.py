@@ -1,12 +1,31 @@
 #!/usr/bin/env python
 
 import csv
+import datetime
+import json
 import os
+import shutil
+import tempfile
 import unittest
 import pprint
 import logging
+import random
+import re
+import time
+import urlparse
 import recordScraper as rs
 import recordScraperLib as rsl
+import recordScraperAsync as rsa
+import recordOutput
+import recordStore
+import apnIndex
+import benchmarkScraper
+import bulkScraper
+import scraperDaemon
+import criisStubServer
+import recordMetrics
+import recordCalendar
+import recordRollups
 
 class TestDeedScraperFunctions(unittest.TestCase):
     def test_expand_dates_to_MMDDYYYY_list_singledate(self):
@@ -30,6 +49,68 @@ class TestDeedScraperFunctions(unittest.TestCase):
             "outpath", "prefix", "01022013")
         self.assertEqual(filename, "outpath/prefix_20130102.json")
 
+    def test_find_days_to_repair(self):
+        output_path = tempfile.mkdtemp()
+        try:
+            for day in ("20130101", "20130102"):
+                open(os.path.join(output_path, "DEED_%s.json" % day),
+                     'w').close()
+            open(os.path.join(output_path, "DEED_20130102.json_BAD_READ"),
+                 'w').close()
+            date_list = rs.expand_dates_to_MMDDYYYY_list("20130101",
+                                                         "20130103")
+            self.assertEqual(
+                rs.find_days_to_repair(date_list, output_path, "DEED"),
+                ["01022013", "01032013"])
+        finally:
+            shutil.rmtree(output_path)
+
+    def test_split_into_windows(self):
+        date_list = rs.expand_dates_to_MMDDYYYY_list("20121230", "20130104")
+        date_list.remove("01012013")
+        self.assertEqual(rs.split_into_windows(date_list, 2),
+                         [["12302012", "12312012"], ["01022013", "01032013"],
+                          ["01042013"]])
+        self.assertEqual(len(rs.split_into_windows(date_list, 1)), 5)
+
+    def test_fetch_window_splits_large_reports(self):
+        output_path = tempfile.mkdtemp()
+        fetched = []
+        def fetch(start, end, record_type, apn_concurrency, journal=None,
+                  known=None, max_report_pages=None, check_empty=False):
+            self.assertFalse(check_empty)
+            fetched.append((start, end))
+            if start != end:
+                self.assertEqual(max_report_pages, 20)
+            if start != end and end != "01022013":
+                raise rsl.ReportTooLargeException(start, end, 30)
+            return [rsl.Record("D%s" % day, "%s/%s/%s" % (
+                        day[0:2], day[2:4], day[4:8]), "DEED")
+                    for day in rs.expand_dates_to_MMDDYYYY_list(
+                        start[4:8] + start[0:4], end[4:8] + end[0:4])]
+        saved_fetch = rs.rs.fetch_records_for_daterange
+        rs.rs.fetch_records_for_daterange = fetch
+        try:
+            options = rs.parse_commandline_arguments(
+                ["recordScraper.py", "--window-days=4",
+                 "20130101:20130104", "DEED", output_path])[4]
+            date_list = rs.expand_dates_to_MMDDYYYY_list("20130101",
+                                                         "20130104")
+            self.assertEqual(rs.fetch_window(date_list, "DEED", output_path,
+                                             options), [])
+            self.assertEqual(fetched, [
+                    ("01012013", "01042013"), ("01012013", "01022013"),
+                    ("01032013", "01042013"), ("01032013", "01032013"),
+                    ("01042013", "01042013")])
+            for day in date_list:
+                records = json.load(open(rs.convert_mmddyyyy_to_output_filename(
+                            output_path, "DEED", day)))
+                self.assertEqual([record['id'] for record in records],
+                                 ["D%s" % day])
+        finally:
+            rs.rs.fetch_records_for_daterange = saved_fetch
+            shutil.rmtree(output_path)
+
 class TestHTMLRecordsDateQueryParser(unittest.TestCase):
     def test_get_attribute(self):
         self.assertEqual(rsl.HTMLRecordsParser.get_attribute(
@@ -46,6 +127,79 @@ class TestHTMLRecordsDateQueryParser(unittest.TestCase):
             self.assertEqual(
                 rsl.HTMLRecordsDateQueryParser.validate_records(records), True)
 
+    def test_fast_engine_matches_htmlparser(self):
+        for c in ['1', '2', '3']:
+            f = open('./testdata/datequery_doc_type_list' + c + '.html', 'r')
+            page = f.read()
+            records = {}
+            for engine in rsl.PARSER_ENGINES:
+                datequery_parser = rsl.HTMLRecordsDateQueryParser(engine)
+                datequery_parser.feed(page)
+                records[engine] = datequery_parser.get_records()
+            self.assertEqual(records['fast'], records['htmlparser'])
+
+    def test_parse_stream_yields_groups_early(self):
+        f = open('./testdata/datequery_doc_type_list2.html', 'r')
+        page = f.read()
+        chunks_read = []
+        def chunks():
+            for i in range(0, len(page), 512):
+                chunks_read.append(i)
+                yield page[i:i + 512]
+        for engine in rsl.PARSER_ENGINES:
+            datequery_parser = rsl.HTMLRecordsDateQueryParser(engine)
+            datequery_parser.feed(page)
+            records = datequery_parser.get_records()
+            chunks_read = []
+            streaming_parser = rsl.HTMLRecordsDateQueryParser(engine)
+            groups = []
+            for group in streaming_parser.parse_stream(chunks()):
+                if not groups:
+                    self.assertTrue(len(chunks_read) < len(page) / 512)
+                groups.append(group)
+            self.assertEqual(len(groups), len(records))
+            self.assertEqual(dict(groups), records)
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, rsl.HTMLRecordsDateQueryParser, 'lxml')
+
+class TestBlockLotQuery(unittest.TestCase):
+    # Captures of www.criis.com's Block and Lot Search form and of the
+    # results page of one parcel, saved as served.
+    form_path = './testdata/blocklot_search_form.html'
+    results_path = './testdata/blocklot_query_list1.html'
+
+    def read_capture(self, path):
+        if not os.path.exists(path):
+            self.skipTest("No capture of the live site in %s" % path)
+        return open(path).read()
+
+    def test_params_match_captured_form(self):
+        form = self.read_capture(self.form_path)
+        fields = set(re.findall(r'name="([^"]+)"', form, re.I))
+        params = urlparse.parse_qs(rsl.CRIISCallerBlockLotQuery.build_params(
+                '0619', '108'), keep_blank_values=True)
+        self.assertEqual(set(params) - fields, set())
+
+    def test_parse_captured_results(self):
+        parser = rsl.HTMLRecordsDateQueryParser()
+        parser.feed(self.read_capture(self.results_path))
+        records = parser.get_records()
+        self.assertTrue(records)
+        self.assertEqual(
+            rsl.HTMLRecordsDateQueryParser.validate_records(records), True)
+
+    def test_bulk_run_needs_a_checked_form(self):
+        if rsl.BLOCKLOT_FORM_VERIFIED:
+            return
+        work_dir = tempfile.mkdtemp()
+        try:
+            self.assertRaises(SystemExit, bulkScraper.main, [
+                    "bulkScraper.py", "run",
+                    os.path.join(work_dir, "queue.db"), work_dir])
+        finally:
+            shutil.rmtree(work_dir)
+
 class TestHTMLRecordsAPNParser(unittest.TestCase):
     def test_parse_html(self):
         for c in ['1', '2', '3']:
@@ -55,7 +209,1305 @@ class TestHTMLRecordsAPNParser(unittest.TestCase):
             records = apn_parser.get_records()
             self.assertEqual(
                 apn_parser.validate_records(records), True)
-            
+
+    def test_fast_engine_matches_htmlparser(self):
+        for c in ['1', '2', '3']:
+            f = open('./testdata/apnquery_doc_detail' + c + '.html', 'r')
+            page = f.read()
+            records = {}
+            for engine in rsl.PARSER_ENGINES:
+                apn_parser = rsl.HTMLRecordsAPNParser(engine)
+                apn_parser.feed(page)
+                records[engine] = apn_parser.get_records()
+            self.assertEqual(records['fast'], records['htmlparser'])
+
+class FakeAPNCaller(object):
+    """Stands in for CRIISCallerAPNQuery, failing on URLs containing FAIL."""
+    def fetch(self, apn_url):
+        time.sleep(random.random() / 100)
+        if "FAIL" in apn_url:
+            raise rsl.DSException("Injected failure for %s" % apn_url)
+        return "page for " + apn_url
+
+    def create_connection(self):
+        pass
+
+    def close_connection(self):
+        pass
+
+    def reset_connection(self):
+        pass
+
+class TestAPNFetchPool(unittest.TestCase):
+    def setUp(self):
+        self.original_sleep = rsl.time.sleep
+        rsl.time.sleep = lambda seconds: None
+
+    def tearDown(self):
+        rsl.time.sleep = self.original_sleep
+
+    def test_fetch_all_preserves_order(self):
+        jobs = [("J%d-00" % i, "02/01/2011", "/apn?%d" % i)
+                for i in range(20)]
+        pool = rsl.APNFetchPool(4, caller_factory=FakeAPNCaller)
+        pages = pool.fetch_all(jobs)
+        self.assertEqual(pages, ["page for " + job[2] for job in jobs])
+
+    def test_fetch_all_reports_failures(self):
+        jobs = [("J1-00", "02/01/2011", "/apn?1"),
+                ("J2-00", "02/01/2011", "/apn?FAIL")]
+        pool = rsl.APNFetchPool(2, caller_factory=FakeAPNCaller)
+        self.assertEqual(pool.fetch_all(jobs), ["page for /apn?1", None])
+
+    def test_submit_while_running(self):
+        pool = rsl.APNFetchPool(2, caller_factory=FakeAPNCaller)
+        arrived = []
+        pool.start(lambda idx, page: arrived.append(idx))
+        for i in range(5):
+            self.assertEqual(pool.submit(("J%d-00" % i, "02/01/2011",
+                                          "/apn?%d" % i)), i)
+        self.assertEqual(len(pool.workers), 2)
+        self.assertEqual(pool.finish(),
+                         ["page for /apn?%d" % i for i in range(5)])
+        self.assertEqual(sorted(arrived), range(5))
+
+class TestParseWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = rsl.ParseWorkerPool(2)
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_parse_page_matches_in_process(self):
+        for c in ['1', '2', '3']:
+            f = open('./testdata/apnquery_doc_detail' + c + '.html', 'r')
+            page = f.read()
+            apn_parser = rsl.HTMLRecordsAPNParser()
+            apn_parser.feed(page)
+            self.assertEqual(
+                self.pool.parse_page(rsl.HTMLRecordsAPNParser, page),
+                apn_parser.get_records())
+
+    def test_stream_matches_in_process(self):
+        f = open('./testdata/datequery_doc_type_list2.html', 'r')
+        page = f.read()
+        datequery_parser = rsl.HTMLRecordsDateQueryParser()
+        datequery_parser.feed(page)
+        chunks = [page[i:i + 4096] for i in range(0, len(page), 4096)]
+        stream_parser = rsl.WorkerStreamParser(
+            rsl.HTMLRecordsDateQueryParser, self.pool)
+        groups = list(stream_parser.parse_stream(iter(chunks)))
+        self.assertEqual(dict(groups), datequery_parser.get_records())
+        self.assertEqual(stream_parser.report_pages,
+                         datequery_parser.report_pages)
+
+    def test_stream_read_error(self):
+        f = open('./testdata/datequery_doc_type_list2.html', 'r')
+        page = f.read()
+        def failing_chunks():
+            yield page[:len(page) / 2]
+            raise rsl.DSException("Injected failure")
+        stream_parser = rsl.WorkerStreamParser(
+            rsl.HTMLRecordsDateQueryParser, self.pool)
+        groups = []
+        try:
+            for group in stream_parser.parse_stream(failing_chunks()):
+                groups.append(group)
+            self.fail("Expected a DSException")
+        except rsl.DSException:
+            pass
+        self.assertTrue(0 < len(groups) < 96)
+        # The workers are usable again afterwards.
+        stream_parser = rsl.WorkerStreamParser(
+            rsl.HTMLRecordsDateQueryParser, self.pool)
+        self.assertEqual(len(list(stream_parser.parse_stream([page]))), 96)
+
+class TestMetrics(unittest.TestCase):
+    def test_counters_and_histograms(self):
+        metrics = recordMetrics.Metrics()
+        metrics.inc('retries_total', caller='A')
+        metrics.inc('retries_total', 2, caller='A')
+        for seconds in (0.003, 0.2, 100):
+            metrics.observe('http_seconds', seconds, phase='send')
+        self.assertEqual(metrics.counter_value('retries_total', caller='A'),
+                         3)
+        histogram = metrics.histogram('http_seconds', phase='send')
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.max, 100)
+        self.assertEqual(histogram.counts[1], 1)  # 0.001 < 0.003 <= 0.005
+        self.assertEqual(histogram.counts[-1], 1)  # beyond the last bucket
+
+        prometheus = metrics.to_prometheus().splitlines()
+        self.assertTrue('deedscraper_retries_total{caller="A"} 3' in
+                        prometheus)
+        self.assertTrue('deedscraper_http_seconds_bucket'
+                        '{le="0.25",phase="send"} 2' in prometheus)
+        self.assertTrue('deedscraper_http_seconds_bucket'
+                        '{le="+Inf",phase="send"} 3' in prometheus)
+        self.assertTrue('deedscraper_http_seconds_count{phase="send"} 3' in
+                        prometheus)
+
+    def test_merge_snapshot(self):
+        worker = recordMetrics.Metrics()
+        worker.inc('records_total', 5)
+        worker.observe('parse_seconds', 0.5)
+        snapshot = json.loads(json.dumps(worker.snapshot(reset=True)))
+        self.assertEqual(worker.counter_value('records_total'), 0)
+        parent = recordMetrics.Metrics()
+        parent.inc('records_total', 1)
+        parent.merge(snapshot)
+        parent.merge(snapshot)
+        self.assertEqual(parent.counter_value('records_total'), 11)
+        self.assertEqual(parent.histogram('parse_seconds').count, 2)
+
+    def test_parser_metrics(self):
+        labels = {'parser': 'HTMLRecordsDateQueryParser'}
+        rows_before = recordMetrics.METRICS.counter_value(
+            'parsed_rows_total', **labels)
+        parser = rsl.HTMLRecordsDateQueryParser()
+        parser.feed(open('./testdata/datequery_doc_type_list1.html').read())
+        self.assertEqual(recordMetrics.METRICS.counter_value(
+                'parsed_rows_total', **labels) - rows_before, 219)
+        self.assertTrue(parser.parse_seconds > 0)
+
+    def test_run_serial_defers_failed_days(self):
+        fetched = []
+        def fetch_window(window, record_type_name, output_path, options):
+            fetched.append(window)
+            return [day for day in window if day == "01022013"]
+        saved_fetch_window = rs.fetch_window
+        rs.fetch_window = fetch_window
+        try:
+            options = rs.parse_commandline_arguments(
+                ["recordScraper.py", "--day-attempts=3", "20130101:20130103",
+                 "DEED", "out"])[4]
+            pending = [(cur_date, "DEED") for cur_date in
+                       rs.expand_dates_to_MMDDYYYY_list("20130101",
+                                                        "20130103")]
+            self.assertEqual(rs.run_serial(pending, "out", options),
+                             [("01022013", "DEED")])
+        finally:
+            rs.fetch_window = saved_fetch_window
+        self.assertEqual(fetched, [["01012013"], ["01022013"], ["01032013"],
+                                   ["01022013"], ["01022013"]])
+
+class TestRateController(unittest.TestCase):
+    def setUp(self):
+        self.now = [1000.0]
+        self.controller = rsl.RateController(rate=5.0, min_rate=1.0,
+                                             max_rate=6.0)
+        self.controller.clock = lambda: self.now[0]
+        self.controller.updated = self.now[0]
+
+    def test_reserve_paces_requests(self):
+        self.assertEqual(self.controller.reserve(), 0.0)
+        self.assertAlmostEqual(self.controller.reserve(), 0.2)
+        self.assertAlmostEqual(self.controller.reserve(), 0.4)
+        self.now[0] += 10
+        self.assertEqual(self.controller.reserve(), 0.0)
+
+    def test_additive_increase_multiplicative_decrease(self):
+        for i in range(100):
+            self.controller.record_success(0.1)
+        self.assertEqual(self.controller.rate, 6.0)
+        self.controller.record_failure()
+        self.assertEqual(self.controller.rate, 3.0)
+        # A burst of concurrent timeouts only counts once.
+        self.controller.record_failure()
+        self.assertEqual(self.controller.rate, 3.0)
+        self.now[0] += 1
+        self.controller.record_failure()
+        self.assertEqual(self.controller.rate, 1.5)
+        self.now[0] += 1
+        self.controller.record_failure()
+        self.assertEqual(self.controller.rate, 1.0)
+
+    def test_slow_responses_reduce_rate(self):
+        self.controller.record_success(10.0)
+        self.assertEqual(self.controller.rate, 2.5)
+
+    def test_set_max_rate_restores_min_rate(self):
+        self.controller.set_max_rate(0.5)
+        self.assertEqual((self.controller.rate, self.controller.min_rate),
+                         (0.5, 0.5))
+        self.controller.set_max_rate(6.0)
+        self.assertEqual((self.controller.rate, self.controller.min_rate),
+                         (1.0, 1.0))
+        self.controller.record_success(10.0)
+        self.assertEqual(self.controller.rate, 1.0)
+
+    def test_backoff_delay_is_jittered_exponential(self):
+        for attempt in range(8):
+            delay = self.controller.backoff_delay(attempt)
+            cap = min(self.controller.max_backoff, 2 ** attempt)
+            self.assertTrue(cap / 2.0 <= delay <= cap)
+
+class TestRetryBudget(unittest.TestCase):
+    def test_retries_are_a_share_of_requests(self):
+        budget = rsl.RetryBudget(ratio=0.5, max_balance=2.0)
+        self.assertTrue(budget.try_retry())
+        self.assertTrue(budget.try_retry())
+        self.assertFalse(budget.try_retry())
+        budget.record_request()
+        self.assertFalse(budget.try_retry())
+        budget.record_request()
+        self.assertTrue(budget.try_retry())
+        for i in range(10):
+            budget.record_request()
+        self.assertEqual(budget.balance, 2.0)
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.now = [1000.0]
+        self.breaker = rsl.CircuitBreaker(failure_threshold=3, cooldown=10.0,
+                                          max_cooldown=15.0)
+        self.breaker.clock = lambda: self.now[0]
+
+    def test_opens_after_failures_in_a_row(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.delay(), 0.0)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertEqual(self.breaker.delay(), 10.0)
+        self.now[0] += 4
+        self.assertEqual(self.breaker.delay(), 6.0)
+
+    def test_one_probe_after_cooldown(self):
+        for i in range(3):
+            self.breaker.record_failure()
+        self.now[0] += 10
+        self.assertEqual(self.breaker.delay(), 0.0)
+        self.assertEqual(self.breaker.state, 'half_open')
+        # Only one caller probes, the others keep waiting.
+        self.assertEqual(self.breaker.delay(), self.breaker.probe_poll)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertEqual(self.breaker.delay(), 15.0)
+        self.now[0] += 15
+        self.assertEqual(self.breaker.delay(), 0.0)
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertEqual(self.breaker.delay(), 0.0)
+        self.assertEqual(self.breaker.cooldown, 10.0)
+
+class TestSharedRequestBudget(unittest.TestCase):
+    def test_reserve_spaces_slots(self):
+        budget = rsl.SharedRequestBudget(10.0)
+        waits = [budget.reserve() for i in range(5)]
+        self.assertTrue(waits[0] < 0.01)
+        for previous, wait in zip(waits, waits[1:]):
+            self.assertAlmostEqual(wait - previous, 0.1, places=2)
+
+    def test_rate_controller_waits_for_budget(self):
+        controller = rsl.RateController(rate=1000.0, burst=1000.0)
+        controller.budget = rsl.SharedRequestBudget(2.0)
+        controller.reserve()
+        self.assertTrue(controller.reserve() > 0.4)
+
+class TestResponseArchive(unittest.TestCase):
+    def setUp(self):
+        self.archive_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_path)
+
+    def test_round_trip_ignores_param_order(self):
+        archive = rsl.ResponseArchive(self.archive_path)
+        self.assertEqual(archive.get("/cgi", "a=1&b=2"), None)
+        archive.put("/cgi", "a=1&b=2", "<html>page</html>")
+        self.assertEqual(archive.get("/cgi", "b=2&a=1"), "<html>page</html>")
+        self.assertEqual(archive.get("/cgi", "a=1&b=3"), None)
+
+    def test_offline_miss_raises(self):
+        archive = rsl.ResponseArchive(self.archive_path, offline=True)
+        self.assertRaises(rsl.ArchiveMissException, archive.get, "/cgi", "a=1")
+
+    def test_evicts_least_recently_used(self):
+        archive = rsl.ResponseArchive(self.archive_path, max_bytes=10 ** 6)
+        page = os.urandom(300 * 1024)
+        for i in range(3):
+            archive.put("/cgi", "page=%d" % i, page)
+            path = archive.path_for_key(rsl.ResponseArchive.request_key(
+                    "/cgi", "page=%d" % i))
+            os.utime(path, (1000 + i, 1000 + i))
+        archive.get("/cgi", "page=0")
+        archive.put("/cgi", "page=3", page)
+        self.assertEqual(archive.get("/cgi", "page=1"), None)
+        self.assertEqual(archive.get("/cgi", "page=0"), page)
+        self.assertEqual(archive.get("/cgi", "page=3"), page)
+
+    def test_rearchiving_a_page_keeps_its_size(self):
+        archive = rsl.ResponseArchive(self.archive_path, max_bytes=10 ** 6)
+        page = os.urandom(300 * 1024)
+        for i in range(3):
+            archive.put("/cgi", "page=0", page)
+        archive.put("/cgi", "page=1", page)
+        archive.put("/cgi", "page=2", page)
+        self.assertEqual(archive.get("/cgi", "page=0"), page)
+        self.assertEqual(archive.size_bytes, sum(
+                size for mtime, size, path in archive.entries()))
+
+class TestRecordTypes(unittest.TestCase):
+    record = {'id': 'J1-00', 'date': '02/01/2011', 'doctype': 'DEED',
+              'grantors': ['SMITH JOHN'], 'grantees': ['DOE JANE'],
+              'reel_image': ['K614,0694'], 'apn': ['0619-108', '0619-109']}
+
+    def test_record_round_trip(self):
+        record = rsl.Record.from_dict(self.record)
+        self.assertEqual(record.to_dict(), self.record)
+        self.assertEqual(rsl.encode_record(record), json.dumps(self.record))
+        self.assertEqual(record['apn'], ['0619-108', '0619-109'])
+        record['apn'] += ['0619-110']
+        self.assertEqual(record.apn, ('0619-108', '0619-109', '0619-110'))
+        self.assertRaises(KeyError, record.__getitem__, 'owner')
+
+    def test_record_strings_are_interned(self):
+        other = dict(self.record, id='J2-00', date=u'02/01/2011')
+        strings = rsl.StringInterner()
+        first = rsl.Record.from_dict(self.record, strings)
+        second = rsl.Record.from_dict(json.loads(json.dumps(other)), strings)
+        self.assertTrue(first.date is second.date)
+        self.assertTrue(first.grantors[0] is second.grantors[0])
+        self.assertEqual(len(strings.strings), 7)
+        # Without an interner nothing is kept beyond the records.
+        third = rsl.Record.from_dict(json.loads(json.dumps(other)))
+        self.assertFalse(third.date is first.date)
+        self.assertEqual(len(strings.strings), 7)
+
+    def test_record_row(self):
+        row = rsl.RecordRow({'Document': 'J1-00', 'Name': 'SMITH JOHN'})
+        self.assertEqual(sorted(row.keys()), ['Document', 'Name'])
+        self.assertEqual(row['Name'], 'SMITH JOHN')
+        self.assertEqual(row.get('APN', ''), '')
+        self.assertFalse('APN' in row)
+        self.assertEqual(row, {'Document': 'J1-00', 'Name': 'SMITH JOHN'})
+
+class TestRecordOutput(unittest.TestCase):
+    records = [{'id': 'J1-00', 'apn': ['0619-108'], 'grantors': [u'\xe9']},
+               {'id': 'J2-00', 'apn': [], 'grantors': []}]
+
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_path)
+
+    def test_round_trip(self):
+        for output_format in recordOutput.OUTPUT_FORMATS:
+            path = os.path.join(self.output_path, "DEED_20110201" +
+                                recordOutput.output_extension(output_format))
+            with recordOutput.RecordWriter(path, output_format) as writer:
+                writer.write_all(self.records)
+            self.assertFalse(os.path.exists(writer.tmp_path))
+            self.assertEqual(list(recordOutput.iter_records(path)),
+                             self.records)
+            self.assertTrue(all(isinstance(record, rsl.Record) for record in
+                                recordOutput.iter_records(path, True)))
+
+    def test_json_matches_dumps(self):
+        path = os.path.join(self.output_path, "DEED_20110201.json")
+        with recordOutput.RecordWriter(path) as writer:
+            writer.write_all(self.records)
+        self.assertEqual(open(path).read(), json.dumps(self.records))
+        with recordOutput.RecordWriter(path) as writer:
+            pass
+        self.assertEqual(open(path).read(), "[]")
+
+    def test_failed_write_leaves_no_file(self):
+        path = os.path.join(self.output_path, "DEED_20110201.jsonl.gz")
+        try:
+            with recordOutput.RecordWriter(path, 'jsonl.gz') as writer:
+                writer.write(self.records[0])
+                raise rsl.DSException("Injected failure")
+        except rsl.DSException:
+            pass
+        self.assertEqual(os.listdir(self.output_path), [])
+
+class TestRecordStore(unittest.TestCase):
+    records = [
+        {'id': 'J1-00', 'date': '02/01/2011', 'doctype': 'DEED',
+         'grantors': ['SMITH JOHN'], 'grantees': ['DOE, JANE '],
+         'reel_image': ['K614,0694'], 'apn': ['0619-108', '0619-109']},
+        {'id': 'J2-00', 'date': '02/02/2011', 'doctype': 'DEED',
+         'grantors': ['DOE JANE'], 'grantees': ['SMITHSON ANN'],
+         'reel_image': [], 'apn': ['0619-108']}]
+
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+        with recordOutput.RecordWriter(os.path.join(
+                self.output_path, "DEED_20110201.json")) as writer:
+            writer.write(self.records[0])
+        with recordOutput.RecordWriter(os.path.join(
+                self.output_path, "DEED_20110202.jsonl.gz"),
+                                       'jsonl.gz') as writer:
+            writer.write(self.records[1])
+        open(os.path.join(self.output_path, "DEED_20110203.json_BAD_READ"),
+             'w').close()
+        self.store = recordStore.RecordStore(
+            os.path.join(self.output_path, "deeds.db"))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.output_path)
+
+    def test_ingest_is_idempotent(self):
+        self.assertEqual(self.store.ingest_directory(self.output_path),
+                         (2, 2))
+        self.assertEqual(self.store.ingest_directory(self.output_path),
+                         (0, 0))
+        self.store.upsert(self.records)
+        self.assertEqual(self.store.records_between('20110101', '20111231'),
+                         self.records)
+        self.assertEqual(self.store.get('J1-00'), self.records[0])
+        self.assertEqual(self.store.get('J3-00'), None)
+
+    def test_reingest_removes_dropped_documents(self):
+        path = os.path.join(self.output_path, "DEED_20110201.json")
+        dropped = dict(self.records[0], id='J3-00', apn=['0619-110'])
+        with recordOutput.RecordWriter(path) as writer:
+            writer.write_all([self.records[0], dropped])
+        other = os.path.join(self.output_path, "DEED_OF_TRUST_20110201.json")
+        with recordOutput.RecordWriter(other) as writer:
+            writer.write(self.records[0])
+        self.store.ingest_directory(self.output_path)
+        self.assertEqual(self.store.get('J3-00'), dropped)
+        # A fixed parser finds neither document, and the file shrinks.
+        with recordOutput.RecordWriter(path) as writer:
+            writer.write_all([])
+        self.assertEqual(self.store.ingest_file(path), 0)
+        self.assertEqual(self.store.get('J3-00'), None)
+        self.assertEqual(self.store.records_for_apn('0619-110'), [])
+        # J1-00 is still listed in the other file.
+        self.assertEqual(self.store.get('J1-00'), self.records[0])
+
+    def test_lookups(self):
+        self.store.ingest_directory(self.output_path)
+        self.assertEqual(self.store.records_for_apn('0619-108 '),
+                         self.records)
+        self.assertEqual(self.store.records_for_apn('0619-109'),
+                         self.records[0:1])
+        self.assertEqual(self.store.records_for_name('doe jane'),
+                         self.records)
+        self.assertEqual(self.store.records_for_name('DOE JANE', 'grantors'),
+                         self.records[1:])
+        self.assertEqual(self.store.records_for_name('SMITH'), [])
+        self.assertEqual(self.store.records_for_name('SMITH', prefix=True),
+                         self.records)
+
+class TestRecordRollups(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.rollups_path = os.path.join(self.output_dir, "rollups.db")
+        self.rollups = recordRollups.RecordRollups(self.rollups_path)
+
+    def tearDown(self):
+        self.rollups.close()
+        shutil.rmtree(self.output_dir)
+
+    def write_day(self, filename, records, mtime=None):
+        path = os.path.join(self.output_dir, filename)
+        with recordOutput.RecordWriter(path, 'json') as writer:
+            writer.write_all([dict(record, grantors=[], grantees=[],
+                                   reel_image=[]) for record in records])
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_transfers(self):
+        self.write_day("DEED_20110201.json", [
+                {'id': 'J1-00', 'date': '02/01/2011', 'doctype': 'DEED',
+                 'apn': ['2004-062', '2004-063', '0619-108']},
+                {'id': 'J2-00', 'date': '02/01/2011', 'doctype': 'DEED',
+                 'apn': ['2004-062']}])
+        self.write_day("DEED_OF_TRUST_20110201.json", [
+                {'id': 'J3-00', 'date': '02/01/2011',
+                 'doctype': 'DEED OF TRUST', 'apn': ['2004-062']},
+                # Also listed as a deed; counts once.
+                {'id': 'J2-00', 'date': '02/01/2011', 'doctype': 'DEED',
+                 'apn': ['2004-062']}])
+        self.write_day("DEED_20110302.json", [
+                {'id': 'J4-00', 'date': '03/02/2011', 'doctype': 'DEED',
+                 'apn': ['2004-070']}])
+        self.assertEqual(self.rollups.update(self.output_dir), (3, 0))
+        self.assertEqual(self.rollups.transfers("2004", "DEED"),
+                         [("201102", 2), ("201103", 1)])
+        self.assertEqual(self.rollups.transfers(),
+                         [("201102", 3), ("201103", 1)])
+        self.assertEqual(self.rollups.transfers("0619", start_month="201102",
+                                                end_month="201102"),
+                         [("201102", 1)])
+
+        # Only the changed file is folded in again; removed ones go.
+        self.write_day("DEED_20110302.json", [
+                {'id': 'J4-00', 'date': '03/02/2011', 'doctype': 'DEED',
+                 'apn': ['2004-070']},
+                {'id': 'J5-00', 'date': '03/02/2011', 'doctype': 'DEED',
+                 'apn': ['2004-071']}], mtime=2000000000)
+        os.remove(os.path.join(self.output_dir, "DEED_OF_TRUST_20110201.json"))
+        self.assertEqual(self.rollups.update(self.output_dir), (1, 1))
+        self.assertEqual(self.rollups.transfers(),
+                         [("201102", 2), ("201103", 2)])
+        self.assertEqual(self.rollups.transfers(doctype="DEED OF TRUST"), [])
+        self.assertEqual(self.rollups.update(self.output_dir), (0, 0))
+
+    def test_resales(self):
+        def sale(document_id, date):
+            return {'id': document_id, 'date': date, 'doctype': 'DEED',
+                    'apn': ['2004-062']}
+        self.write_day("DEED_20050110.json", [sale('J1-00', '01/10/2005')])
+        self.write_day("DEED_20110201.json", [sale('J2-00', '02/01/2011')])
+        self.rollups.update(self.output_dir)
+        self.assertEqual(self.rollups.resales("2004"),
+                         [("201102", {5: (1, 2213)})])
+        # A sale in between splits the interval.
+        self.write_day("DEED_20100201.json", [sale('J3-00', '02/01/2010')])
+        self.rollups.update(self.output_dir)
+        self.assertEqual(self.rollups.resales(),
+                         [("201002", {5: (1, 1848)}),
+                          ("201102", {0: (1, 365)})])
+
+class TestAPNIndex(unittest.TestCase):
+    records = [
+        {'id': 'J2-00', 'date': '03/01/2011', 'doctype': 'DEED',
+         'grantors': [], 'grantees': [], 'reel_image': [],
+         'apn': ['0619-108', '', 'BOGUS']},
+        {'id': 'J1-00', 'date': '02/01/2011', 'doctype': 'DEED',
+         'grantors': [], 'grantees': [], 'reel_image': [],
+         'apn': ['0619-108', '0619-109']}]
+
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.output_path, "index")
+        with recordOutput.RecordWriter(os.path.join(
+                self.output_path, "DEED_20110301.jsonl"), 'jsonl') as writer:
+            writer.write_all(self.records)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_path)
+
+    def test_history_in_date_order(self):
+        self.assertEqual(apnIndex.build_index(self.output_path,
+                                              self.index_path), (2, 3))
+        index = apnIndex.APNIndex(self.index_path)
+        try:
+            self.assertEqual(index.history('0619-108'),
+                             [self.records[1], self.records[0]])
+            self.assertEqual(index.history(' 0619-109'), self.records[1:])
+            self.assertEqual(index.history('0619-10'), [])
+            self.assertEqual(index.history('9999-999'), [])
+            self.assertEqual(index.history('BOGUS'), [])
+        finally:
+            index.close()
+
+    def test_indexes_each_document_once(self):
+        # The same documents in a second format and under another type,
+        # the later copy of J1-00 with its grantee filled in.
+        with recordOutput.RecordWriter(os.path.join(
+                self.output_path, "DEED_20110301.json"), 'json') as writer:
+            writer.write_all(self.records)
+        updated = dict(self.records[1], grantees=['SMITH JOHN'])
+        with recordOutput.RecordWriter(os.path.join(
+                self.output_path, "DEED_OF_TRUST_20110301.jsonl"),
+                                       'jsonl') as writer:
+            writer.write_all([updated])
+        self.assertEqual(apnIndex.build_index(self.output_path,
+                                              self.index_path), (2, 3))
+        index = apnIndex.APNIndex(self.index_path)
+        try:
+            self.assertEqual(index.history('0619-108'),
+                             [updated, self.records[0]])
+            self.assertEqual(index.history('0619-109'), [updated])
+        finally:
+            index.close()
+
+    def test_rejects_mismatched_records(self):
+        apnIndex.build_index(self.output_path, self.index_path)
+        f = open(os.path.join(self.index_path, apnIndex.RECORDS_FILENAME),
+                 'a')
+        f.write("\n")
+        f.close()
+        self.assertRaises(ValueError, apnIndex.APNIndex, self.index_path)
+
+def exit_benchmark():
+    os._exit(3)
+
+class TestBenchmarkScraper(unittest.TestCase):
+    def test_scale_page(self):
+        page = benchmarkScraper.read_testdata(
+            benchmarkScraper.DATE_QUERY_PAGES[0])
+        records = benchmarkScraper.parse_page(
+            rsl.HTMLRecordsDateQueryParser, 'fast', page)
+        scaled = benchmarkScraper.parse_page(
+            rsl.HTMLRecordsDateQueryParser, 'fast',
+            benchmarkScraper.scale_page(page, 3))
+        self.assertEqual(len(scaled), 3 * len(records))
+        self.assertEqual(benchmarkScraper.count_rows(scaled),
+                         3 * benchmarkScraper.count_rows(records))
+        self.assertEqual(scaled['J10129644-00'][0]['APNLink'],
+                         records['J129644-00'][0]['APNLink'].replace(
+                             '5198143', '15198143'))
+
+    def test_compare_runs(self):
+        baseline = {'results': {'a': {'best_s': 1.0}, 'b': {'best_s': 1.0}}}
+        current = {'results': {'a': {'best_s': 1.1}, 'b': {'best_s': 2.0},
+                               'c': {'best_s': 1.0}}}
+        comparison, regressions = benchmarkScraper.compare_runs(
+            baseline, current)
+        self.assertEqual([entry[0] for entry in comparison], ['a', 'b'])
+        self.assertEqual(regressions, ['b'])
+
+    def test_run_benchmark_reports_dead_child(self):
+        self.assertEqual(benchmarkScraper.run_benchmark(exit_benchmark, ()),
+                         {'error': "Benchmark process exited with code 3"})
+
+class TestCRIISStubServer(unittest.TestCase):
+    def setUp(self):
+        self.saved = (rsl.CRIISCaller.website, rsl.CRIISCaller.rate_controller,
+                      rsl.CRIISCaller.retry_budget,
+                      rsl.CRIISCaller.circuit_breaker, rsl.CRIISCaller.sessions)
+        rsl.CRIISCaller.rate_controller = rsl.RateController(
+            rate=1000, min_rate=500, max_rate=1000, base_backoff=0.001)
+        rsl.CRIISCaller.retry_budget = rsl.RetryBudget()
+        rsl.CRIISCaller.circuit_breaker = rsl.CircuitBreaker()
+        rsl.CRIISCaller.sessions = rsl.CRIISSessionPool()
+        self.server = None
+
+    def tearDown(self):
+        rsl.CRIISCaller.sessions.close()
+        (rsl.CRIISCaller.website, rsl.CRIISCaller.rate_controller,
+         rsl.CRIISCaller.retry_budget, rsl.CRIISCaller.circuit_breaker,
+         rsl.CRIISCaller.sessions) = self.saved
+        if self.server is not None:
+            self.server.stop()
+
+    def start_server(self, **behavior):
+        self.server = criisStubServer.CRIISStubServer(
+            behavior=criisStubServer.StubBehavior(**behavior)).start()
+        rsl.CRIISCaller.website = self.server.website
+
+    def test_fetch_day(self):
+        self.start_server()
+        records = rsl.fetch_records_for_daterange("02012011", "02012011",
+                                                  "001")
+        self.assertEqual(len(records), 67)
+        self.assertEqual(set(record['date'] for record in records),
+                         set(["02/01/2011"]))
+        self.assertTrue(all(record['apn'] for record in records))
+        stats = self.server.get_stats()
+        self.assertEqual(stats['date_queries'], 1)
+        self.assertEqual(stats['apn_queries'], 67)
+
+    def test_retries_injected_faults(self):
+        self.start_server(fault_plan=('error', None, 'drop', None, None,
+                                      'drop'))
+        records = rsl.fetch_records_for_daterange("02012011", "02012011",
+                                                  "001")
+        self.assertEqual(len(records), 67)
+        stats = self.server.get_stats()
+        self.assertEqual(stats['error'], 1)
+        self.assertEqual(stats['drop'], 2)
+        self.assertEqual(stats['date_queries'], 2)
+
+    def test_session_reuses_connections_across_days(self):
+        self.start_server(keep_alive=True, gzip=True)
+        for day in ("02012011", "02022011"):
+            records = rsl.fetch_records_for_daterange(day, day, "001",
+                                                      apn_concurrency=2)
+            self.assertTrue(all(record['apn'] for record in records))
+        stats = rsl.CRIISCaller.sessions.stats()
+        server_stats = self.server.get_stats()
+        self.assertEqual(stats['requests'], server_stats['requests'])
+        self.assertEqual(stats['connections'], server_stats['connections'])
+        # One connection per APN worker and one for the date queries.
+        self.assertEqual(stats['connections'], 3)
+        self.assertTrue(stats['wire_bytes'] < stats['page_bytes'] / 2)
+        self.assertEqual(stats['wire_bytes'], server_stats['body_bytes'])
+
+    def test_resends_on_closed_keep_alive_connection(self):
+        self.start_server(keep_alive=True, fault_plan=(None, None, 'drop'))
+        caller = rsl.CRIISCallerAPNQuery()
+        apn_url = ("/cgi-bin/new_get_recorded.cgi?l_doc_ref_no=7&"
+                   "COUNTY=sanfrancisco")
+        first = caller.fetch(apn_url)
+        self.assertEqual(caller.fetch(apn_url), first)
+        self.assertEqual(caller.session.connections, 2)
+        self.assertEqual(caller.session.requests, 5)
+        self.assertEqual(self.server.get_stats()['drop'], 1)
+        caller.close_connection()
+
+    def test_retry_budget_bounds_retries(self):
+        self.start_server(error_rate=1.0)
+        rsl.CRIISCaller.retry_budget = rsl.RetryBudget(max_balance=1.0)
+        self.assertRaises(rsl.DSException, rsl.fetch_records_for_daterange,
+                          "02012011", "02012011", "001")
+        self.assertEqual(self.server.get_stats()['error'], 2)
+
+    def test_server_errors_open_the_circuit(self):
+        self.start_server(error_rate=1.0)
+        for fetch in (rsl.fetch_records_for_daterange,
+                      rsa.fetch_records_for_daterange):
+            rsl.CRIISCaller.circuit_breaker = rsl.CircuitBreaker(
+                failure_threshold=3, cooldown=60.0)
+            self.assertRaises(rsl.DSException, fetch, "02012011",
+                              "02012011", "001")
+            self.assertEqual(rsl.CRIISCaller.circuit_breaker.state, 'open')
+            self.assertEqual(rsl.CRIISCaller.circuit_breaker.failures, 3)
+
+    def test_server_errors_slow_the_rate_down(self):
+        self.start_server(error_rate=1.0)
+        for fetch in (rsl.fetch_records_for_daterange,
+                      rsa.fetch_records_for_daterange):
+            controller = rsl.RateController(rate=1000, min_rate=10,
+                                            max_rate=1000, base_backoff=0.001)
+            rsl.CRIISCaller.rate_controller = controller
+            self.assertRaises(rsl.DSException, fetch, "02012011",
+                              "02012011", "001")
+            # No response counted as a success, every one as a failure.
+            self.assertEqual(controller.latency, None)
+            self.assertTrue(controller.timeout_rate > 0.2)
+            self.assertTrue(controller.rate <= 500)
+
+    def test_fetch_day_with_parse_workers(self):
+        rsl.start_parse_workers(2)
+        try:
+            self.start_server()
+            records = rsl.fetch_records_for_daterange("02012011", "02012011",
+                                                      "001")
+        finally:
+            rsl.stop_parse_workers()
+        self.assertEqual(len(records), 67)
+        self.assertTrue(all(record['apn'] for record in records))
+
+    def test_multi_day_page(self):
+        server = criisStubServer.CRIISStubServer()
+        try:
+            page = server.date_query_page(datetime.date(2011, 2, 1),
+                                          datetime.date(2011, 2, 3))
+        finally:
+            server.server_close()
+        parser = rsl.HTMLRecordsDateQueryParser()
+        parser.feed(page)
+        records = parser.get_records()
+        self.assertEqual(parser.report_pages, 15)
+        self.assertEqual(len(records), 3 * 67)
+        self.assertEqual(
+            sorted(set(rows[0]['RecordDate'] for rows in records.values())),
+            ["02/01/2011", "02/02/2011", "02/03/2011"])
+
+    def test_bulk_run_fetches_queued_blocklots(self):
+        self.start_server(keep_alive=True)
+        work_dir = tempfile.mkdtemp()
+        try:
+            queue = rsl.WorkQueue(os.path.join(work_dir, "queue.db"),
+                                  max_attempts=1)
+            queue.add(bulkScraper.read_apn_list(
+                    ["# parcels\n", "3731-048\n", "\n", "0619-108 \n"]))
+            options = dict(rs.default_options(), workers=2)
+            stats = bulkScraper.run_queue(queue, work_dir, options)
+            self.assertEqual(sorted(stats), [("0619-108", "done"),
+                                             ("3731-048", "done")])
+            self.assertEqual(queue.counts()['done'], 2)
+            queue.close()
+            records = list(recordOutput.iter_records(
+                    os.path.join(work_dir, "APN_3731-048.json")))
+            self.assertTrue(records)
+            self.assertTrue(all(record['apn'] for record in records))
+            self.assertEqual(self.server.get_stats()['blocklot_queries'], 2)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_bulk_run_fails_blocklot_after_max_attempts(self):
+        self.start_server(error_rate=1.0)
+        work_dir = tempfile.mkdtemp()
+        try:
+            queue = rsl.WorkQueue(os.path.join(work_dir, "queue.db"),
+                                  max_attempts=2)
+            queue.add(["3731-048"])
+            options = dict(rs.default_options(), workers=1)
+            stats = bulkScraper.run_queue(queue, work_dir, options)
+            self.assertEqual(stats, [("3731-048", "pending"),
+                                     ("3731-048", "failed")])
+            self.assertEqual(queue.failures()[0][0:2], ("3731-048", 2))
+            queue.close()
+            self.assertFalse(os.path.exists(
+                    os.path.join(work_dir, "APN_3731-048.json")))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_multi_type_run_looks_up_shared_documents_once(self):
+        # The stub lists the same documents under every record type.
+        self.start_server(keep_alive=True)
+        work_dir = tempfile.mkdtemp()
+        saved_run_documents = rs.RUN_DOCUMENTS
+        rs.RUN_DOCUMENTS = rsl.RunDocuments()
+        try:
+            options = rs.parse_commandline_arguments(
+                ["recordScraper.py", "20110201:20110202",
+                 "DEED,DEED_OF_TRUST,DEED", work_dir])[4]
+            self.assertEqual(rs.parse_commandline_arguments(
+                    ["recordScraper.py", "20110201:20110202",
+                     "DEED,DEED_OF_TRUST,DEED", work_dir])[2],
+                             ["DEED", "DEED_OF_TRUST"])
+            pending = [(cur_date, record_type_name)
+                       for record_type_name in ("DEED", "DEED_OF_TRUST")
+                       for cur_date in ("02012011", "02022011")]
+            self.assertEqual(
+                [(window, record_type_name) for window, record_type_name in
+                 rs.plan_windows(pending, 1)],
+                [(["02012011"], "DEED"), (["02012011"], "DEED_OF_TRUST"),
+                 (["02022011"], "DEED"), (["02022011"], "DEED_OF_TRUST")])
+            self.assertEqual(rs.run_serial(pending, work_dir, options), [])
+            stats = self.server.get_stats()
+            self.assertEqual(stats['date_queries'], 4)
+            # 67 documents on the first day, 96 on the second.
+            self.assertEqual(stats['apn_queries'], 67 + 96)
+            # One for the date queries, one per APN lookup thread.
+            self.assertEqual(stats['connections'],
+                             1 + options['apn_concurrency'])
+            for record_type_name in ("DEED", "DEED_OF_TRUST"):
+                records = list(recordOutput.iter_records(os.path.join(
+                            work_dir, "%s_20110201.json" % record_type_name)))
+                self.assertEqual(len(records), 67)
+                self.assertTrue(all(record['apn'] for record in records))
+        finally:
+            rs.RUN_DOCUMENTS = saved_run_documents
+            shutil.rmtree(work_dir)
+
+    def test_scheduled_multi_type_run_looks_up_shared_documents_once(self):
+        self.start_server(keep_alive=True)
+        work_dir = tempfile.mkdtemp()
+        # The workers' rate controllers start at full speed.
+        rate_controller_class = rsl.RateController
+        rsl.RateController = lambda **kwargs: rate_controller_class(
+            rate=1000, **kwargs)
+        try:
+            options = rs.parse_commandline_arguments(
+                ["recordScraper.py", "--processes=2", "--max-rate=1000",
+                 "--website=%s" % self.server.website, "20110201:20110202",
+                 "DEED,DEED_OF_TRUST", work_dir])[4]
+            pending = [(cur_date, record_type_name)
+                       for record_type_name in ("DEED", "DEED_OF_TRUST")
+                       for cur_date in ("02012011", "02022011")]
+            self.assertEqual(rs.group_windows(rs.plan_windows(pending, 1)),
+                             [(["02012011"], ["DEED", "DEED_OF_TRUST"]),
+                              (["02022011"], ["DEED", "DEED_OF_TRUST"])])
+            self.assertEqual(rs.run_scheduled(pending, work_dir, options), [])
+            stats = self.server.get_stats()
+            self.assertEqual(stats['date_queries'], 4)
+            self.assertEqual(stats['apn_queries'], 67 + 96)
+            for record_type_name in ("DEED", "DEED_OF_TRUST"):
+                self.assertEqual(len(list(recordOutput.iter_records(
+                                os.path.join(work_dir, "%s_20110202.json" %
+                                             record_type_name)))), 96)
+        finally:
+            rsl.RateController = rate_controller_class
+            shutil.rmtree(work_dir)
+
+    def test_calendar_checks_or_skips_closed_days(self):
+        self.start_server(closed_days=True)
+        work_dir = tempfile.mkdtemp()
+        try:
+            # Friday 02/04/2011 to Monday 02/07/2011.
+            pending = [(cur_date, "DEED") for cur_date in
+                       ("02042011", "02052011", "02062011", "02072011")]
+            for mode, date_queries in (('check', 4), ('skip', 2)):
+                options = rs.parse_commandline_arguments(
+                    ["recordScraper.py", "--calendar=%s" % mode,
+                     "20110204:20110207", "DEED", work_dir])[4]
+                empty_before = recordMetrics.METRICS.counter_value(
+                    'empty_checks_total', result='empty')
+                queries_before = self.server.get_stats().get(
+                    'date_queries', 0)
+                self.assertEqual(rs.run_serial(rs.plan_days(
+                            pending, work_dir, options), work_dir, options),
+                                 [])
+                self.assertEqual(self.server.get_stats()['date_queries'] -
+                                 queries_before, date_queries)
+                if mode == 'check':
+                    self.assertEqual(recordMetrics.METRICS.counter_value(
+                            'empty_checks_total', result='empty') -
+                                     empty_before, 2)
+                self.assertEqual(len(list(recordOutput.iter_records(
+                                os.path.join(work_dir, "DEED_20110205.json")))),
+                                 0)
+                self.assertEqual(len(list(recordOutput.iter_records(
+                                os.path.join(work_dir, "DEED_20110207.json")))),
+                                 67)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_async_fetch_matches_threaded_fetch(self):
+        self.start_server(keep_alive=True)
+        records = rsl.fetch_records_for_daterange("02012011", "02012011",
+                                                  "001")
+        before = self.server.get_stats()
+        self.assertEqual(rsa.fetch_records_for_daterange(
+                "02012011", "02012011", "001", pool_size=4), records)
+        stats = self.server.get_stats()
+        self.assertEqual(stats['date_queries'] - before['date_queries'], 1)
+        self.assertEqual(stats['apn_queries'] - before['apn_queries'], 67)
+        # Every POST is redirected to a results page.
+        self.assertEqual(stats['results'] - before['results'], 68)
+        self.assertTrue(stats['connections'] - before['connections'] <= 4)
+
+    def test_async_fetch_retries_injected_faults(self):
+        self.start_server(keep_alive=True)
+        records = rsl.fetch_records_for_daterange("02012011", "02012011",
+                                                  "001")
+        self.server.stop()
+        # A dropped date query, a failed and a dropped results page, and
+        # some results pages cut off halfway.
+        self.start_server(keep_alive=True, truncate_rate=0.05, seed=7,
+                          fault_plan=('drop', None, 'error', None, None,
+                                      'drop'))
+        self.assertEqual(rsa.fetch_records_for_daterange(
+                "02012011", "02012011", "001", pool_size=4), records)
+        stats = self.server.get_stats()
+        self.assertEqual(stats['drop'], 2)
+        self.assertEqual(stats['error'], 1)
+        self.assertTrue(stats['truncated'] >= 1)
+
+    def test_async_fetch_checks_for_empty_reports(self):
+        self.start_server(closed_days=True)
+        empty_before = recordMetrics.METRICS.counter_value(
+            'empty_checks_total', result='empty')
+        # Saturday 02/05/2011, then Monday 02/07/2011.
+        self.assertEqual(rsa.fetch_records_for_daterange(
+                "02052011", "02052011", "001", check_empty=True), [])
+        self.assertEqual(recordMetrics.METRICS.counter_value(
+                'empty_checks_total', result='empty') - empty_before, 1)
+        self.assertEqual(len(rsa.fetch_records_for_daterange(
+                    "02072011", "02072011", "001", check_empty=True)), 67)
+
+    def test_daemon_fetches_off_peak_and_pauses_at_peak(self):
+        self.start_server()
+        work_dir = tempfile.mkdtemp()
+        try:
+            queue = rsl.WorkQueue(os.path.join(work_dir, "queue.db"))
+            scraperDaemon.queue_backfill(queue, "20110201:20110201")
+            scraperDaemon.queue_catch_up(queue, datetime.date(2011, 2, 3), 1)
+            schedule = scraperDaemon.OffPeakSchedule.parse("07:00-19:00")
+            options = dict(rs.default_options(), peak_rate=0,
+                           peak_apn_concurrency=1, off_peak_rate=1000,
+                           off_peak_apn_concurrency=4)
+            peak = datetime.datetime(2011, 2, 3, 12, 0)
+            night = datetime.datetime(2011, 2, 3, 23, 0)
+            self.assertEqual(scraperDaemon.run_once(
+                    queue, "a", schedule, peak, "DEED", work_dir, options),
+                             'paused')
+            self.assertEqual([scraperDaemon.run_once(
+                        queue, "a", schedule, night, "DEED", work_dir,
+                        options) for idx in range(3)],
+                             ["20110202", "20110201", 'idle'])
+            self.assertEqual(options['apn_concurrency'], 4)
+            self.assertEqual(queue.counts()['done'], 2)
+            queue.close()
+            self.assertTrue(os.path.exists(
+                    os.path.join(work_dir, "DEED_20110201.json")))
+            self.assertEqual(self.server.get_stats()['date_queries'], 2)
+        finally:
+            shutil.rmtree(work_dir)
+
+class TestRecordCalendar(unittest.TestCase):
+    def test_county_holidays(self):
+        holidays = recordCalendar.county_holidays(2010)
+        # Independence Day was a Sunday, New Year's Day 2011 a Saturday.
+        self.assertEqual(holidays[datetime.date(2010, 7, 5)],
+                         "Independence Day")
+        self.assertEqual(holidays[datetime.date(2010, 12, 31)],
+                         "New Year's Day")
+        self.assertEqual(holidays[datetime.date(2010, 11, 26)],
+                         "Day after Thanksgiving")
+        self.assertEqual(holidays[datetime.date(2010, 5, 31)], "Memorial Day")
+        self.assertEqual(len(holidays), 12)
+
+    def test_planner_learns_empty_days(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            for day, records in (("20081224", []), ("20091224", []),
+                                 ("20090105", []), ("20110205", []),
+                                 ("20090106", [{'id': 'J1-00'}]),
+                                 ("20100106", [])):
+                with recordOutput.RecordWriter(os.path.join(
+                        output_dir, "DEED_%s.json" % day), 'json') as writer:
+                    writer.write_all(records)
+            learned = recordCalendar.learn_empty_days(output_dir, "DEED")
+            self.assertEqual(learned, set([(12, 24)]))
+            self.assertEqual(recordCalendar.learn_empty_days(
+                    output_dir, "DEED_OF_TRUST"), set())
+        finally:
+            shutil.rmtree(output_dir)
+        planner = recordCalendar.DatePlanner(learned)
+        self.assertEqual(planner.reason(datetime.date(2011, 2, 5)), "weekend")
+        self.assertEqual(planner.reason(datetime.date(2011, 1, 17)),
+                         "Martin Luther King Jr. Day")
+        self.assertEqual(planner.reason(datetime.date(2012, 12, 24)),
+                         "empty in earlier years")
+        self.assertEqual(planner.reason(datetime.date(2011, 2, 4)), None)
+
+    def test_skipped_days_are_not_learned(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            # Found empty on 03/16 in 2009 and 2010, both weekdays.
+            for day in ("20090316", "20100316"):
+                with recordOutput.RecordWriter(os.path.join(
+                        output_dir, "DEED_%s.json" % day), 'json') as writer:
+                    writer.write_all([])
+            options = rs.parse_commandline_arguments(
+                ["recordScraper.py", "--calendar=skip", "20110316:20110316",
+                 "DEED", output_dir])[4]
+            self.assertEqual(rs.plan_days([("03162011", "DEED")], output_dir,
+                                          options), [])
+            self.assertTrue(os.path.exists(os.path.join(
+                        output_dir, "DEED_20110316.json_SKIPPED")))
+            self.assertEqual(recordCalendar.is_empty_output(os.path.join(
+                        output_dir, "DEED_20110316.json")), None)
+            self.assertEqual(recordCalendar.learn_empty_days(
+                    output_dir, "DEED", min_years=3), set())
+            self.assertEqual(rs.find_days_to_repair(["03162011"], output_dir,
+                                                    "DEED"), ["03162011"])
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_check_empty_page(self):
+        page = open('./testdata/datequery_doc_type_list1.html').read()
+        chunks = [page[idx:idx + 4096] for idx in range(0, len(page), 4096)]
+        self.assertEqual("".join(rsl.check_empty_page(iter(chunks))), page)
+        empty = criisStubServer.CRIISStubServer(
+            behavior=criisStubServer.StubBehavior(closed_days=True))
+        try:
+            empty_page = empty.date_query_page(datetime.date(2011, 2, 5),
+                                               datetime.date(2011, 2, 5))
+        finally:
+            empty.server_close()
+        self.assertEqual(list(rsl.check_empty_page([empty_page[:5000],
+                                                    empty_page[5000:]])), [])
+        self.assertRaises(rsl.DSException, list,
+                          rsl.check_empty_page([empty_page[:5000]]))
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+        self.now = [1000000.0]
+        self.queue = self.open_queue()
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.queue_dir)
+
+    def open_queue(self):
+        queue = rsl.WorkQueue(os.path.join(self.queue_dir, "queue.db"),
+                              lease_seconds=60, max_attempts=2)
+        queue.clock = lambda: self.now[0]
+        return queue
+
+    def test_lease_and_complete(self):
+        self.assertEqual(self.queue.add(["1-1", "1-2", "1-3"]), 3)
+        self.assertEqual(self.queue.add(["1-3", "1-4"]), 1)
+        other = self.open_queue()
+        try:
+            self.assertEqual(self.queue.lease("a", 2), ["1-1", "1-2"])
+            self.assertEqual(other.lease("b", 5), ["1-3", "1-4"])
+            self.assertEqual(other.lease("b"), [])
+            self.assertTrue(self.queue.complete("1-1", "a"))
+            self.assertFalse(other.complete("1-2", "b"))
+        finally:
+            other.close()
+        self.assertEqual(self.queue.counts(), {'pending': 0, 'leased': 3,
+                                               'done': 1, 'failed': 0})
+
+    def test_expired_lease_is_handed_out_again(self):
+        self.queue.add(["1-1"])
+        self.assertEqual(self.queue.lease("a"), ["1-1"])
+        self.now[0] += 30
+        self.assertEqual(self.queue.lease("b"), [])
+        self.now[0] += 60
+        self.assertEqual(self.queue.lease("b"), ["1-1"])
+        self.assertFalse(self.queue.complete("1-1", "a"))
+        self.assertEqual(self.queue.fail("1-1", "a", "late"), None)
+        self.assertTrue(self.queue.complete("1-1", "b"))
+
+    def test_fail_until_max_attempts(self):
+        self.queue.add(["1-1", "1-2"])
+        self.assertEqual(self.queue.lease("a"), ["1-1"])
+        self.assertEqual(self.queue.fail("1-1", "a", "timed out"), 'pending')
+        # Items that failed before go last.
+        self.assertEqual(self.queue.lease("a", 2), ["1-2", "1-1"])
+        self.assertEqual(self.queue.fail("1-1", "a", "timed out"), 'failed')
+        self.assertEqual(self.queue.failures(), [("1-1", 2, "timed out")])
+        self.assertEqual(self.queue.release(), 1)
+        self.assertEqual(self.queue.release(failed=True), 1)
+        self.assertEqual(self.queue.counts()['pending'], 2)
+
+    def test_higher_priority_first(self):
+        self.queue.add(["1-1", "1-2"])
+        self.queue.add(["1-3"], priority=1)
+        self.assertEqual(self.queue.lease("a", 3), ["1-3", "1-1", "1-2"])
+
+    def test_failed_priority_item_stays_first(self):
+        self.queue.add(["1-1", "1-2"])
+        self.queue.add(["1-3"], priority=1)
+        self.assertEqual(self.queue.lease("a"), ["1-3"])
+        self.assertEqual(self.queue.fail("1-3", "a", "timed out"), 'pending')
+        self.assertEqual(self.queue.lease("a"), ["1-3"])
+
+class TestOffPeakSchedule(unittest.TestCase):
+    def setUp(self):
+        self.schedule = scraperDaemon.OffPeakSchedule.parse("07:00-19:00")
+
+    def test_is_peak(self):
+        # 2011-02-01 was a Tuesday.
+        self.assertTrue(self.schedule.is_peak(
+                datetime.datetime(2011, 2, 1, 7, 0)))
+        self.assertFalse(self.schedule.is_peak(
+                datetime.datetime(2011, 2, 1, 19, 0)))
+        self.assertFalse(self.schedule.is_peak(
+                datetime.datetime(2011, 2, 1, 3, 0)))
+        self.assertFalse(self.schedule.is_peak(
+                datetime.datetime(2011, 2, 5, 12, 0)))
+        self.assertRaises(ValueError, scraperDaemon.OffPeakSchedule.parse,
+                          "19:00-07:00")
+
+    def test_next_change(self):
+        self.assertEqual(
+            self.schedule.next_change(datetime.datetime(2011, 2, 1, 12, 0)),
+            datetime.datetime(2011, 2, 1, 19, 0))
+        self.assertEqual(
+            self.schedule.next_change(datetime.datetime(2011, 2, 1, 20, 0)),
+            datetime.datetime(2011, 2, 2, 7, 0))
+        # Friday night runs through the weekend.
+        self.assertEqual(
+            self.schedule.next_change(datetime.datetime(2011, 2, 4, 20, 0)),
+            datetime.datetime(2011, 2, 7, 7, 0))
+
+class TestRecordJournal(unittest.TestCase):
+    def test_load_skips_torn_line(self):
+        journal_dir = tempfile.mkdtemp()
+        try:
+            journal = rsl.RecordJournal(os.path.join(journal_dir, "j"))
+            self.assertEqual(journal.load(), {})
+            journal.append({'id': 'J1-00', 'apn': ['0619-108']})
+            journal.append({'id': 'J2-00', 'apn': []})
+            f = open(journal.path, 'a')
+            f.write('{"id": "J3-')
+            f.close()
+            completed = journal.load()
+            self.assertEqual(sorted(completed.keys()), ['J1-00', 'J2-00'])
+            self.assertEqual(completed['J1-00']['apn'], ['0619-108'])
+            journal.remove()
+            self.assertFalse(os.path.exists(journal.path))
+        finally:
+            shutil.rmtree(journal_dir)
+
+    def test_restore_journaled_records(self):
+        records = [{'id': 'J1-00', 'apn': []}, {'id': 'J2-00', 'apn': []}]
+        journal_dir = tempfile.mkdtemp()
+        try:
+            journal = rsl.RecordJournal(os.path.join(journal_dir, "j"))
+            journal.append({'id': 'J2-00', 'apn': ['0619-108']})
+            pending = rsl.restore_journaled_records(records, journal)
+            self.assertEqual(pending, [0])
+            self.assertEqual(records[1]['apn'], ['0619-108'])
+        finally:
+            shutil.rmtree(journal_dir)
+
+class TestKnownDocuments(unittest.TestCase):
+    def setUp(self):
+        self.known_dir = tempfile.mkdtemp()
+        self.now = [1000000.0]
+        self.known = self.open_known()
+
+    def tearDown(self):
+        self.known.close()
+        shutil.rmtree(self.known_dir)
+
+    def open_known(self, force=False):
+        known = rsl.KnownDocuments(os.path.join(self.known_dir, "known.db"),
+                                   blank_ttl_days=1, force=force)
+        known.clock = lambda: self.now[0]
+        return known
+
+    def test_restore_known_records(self):
+        self.known.add({'id': 'J1-00', 'apn': ['0619-108'],
+                        'reel_image': ['K614,0694']})
+        records = [rsl.Record('J1-00', '02/01/2011', 'DEED'),
+                   rsl.Record('J2-00', '02/01/2011', 'DEED')]
+        self.assertEqual(
+            rsl.restore_known_records(records, [0, 1], self.known), [1])
+        self.assertEqual(records[0]['apn'], ['0619-108'])
+        self.assertEqual(records[0]['reel_image'], ['K614,0694'])
+        forced = self.open_known(force=True)
+        try:
+            self.assertFalse(forced.restore(records[1]))
+            self.assertFalse(forced.restore(records[0]))
+        finally:
+            forced.close()
+
+    def test_blank_reel_image_expires(self):
+        self.known.add({'id': 'J1-00', 'apn': ['0619-108'], 'reel_image': []})
+        record = rsl.Record('J1-00', '02/01/2011', 'DEED')
+        self.now[0] += 3600
+        self.assertTrue(self.known.restore(record))
+        self.now[0] += 86400
+        self.assertFalse(self.known.restore(record))
+
+class TestRecordNormalization(unittest.TestCase):
+    def test_normalize_and_merge(self):
+        f = open('./testdata/datequery_doc_type_list1.html', 'r')
+        datequery_parser = rsl.HTMLRecordsDateQueryParser()
+        datequery_parser.feed(f.read())
+        records = datequery_parser.get_records()
+        record = rsl.normalize_date_query_rows(
+            'J129644-00', records['J129644-00'])
+        self.assertEqual(record['date'], '02/01/2011')
+        self.assertEqual(record['grantors'], ['CALVEY MARK'])
+        self.assertEqual(sorted(record['grantees']),
+                         ['CALVEY MARK', 'MARK CALVEY REVOC TR'])
+
+        f = open('./testdata/apnquery_doc_detail2.html', 'r')
+        apn_parser = rsl.HTMLRecordsAPNParser()
+        apn_parser.feed(f.read())
+        rsl.merge_apn_records(record, apn_parser.get_records())
+        self.assertEqual(record['apn'], ['2004-062'])
+        self.assertEqual(record['reel_image'], ['K614,0694'])
+
+class TestHTTPResponseReader(unittest.TestCase):
+    def feed_in_pieces(self, reader, data, piece_len=7):
+        complete = False
+        for i in range(0, len(data), piece_len):
+            complete = reader.feed(data[i:i + piece_len])
+        return complete
+
+    def test_content_length(self):
+        reader = rsa.HTTPResponseReader('GET')
+        complete = self.feed_in_pieces(reader, "HTTP/1.1 302 Found\r\n"
+                                       "Location: /results/1.html\r\n"
+                                       "Content-Length: 5\r\n\r\nmoved")
+        self.assertTrue(complete)
+        self.assertEqual(reader.status, 302)
+        self.assertEqual(reader.getheader('Location'), '/results/1.html')
+        self.assertEqual(reader.read(), 'moved')
+        self.assertFalse(reader.will_close())
+
+    def test_chunked(self):
+        reader = rsa.HTTPResponseReader('GET')
+        complete = self.feed_in_pieces(reader, "HTTP/1.1 200 OK\r\n"
+                                       "Transfer-Encoding: chunked\r\n\r\n"
+                                       "5\r\n<html\r\n2;x=y\r\n/>\r\n"
+                                       "0\r\n\r\n")
+        self.assertTrue(complete)
+        self.assertEqual(reader.read(), '<html/>')
+
+    def test_read_until_close(self):
+        reader = rsa.HTTPResponseReader('GET')
+        self.assertFalse(reader.feed("HTTP/1.0 200 OK\r\n\r\n<html>"))
+        self.assertTrue(reader.feed_eof())
+        self.assertEqual(reader.read(), '<html>')
+        self.assertTrue(reader.will_close())
+
 if __name__ == '__main__':
     unittest.main()
 